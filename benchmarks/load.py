@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""End-to-end load benchmark. Run from the root of the repository:
+
+    python -m benchmarks.load --requests 20000 --concurrency 50 --hit-ratio 0.9 --value-size 4096
+
+A memcached server (:mod:`txcaching.memcached`) and a twisted.web site with the three decorators are started in this process,
+then the site is loaded over HTTP by concurrent clients. Throughput and latency percentiles are printed as JSON.
+No real memcached is needed. The server and the clients share one reactor (and one CPU core),
+so compare results of runs on the same machine only.
+"""
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+from twisted.internet import defer, reactor, task
+from twisted.web import server
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.resource import Resource
+import twisted
+
+from txcaching import cache, memcached, metrics
+
+ENDPOINTS = ("sync", "async", "data")
+
+
+def make_site(value_size, backend_delay):
+    """Site with a resource for each decorator: /sync/<key>, /async/<key> and /data/<key>."""
+
+    value = "x" * value_size
+
+    @cache.cache(lazy_key=cache.default_lazy_key)
+    def fetch(key):
+        return task.deferLater(reactor, backend_delay, lambda: value)
+
+    class SyncPage(Resource):
+        isLeaf = True
+
+        @cache.cache_sync_render_GET(class_name="SyncPage", exclude_self=True)
+        def render_GET(self, request):
+            request.setHeader("Content-Type", "text/plain")
+            return value
+
+    class AsyncPage(Resource):
+        isLeaf = True
+
+        @cache.cache_async_render_GET(class_name="AsyncPage", exclude_self=True)
+        def render_GET(self, request):
+            def write(_):
+                request.setHeader("Content-Type", "text/plain")
+                request.write(value)
+                request.finish()
+
+            task.deferLater(reactor, backend_delay, lambda: None).addCallback(write)
+            return server.NOT_DONE_YET
+
+    class DataPage(Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            def write(data):
+                request.write(data)
+                request.finish()
+
+            fetch(request.postpath[0]).addCallback(write)
+            return server.NOT_DONE_YET
+
+    root = Resource()
+    root.putChild("sync", SyncPage())
+    root.putChild("async", AsyncPage())
+    root.putChild("data", DataPage())
+    site = server.Site(root)
+    site.noisy = False
+    return site
+
+
+class KeyChooser(object):
+    """Chooses keys so that the share of requests to the warm keys (cached after warm-up) is hit_ratio.
+    Other requests get unique keys, which are always missing.
+    """
+
+    def __init__(self, cardinality, hit_ratio, seed):
+        self.cardinality = cardinality
+        self.hit_ratio = hit_ratio
+        self.random = random.Random(seed)
+        self.cold = 0
+
+    def warm(self):
+        return ["key%d" % index for index in xrange(self.cardinality)]
+
+    def __call__(self):
+        if self.random.random() < self.hit_ratio:
+            return "key%d" % self.random.randrange(self.cardinality)
+        self.cold += 1
+        return "cold%d" % self.cold
+
+
+def percentile(latencies, share):
+    """Latency which the share of sorted latencies doesn't exceed."""
+
+    if not latencies:
+        return None
+    index = min(len(latencies) - 1, max(0, int(share * len(latencies) + 0.5) - 1))
+    return latencies[index]
+
+
+@defer.inlineCallbacks
+def drive(agent, base_url, urls, concurrency):
+    """Request the urls by concurrent clients.
+
+    :returns: Deferred which fires with pair (sorted latencies in seconds, number of failed requests)
+    """
+
+    urls = iter(urls)
+    latencies = []
+    errors = [0]
+
+    @defer.inlineCallbacks
+    def client():
+        for url in urls:
+            started = time.time()
+            try:
+                response = yield agent.request("GET", base_url + url)
+                yield readBody(response)
+                if response.code != 200:
+                    errors[0] += 1
+            except Exception:
+                errors[0] += 1
+            latencies.append(time.time() - started)
+
+    yield defer.gatherResults([client() for _ in xrange(concurrency)])
+    latencies.sort()
+    defer.returnValue((latencies, errors[0]))
+
+
+@defer.inlineCallbacks
+def run(reactor, options):
+    memcached_port, _ = memcached.listen(reactor=reactor, max_bytes=options.memcached_max_bytes,
+                                         latency=options.memcached_latency / 1000.0)
+    cache.load_config(disable=False, ip="127.0.0.1", port=memcached_port.getHost().port)
+    web = reactor.listenTCP(0, make_site(options.value_size, options.backend_delay / 1000.0), interface="127.0.0.1")
+    base_url = "http://127.0.0.1:%d/" % web.getHost().port
+
+    pool = HTTPConnectionPool(reactor)
+    pool.maxPersistentPerHost = options.concurrency
+    agent = Agent(reactor, pool=pool)
+
+    endpoints = ENDPOINTS if options.endpoint == "all" else (options.endpoint,)
+    chooser = KeyChooser(options.cardinality, options.hit_ratio, options.seed)
+    warm_urls = ["%s/%s" % (endpoint, key) for endpoint in endpoints for key in chooser.warm()]
+    yield drive(agent, base_url, warm_urls, options.concurrency)
+
+    urls = ["%s/%s" % (endpoints[index % len(endpoints)], chooser()) for index in xrange(options.requests)]
+    metrics.reset()
+    started = time.time()
+    latencies, errors = yield drive(agent, base_url, urls, options.concurrency)
+    elapsed = time.time() - started
+
+    yield pool.closeCachedConnections()
+    yield web.stopListening()
+    yield memcached_port.stopListening()
+
+    functions = metrics.snapshot()["functions"].values()
+    report = {
+        "python": platform.python_version(),
+        "twisted": twisted.__version__,
+        "options": vars(options),
+        "requests": len(latencies),
+        "errors": errors,
+        "cache": {counter: sum(function[counter] for function in functions)
+                  for counter in ("hits", "misses", "errors", "bypasses")},
+        "seconds": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else None,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.5) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "p999": percentile(latencies, 0.999) * 1000,
+            "max": latencies[-1] * 1000,
+        },
+    }
+    output = open(options.output, "w") if options.output else sys.stdout
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write("\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=10000, help="Measured requests (after warm-up)")
+    parser.add_argument("--concurrency", type=int, default=20, help="Concurrent HTTP clients")
+    parser.add_argument("--hit-ratio", type=float, default=0.9, help="Share of requests to cached keys")
+    parser.add_argument("--value-size", type=int, default=1024, help="Size of responses, in bytes")
+    parser.add_argument("--cardinality", type=int, default=1000, help="Number of distinct cached keys")
+    parser.add_argument("--endpoint", choices=ENDPOINTS + ("all",), default="all",
+                        help="Decorator to load: sync (cache_sync_render_GET), async (cache_async_render_GET), "
+                             "data (cache) or all of them in turn")
+    parser.add_argument("--backend-delay", type=float, default=0.0,
+                        help="Delay of the backend of async and data endpoints on misses, in milliseconds")
+    parser.add_argument("--memcached-latency", type=float, default=0.0,
+                        help="Delay of every memcached reply, in milliseconds")
+    parser.add_argument("--memcached-max-bytes", type=int, default=memcached.DEFAULT_MAX_BYTES,
+                        help="Memory limit of memcached; least recently used items are evicted")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="File to write JSON results to (stdout by default)")
+    options = parser.parse_args(argv)
+    task.react(run, [options])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmarks of txcaching hot paths. Run from the root of the repository:
+
+    python -m benchmarks.micro --output before.json
+    python -m benchmarks.micro --compare before.json
+
+Every benchmark is timed with :mod:`timeit`: the best and the median of several repeats are reported
+in microseconds per call. Arguments are generated with a fixed seed, so runs are comparable across commits.
+"""
+
+import argparse
+import cPickle as pickle
+import json
+import platform
+import random
+import subprocess
+import sys
+import timeit
+
+from twisted.internet import defer
+from twisted.web.http_headers import Headers
+import twisted
+
+from txcaching import cache, keyregistry, response
+
+SEED = 1234
+
+
+class MemoryTransport(object):
+    def loseConnection(self):
+        pass
+
+
+class MemoryProtocol(object):
+    """Stand-in for memcached connection which answers immediately from a dictionary.
+    If store is false, values are never stored, so every lookup is a miss.
+    """
+
+    def __init__(self, store=True):
+        self.data = {}
+        self.store = store
+        self.transport = MemoryTransport()
+
+    def get(self, key, withIdentifier=False):
+        return defer.succeed((0, self.data.get(key)))
+
+    def set(self, key, val, flags=0, expireTime=0):
+        if self.store:
+            self.data[key] = val
+        return defer.succeed(True)
+
+    add = set
+
+
+class BenchRequest(object):
+    """Minimal request for render_GET decorators."""
+
+    method = "GET"
+    code = 200
+
+    def __init__(self, uri, headers=None):
+        self.uri = uri
+        self.args = {}
+        self.requestHeaders = Headers(headers or {})
+        self.responseHeaders = Headers()
+        self.written = 0
+
+    def getHeader(self, name):
+        values = self.requestHeaders.getRawHeaders(name)
+        return values[-1] if values else None
+
+    def getCookie(self, name):
+        return None
+
+    def setHeader(self, name, value):
+        self.responseHeaders.setRawHeaders(name, [value])
+
+    def setResponseCode(self, code, message=None):
+        self.code = code
+
+    def write(self, data):
+        self.written += len(data)
+
+    def finish(self):
+        pass
+
+
+def lookup_user(user_id, email, limit=10):
+    return {"id": user_id, "email": email, "limit": limit}
+
+
+class Catalog(object):
+    def __init__(self):
+        self.name = "catalog"
+
+    def search(self, query, page=1, filters=None):
+        return [query, page, filters]
+
+
+class Page(object):
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/html")
+        return "<html><body>%s</body></html>" % ("x" * 2000)
+
+
+def _uri(rnd, count):
+    args = ["arg%d=%d" % (rnd.randint(0, 99), rnd.randint(0, 10 ** 6)) for _ in xrange(count)]
+    return "/api/v1/items/?" + "&".join(args + ["_dc=%d" % rnd.randint(0, 10 ** 12)])
+
+
+def _record(rnd):
+    return {
+        "id": rnd.randint(0, 10 ** 9),
+        "name": "user%d" % rnd.randint(0, 10 ** 6),
+        "email": "user%d@example.com" % rnd.randint(0, 10 ** 6),
+        "tags": ["tag%d" % rnd.randint(0, 100) for _ in xrange(10)],
+        "scores": [rnd.random() for _ in xrange(20)],
+        "active": True,
+    }
+
+
+def _fill_registry(size):
+    keyregistry.clear()
+    for index in xrange(size):
+        keyregistry.register("key%d" % index, lookup_user, (index, "user%d@example.com" % index), {"limit": 10})
+
+
+def _drive(d):
+    """Run the Deferred which fires synchronously and return its result."""
+
+    result = []
+    d.addBoth(result.append)
+    return result[0]
+
+
+def benchmarks():
+    """Dictionary {benchmark name: (setup, function to time)}. Setup is called once before timing."""
+
+    rnd = random.Random(SEED)
+    catalog = Catalog()
+    nested_kwargs = {"filters": {"color": ["red", "blue"], "price": (10, 100), "in_stock": True}, "page": 3}
+    short_uri = _uri(rnd, 3)
+    long_uri = _uri(rnd, 20)
+    redundant = frozenset(["_dc"])
+    vary_key = cache._key_builder(("_dc",), vary_headers=("Accept-Language", "Host"))
+    vary_request = BenchRequest(long_uri, {"Accept-Language": ["en-US,en;q=0.8"], "Host": ["example.com"]})
+    small_value = ("value", 1)
+    record = _record(rnd)
+    records = [_record(rnd) for _ in xrange(100)]
+    envelope = response.CachedResponse(200, (("Content-Type", ("text/html",)),), "x" * 20000, '"etag"', 0, ())
+    dumped_envelope = response.dumps(envelope)
+
+    def registry(size):
+        return lambda: _fill_registry(size)
+
+    def no_setup():
+        pass
+
+    return {
+        "lazy_key.scalar_args": (no_setup, lambda: cache.default_lazy_key(
+            lookup_user, (42, "user42@example.com"), {"limit": 10})),
+        "lazy_key.method_exclude_self": (no_setup, lambda: cache.default_lazy_key(
+            Catalog.search, (catalog, "shoes"), nested_kwargs, exclude_self=True, class_name="Catalog")),
+        "canonical_uri.3_args": (no_setup, lambda: cache._canonical_uri(short_uri, redundant)),
+        "canonical_uri.20_args": (no_setup, lambda: cache._canonical_uri(long_uri, redundant)),
+        "key_builder.vary_headers": (no_setup, lambda: vary_key(vary_request)),
+        "keyregistry.register.100": (registry(100), lambda: keyregistry.register(
+            "key50", lookup_user, (50, "user50@example.com"), {"limit": 10})),
+        "keyregistry.register.10000": (registry(10000), lambda: keyregistry.register(
+            "key5000", lookup_user, (5000, "user5000@example.com"), {"limit": 10})),
+        "keyregistry.key.100": (registry(100), lambda: keyregistry.key(
+            lookup_user, (50, "user50@example.com"), {"limit": 10})),
+        "keyregistry.key.10000": (registry(10000), lambda: keyregistry.key(
+            lookup_user, (5000, "user5000@example.com"), {"limit": 10})),
+        "pickle.small_tuple": (no_setup, lambda: pickle.loads(pickle.dumps(small_value))),
+        "pickle.record": (no_setup, lambda: pickle.loads(pickle.dumps(record))),
+        "pickle.100_records": (no_setup, lambda: pickle.loads(pickle.dumps(records))),
+        "response.dumps_20k": (no_setup, lambda: response.dumps(envelope)),
+        "response.loads_20k": (no_setup, lambda: response.loads(dumped_envelope)),
+    }
+
+
+def decorator_benchmarks():
+    """Benchmarks of decorated calls against :class:`MemoryProtocol`. They patch :func:`txcaching.cache.connect`,
+    so they are built separately.
+    """
+
+    hit_proto = MemoryProtocol()
+    miss_proto = MemoryProtocol(store=False)
+    protos = {"proto": hit_proto}
+    cache.config = cache.ConfigSchema(disable=False)
+    cache.connect = lambda: defer.succeed(protos["proto"])
+
+    cached_lookup = cache.cache(lazy_key=cache.default_lazy_key)(lookup_user)
+    cached_page = cache.cache_sync_render_GET(exclude_self=True, class_name="Page")(Page.render_GET.im_func)
+    page = Page()
+    request = BenchRequest("/page/?id=1")
+
+    def using(proto):
+        def setup():
+            cache.config = cache.ConfigSchema(disable=False)
+            protos["proto"] = proto
+            keyregistry.clear()
+        return setup
+
+    def disabled():
+        cache.config = cache.ConfigSchema(disable=True)
+
+    def warm_page():
+        using(hit_proto)()
+        cached_page(page, BenchRequest("/page/?id=1"))
+
+    return {
+        "decorator.bare_call": (using(hit_proto), lambda: lookup_user(42, "user42@example.com", limit=10)),
+        "decorator.disabled_call": (disabled, lambda: cached_lookup(42, "user42@example.com", limit=10)),
+        "decorator.cache_hit": (using(hit_proto), lambda: _drive(cached_lookup(42, "user42@example.com", limit=10))),
+        "decorator.cache_miss": (using(miss_proto), lambda: _drive(cached_lookup(42, "user42@example.com", limit=10))),
+        "decorator.render_GET_hit": (warm_page, lambda: cached_page(page, request)),
+    }
+
+
+def _commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=open("/dev/null", "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(selected=None, repeat=5, number=None):
+    """Run the benchmarks whose names start with one of selected prefixes (all by default).
+
+    :param number: Calls per repeat. By default, it is chosen so that a repeat takes at least 0.2 s.
+
+    :returns: dict {benchmark name: {"best_us", "median_us", "number", "repeat"}}
+    """
+
+    all_benchmarks = benchmarks()
+    all_benchmarks.update(decorator_benchmarks())
+    results = {}
+    for name in sorted(all_benchmarks):
+        if selected and not any(name.startswith(prefix) for prefix in selected):
+            continue
+        setup, func = all_benchmarks[name]
+        setup()
+        timer = timeit.Timer(func)
+        calls = number
+        if calls is None:
+            calls = 1
+            elapsed = timer.timeit(calls)
+            while elapsed < 0.02:
+                calls *= 2
+                elapsed = timer.timeit(calls)
+            calls = max(1, int(calls * 0.2 / elapsed))
+        timings = sorted(timer.repeat(repeat, calls))
+        results[name] = {
+            "best_us": timings[0] / calls * 1e6,
+            "median_us": timings[len(timings) // 2] / calls * 1e6,
+            "number": calls,
+            "repeat": repeat,
+        }
+    return results
+
+
+def compare(previous, current):
+    """Lines with relative change of median time of every benchmark present in both runs."""
+
+    lines = []
+    for name in sorted(current):
+        if name in previous:
+            before = previous[name]["median_us"]
+            after = current[name]["median_us"]
+            lines.append("%-32s %10.3f us -> %10.3f us  %+7.1f%%" % (name, before, after,
+                                                                     (after - before) / before * 100))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("benchmarks", nargs="*", help="Prefixes of benchmark names to run (all by default)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=None, help="Calls per repeat (calibrated by default)")
+    parser.add_argument("--output", help="File to write JSON results to (stdout by default)")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    options = parser.parse_args(argv)
+
+    report = {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "twisted": twisted.__version__,
+        "platform": platform.platform(),
+        "results": run(options.benchmarks, options.repeat, options.number),
+    }
+
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as previous:
+            print "\n".join(compare(json.load(previous)["results"], report["results"]))
+    elif not options.output:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
+
+
+if __name__ == "__main__":
+    main()
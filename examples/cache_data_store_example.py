@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 import time
 
-from twisted.internet import defer, reactor
+from twisted.internet import reactor
 from twisted.web import server
 from twisted.web.resource import Resource
 
@@ -84,17 +84,17 @@ class DB:
         self.data = {}
 
 
-    @cache.cache(class_name="DB", exclude_self=True)
+    @cache.cache(class_name="DB", exclude_self=True, threaded=True)
     def get(self, username):
-        """Very heavy request"""
+        """Very heavy blocking request. It runs in a thread, so other requests are served meanwhile."""
 
         print "Reading from DB"
         time.sleep(2)
         email = self.data.get(username, None)
         if email:
-            return defer.succeed(email)
+            return email
         else:
-            return defer.fail(Exception("User not found"))
+            raise Exception("User not found")
 
     def set(self, username, email):
         self.data[username] = email
@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
+from StringIO import StringIO
 import inspect
+import threading
+import zlib
 
-from twisted.internet import defer
+from twisted.internet import defer, task
+from twisted.internet.address import IPv4Address
+from twisted.python import log
+from twisted.test import proto_helpers
 from twisted.web.server import NOT_DONE_YET
 from twisted.trial import unittest
 
-from txcaching import cache, keyregistry
+from txcaching import accesstrace, adaptive, cache, chunking, hotkeys, keyregistry, metrics, prometheus, response, serialization, simulator, stats, tracing, workers
+from txcaching.connection import CacheProtocol
 from .mock import Mock
 from .utils import MockRequest
 
@@ -38,16 +45,29 @@ class MockTransport:
 class MockCacheServer:
     def __init__(self):
         self.data = {}
+        self.expire_times = {}
         self.connected = True
         self.transport = MockTransport(self)
 
-    def get(self, key, expireTime=0):
+    def get(self, key, withIdentifier=False):
         return defer.succeed((0, self.data.get(key, None)))
 
-    def add(self, key, value, expireTime=0):
+    def getMultiple(self, keys, withIdentifier=False):
+        return defer.succeed({key: (0, self.data.get(key, None)) for key in keys})
+
+    def add(self, key, value, flags=0, expireTime=0):
+        if key in self.data:
+            return defer.succeed(False)
+        return self.set(key, value, flags, expireTime)
+
+    def set(self, key, value, flags=0, expireTime=0):
         self.data[key] = value
+        self.expire_times[key] = expireTime
         return defer.succeed(True)
 
+    def delete(self, key):
+        return defer.succeed(self.data.pop(key, None) is not None)
+
     def flushAll(self):
         self.data = {}
 
@@ -67,6 +87,16 @@ def non_blocking_func_with_args(arg1, arg2="abc"):
     return defer.succeed((str(arg1) + str(arg2), 1))
 
 
+@cache.cache(lazy_key=cache.default_lazy_key)
+@mocked
+def large_value_func(size):
+    return "x" * size
+
+
+def thread_name(arg):
+    return threading.current_thread().name
+
+
 class SomeClass:
     def __init__(self):
         self.call_count = 0
@@ -88,6 +118,56 @@ class SyncService:
         return "sync_render_get_result"
 
 
+class CompressedSyncService:
+
+    def __init__(self):
+        self.call_count = 0
+
+    @cache.cache_sync_render_GET(class_name="CompressedSyncService", exclude_self=True, encodings=("gzip",))
+    def render_GET(self, request):
+        self.call_count += 1
+        return "compressible " * 100
+
+
+class LocalizedSyncService:
+
+    def __init__(self):
+        self.call_count = 0
+
+    @cache.cache_sync_render_GET(class_name="LocalizedSyncService", exclude_self=True,
+                                 vary_headers=("Accept-Language",), vary_session=("utoken",))
+    def render_GET(self, request):
+        self.call_count += 1
+        return "%s:%s" % (request.getHeader("Accept-Language"), request.getSession().utoken)
+
+
+class FreshnessSyncService:
+
+    def __init__(self):
+        self.call_count = 0
+
+    @cache.cache_sync_render_GET(class_name="FreshnessSyncService", exclude_self=True, expireTime=60,
+                                 ttl_from_headers=True)
+    def render_GET(self, request):
+        self.call_count += 1
+        cache_control = request.args.get("cache_control")
+        if cache_control:
+            request.setHeader("Cache-Control", cache_control[0])
+        return "fresh"
+
+
+class FailingSyncService:
+
+    def __init__(self):
+        self.call_count = 0
+
+    @cache.cache_sync_render_GET(class_name="FailingSyncService", exclude_self=True)
+    def render_GET(self, request):
+        self.call_count += 1
+        request.setResponseCode(500)
+        return "oops"
+
+
 class AsyncService:
 
     def __init__(self):
@@ -105,6 +185,54 @@ class AsyncService:
         return NOT_DONE_YET
 
 
+class LocalizedAsyncService:
+
+    def __init__(self):
+        self.call_count = 0
+
+    @cache.cache_async_render_GET(class_name="LocalizedAsyncService", exclude_self=True,
+                                  vary_headers=("Accept-Language",), encodings=("gzip",))
+    def render_GET(self, request):
+        self.call_count += 1
+        request.write(request.getHeader("Accept-Language"))
+        request.finish()
+        return NOT_DONE_YET
+
+
+class AsyncJSONService:
+
+    def __init__(self):
+        self.call_count = 0
+
+    @cache.cache_async_render_GET(class_name="AsyncJSONService", exclude_self=True)
+    def render_GET(self, request):
+
+        def write_response(response):
+            request.setResponseCode(200)
+            request.setHeader("Content-Type", "application/json")
+            request.setHeader("X-Request-Id", str(self.call_count))
+            request.write(response)
+            request.finish()
+
+        defer.succeed('{"result": 1}').addCallback(write_response)
+        self.call_count += 1
+        return NOT_DONE_YET
+
+
+class AsyncChunkedService:
+
+    def __init__(self):
+        self.call_count = 0
+
+    @cache.cache_async_render_GET(class_name="AsyncChunkedService", exclude_self=True, max_cached_size=100)
+    def render_GET(self, request):
+        self.call_count += 1
+        for _ in range(int(request.args["chunks"][0])):
+            request.write("0123456789" * 3)
+        request.finish()
+        return NOT_DONE_YET
+
+
 class AsyncFailingService:
 
     def __init__(self):
@@ -203,6 +331,340 @@ class TestCache(unittest.TestCase):
         #Check that the initial function was called only twice
         self.assertEqual(func.init_func.call_count, 2)
 
+    @defer.inlineCallbacks
+    def test_cache_chunked_value(self):
+        cache.config = cache.ConfigSchema(False, None, None, chunk_size=100)
+        func = large_value_func
+
+        result = yield func(250)  #First call of initial function
+        self.assertEqual(result, "x" * 250)
+        self.assertEqual(len(self.cache_server.data), 4)  #Manifest and 3 chunks
+
+        result = yield func(250)  #Get data from cache, assembled from chunks.
+        self.assertEqual(result, "x" * 250)
+        self.assertEqual(func.init_func.call_count, 1)
+
+        chunk_key = [key for key, value in self.cache_server.data.items() if value.startswith("x")][0]
+        del self.cache_server.data[chunk_key]  #Partially evicted value is a miss.
+
+        result = yield func(250)
+        self.assertEqual(result, "x" * 250)
+        self.assertEqual(func.init_func.call_count, 2)
+
+        yield cache.set("large_key", "y" * 500)
+        result = yield cache.get("large_key")
+        self.assertEqual(result, (0, "y" * 500))
+
+    @defer.inlineCallbacks
+    def test_chunked_value_races(self):
+        server = self.cache_server
+        server.data["key"] = "stored by another writer"
+        stored = yield chunking.store(server, "add", "key", "z" * 250, chunk_size=100)
+        self.assertFalse(stored)
+        self.assertEqual(server.data, {"key": "stored by another writer"})  #No orphaned chunks
+
+        broken = chunking.MANIFEST_PREFIX + "token:3:250:0"
+        result = yield chunking._broken((0, broken), server, "key")
+        self.assertEqual(result, (0, None))
+        self.assertEqual(server.data, {"key": "stored by another writer"})  #The new value is kept
+
+        server.data["key"] = broken
+        yield chunking._broken((0, broken), server, "key")
+        self.assertEqual(server.data, {})
+
+    @defer.inlineCallbacks
+    def test_metrics(self):
+        func = cache.cache(lazy_key=cache.default_lazy_key)(redecorate(blocking_func_with_args))
+        func_metrics = metrics.function(keyregistry.func_id(func))
+        func_metrics.reset()
+
+        yield func(1, arg2=5)
+        yield func(1, arg2=5)
+        yield func(1, arg2=5)
+        cache.connect = lambda: defer.fail(Exception("memcached is unavailable"))
+        yield func(1, arg2=5)
+
+        snapshot = metrics.snapshot()["functions"][keyregistry.func_id(func)]
+        self.assertEqual((snapshot["hits"], snapshot["misses"], snapshot["errors"]), (2, 1, 1))
+        self.assertEqual(snapshot["lookup_latency"]["count"], 3)
+        self.assertEqual(snapshot["recompute_latency"]["count"], 1)
+        self.assertEqual(snapshot["value_size"]["buckets"][0], (64, 1))
+
+    @defer.inlineCallbacks
+    def test_function_error(self):
+        failing = Mock(side_effect=ValueError("failed"))
+        failing.__name__ = "failing"
+        func = cache.cache(lazy_key=cache.default_lazy_key)(failing)
+        func_metrics = metrics.function(keyregistry.func_id(func))
+        func_metrics.reset()
+
+        yield self.assertFailure(func(1), ValueError)
+        self.assertEqual(failing.call_count, 1)  #Errors of the function aren't errors of the lookup.
+        self.assertEqual((func_metrics.misses, func_metrics.errors), (1, 0))
+        self.assertEqual(self.cache_server.data, {})
+
+    def test_histogram(self):
+        histogram = metrics.Histogram((1, 10))
+        for value in (0.5, 1, 5, 100):
+            histogram.record(value)
+        self.assertEqual(histogram.snapshot(), {"buckets": [(1, 2), (10, 3), (float("inf"), 4)],
+                                                "count": 4, "sum": 106.5})
+
+    def test_prometheus(self):
+        registry = metrics.Registry()
+        func_metrics = registry.function('module.func"1')
+        func_metrics.hits, func_metrics.misses = 3, 1
+        func_metrics.value_size.record(100)
+        registry.operation("get").errors = 2
+        registry.connections_open = registry.connections_total = 1
+
+        text = prometheus.render(registry)
+        self.assertIn('txcaching_function_hits_total{function="module.func\\"1"} 3', text)
+        self.assertIn('txcaching_function_hit_ratio{function="module.func\\"1"} 0.75', text)
+        self.assertIn('txcaching_function_value_size_bytes_bucket{function="module.func\\"1",le="256.0"} 1', text)
+        self.assertIn('txcaching_function_value_size_bytes_bucket{function="module.func\\"1",le="+Inf"} 1', text)
+        self.assertIn('txcaching_memcached_operation_errors_total{operation="get"} 2', text)
+        self.assertIn("txcaching_memcached_connections_open 1", text)
+
+        request = MockRequest("", "/metrics")
+        self.assertEqual(prometheus.MetricsResource(registry).render_GET(request), text)
+        self.assertEqual(request.responseHeaders.getRawHeaders("Content-Type"), [prometheus.CONTENT_TYPE])
+
+    @defer.inlineCallbacks
+    def test_tracing(self):
+        hook = RecordingHook()
+        tracing.add_hook(hook)
+        self.addCleanup(tracing.remove_hook, hook)
+        func = cache.cache(lazy_key=cache.default_lazy_key)(redecorate(blocking_func_with_args))
+
+        yield func(2, arg2=7)
+        yield func(2, arg2=7)
+        cache.connect = lambda: defer.fail(Exception("memcached is unavailable"))
+        yield func(2, arg2=7)
+
+        self.assertEqual(hook.started, hook.finished)
+        self.assertEqual([(operation.name, operation.outcome) for operation in hook.finished],
+                         [("lookup", "miss"), ("recompute", "ok"), ("lookup", "hit"), ("lookup", "error")])
+        self.assertEqual(hook.finished[0].function, keyregistry.func_id(func))
+        self.assertEqual(hook.finished[1].sent, hook.finished[2].received)
+        self.assertTrue(hook.finished[2].received > 0)
+
+    @defer.inlineCallbacks
+    def test_access_trace(self):
+        trace = StringIO()
+        recorder = accesstrace.record(trace)
+        func = cache.cache(lazy_key=cache.default_lazy_key)(redecorate(blocking_func_with_args))
+
+        yield func(3, arg2=1)
+        yield func(3, arg2=1)
+        recorder.close()
+
+        trace.seek(0)
+        events = list(accesstrace.read(trace))
+        self.assertEqual([event.kind for event in events], [accesstrace.MISS, accesstrace.COMPUTE, accesstrace.HIT])
+        self.assertEqual(set(event.function for event in events), {keyregistry.func_id(func)})
+        self.assertEqual(events[1].size, events[2].size)
+        self.assertNotIn(recorder, tracing.hooks)
+
+        result = simulator.simulate(events)
+        self.assertEqual((result["lookups"], result["misses"], result["hit_ratio"], result["recorded_hit_ratio"]),
+                         (2, 1, 0.5, 0.5))
+
+    def test_simulator(self):
+        def events(*keys):
+            return [accesstrace.Event(accesstrace.MISS if index < 2 else accesstrace.HIT, index, key, "func", 1000, 0)
+                    for index, key in enumerate(keys)] + [accesstrace.Event(accesstrace.COMPUTE, 0, 1, "func", 1000, 0.5)]
+
+        trace = events(1, 2, 1, 1, 2, 1)
+        result = simulator.simulate(trace, l1_size=1)
+        self.assertEqual((result["l1_hits"], result["memcached_hits"], result["misses"]), (1, 3, 2))
+        self.assertEqual(result["backend_seconds"], 1.0)
+
+        result = simulator.simulate(trace, memcached_bytes=1500)
+        self.assertEqual((result["misses"], result["memcached_evictions"]), (5, 4))
+
+        result = simulator.simulate(trace, memcached_bytes=1500, compression=True)
+        self.assertEqual(result["misses"], 2)
+        self.assertEqual(result["memcached_bytes_read"], 4 * 400)
+
+        result = simulator.simulate(trace, ttls={"func": 2})
+        self.assertEqual(result["misses"], 5)
+
+        trace = events(1, 1, 1, 2, 3, 1)
+        self.assertEqual(simulator.simulate(trace, l1_size=2, l1_policy="lru")["l1_hits"], 2)
+        self.assertEqual(simulator.simulate(trace, l1_size=2, l1_policy="lfu")["l1_hits"], 3)
+
+    def test_count_min_sketch(self):
+        sketch = hotkeys.CountMinSketch(width=64, depth=4)
+        for index in xrange(1000):
+            sketch.add("key%d" % (index % 100))
+        for index in xrange(100):
+            sketch.add("hot")
+        self.assertTrue(sketch.estimate("hot") >= 100)
+        self.assertTrue(sketch.estimate("key1") >= 10)
+
+        sketch.decay()
+        self.assertTrue(50 <= sketch.estimate("hot") < 100)
+
+    @defer.inlineCallbacks
+    def test_hot_keys(self):
+        detector = hotkeys.enable(k=2, sample_rate=1, min_count=3, local_size=10, local_ttl=60)
+        self.addCleanup(hotkeys.disable)
+        func = cache.cache(lazy_key=cache.default_lazy_key)(redecorate(blocking_func_with_args))
+        func_metrics = metrics.function(keyregistry.func_id(func))
+        func_metrics.reset()
+
+        for arg in (1, 2, 3, 1, 1, 1):
+            yield func(arg, arg2=4)
+        self.assertEqual(len(detector.local_tier), 1)
+        top = hotkeys.top()
+        self.assertEqual(top[0][1:], (keyregistry.func_id(func), 4))
+        self.assertEqual(len(top), 2)
+
+        self.cache_server.flushAll()
+        result = yield func(1, arg2=4)
+        self.assertEqual(result, ("14", 1))
+        self.assertEqual((func_metrics.misses, func_metrics.hits, func_metrics.local_hits), (3, 4, 2))
+
+        yield cache.delete(top[0][0])
+        self.assertEqual(len(detector.local_tier), 0)
+
+    @defer.inlineCallbacks
+    def test_hot_keys_per_client(self):
+        detector = hotkeys.enable(k=2, sample_rate=1, min_count=1, local_size=10, local_ttl=60)
+        self.addCleanup(hotkeys.disable)
+        other_server = MockCacheServer()
+        client = cache.CacheClient(registry=metrics.Registry(), chunk_size=0)
+        client.connect = lambda: defer.succeed(other_server)
+        func = cache.cache(lazy_key=cache.default_lazy_key)(redecorate(blocking_func_with_args))
+        other_func = cache.cache(lazy_key=cache.default_lazy_key, client=client)(redecorate(blocking_func_with_args))
+
+        yield func(1, arg2=4)
+        yield func(1, arg2=4)
+        self.assertEqual(len(detector.local_tier), 1)
+        key = self.cache_server.data.keys()[0]
+        other_server.data[key] = client.serializer.dumps(("other", 1))
+        result = yield other_func(1, arg2=4)
+        self.assertEqual(result, ("other", 1))
+
+        yield client.delete(key)
+        self.assertEqual(len(detector.local_tier), 1)
+
+        self.cache_server.append = Mock(return_value=defer.succeed(True))
+        yield cache.append(key, "tail")
+        self.assertEqual(len(detector.local_tier), 0)
+
+    def test_adaptive_bypass_decisions(self):
+        bypass = adaptive.AdaptiveBypass(interval=10)
+        bypass.random = lambda: 0.5
+        for _ in xrange(200):
+            bypass.compute(0.001)
+            bypass.lookup(0.01, True)
+        self.assertEqual(bypass.ratio, bypass.max_ratio)
+        self.assertTrue(bypass.bypass())
+
+        for _ in xrange(200):
+            bypass.lookup(0.0001, True)
+        self.assertEqual(bypass.ratio, 0)
+        self.assertFalse(bypass.bypass())
+
+        for _ in xrange(200):
+            bypass.lookup(0.0005, False)
+        self.assertEqual(bypass.ratio, bypass.max_ratio)
+
+    @defer.inlineCallbacks
+    def test_adaptive_bypass(self):
+        func = cache.cache(lazy_key=cache.default_lazy_key, adaptive_bypass=True)(redecorate(blocking_func_with_args))
+        func_metrics = metrics.function(keyregistry.func_id(func))
+        func_metrics.reset()
+        func.adaptive.random = lambda: 0.0
+
+        result = yield func(1, arg2=6)
+        self.assertEqual(result, ("16", 1))
+        self.assertEqual(func.adaptive.lookups, 1)
+        self.assertEqual(len(self.cache_server.data), 1)
+
+        func.adaptive.ratio = 1.0
+        self.cache_server.flushAll()
+        result = yield func(1, arg2=6)
+        self.assertEqual(result, ("16", 1))
+        self.assertEqual(len(self.cache_server.data), 0)
+        self.assertEqual(func.adaptive.lookups, 1)
+        self.assertEqual((func_metrics.misses, func_metrics.adaptive_bypasses), (1, 1))
+        self.assertEqual(func_metrics.recompute_latency.count, 2)
+
+    @defer.inlineCallbacks
+    def test_threaded(self):
+        pool = workers.Pool("test", size=2)
+        self.addCleanup(pool.stop)
+        pool_metrics = metrics.registry.pool("test")
+        pool_metrics.reset()
+        func = cache.cache(lazy_key=cache.default_lazy_key, threaded=pool)(thread_name)
+
+        name = yield func(1)
+        self.assertNotEqual(name, threading.current_thread().name)
+        cached_name = yield func(1)
+        self.assertEqual(cached_name, name)
+
+        snapshot = metrics.snapshot()["pools"]["test"]
+        self.assertEqual((snapshot["queued"], snapshot["running"], snapshot["completed"]), (0, 0, 1))
+        self.assertEqual(snapshot["wait"]["count"], 1)
+
+    @defer.inlineCallbacks
+    def test_serialization(self):
+        self.assertEqual(serialization.dumps("x" * 100)[:1], "\x80") #Binary protocol
+        self.assertEqual(serialization.loads(cache.pickle.dumps({"a": 1})), {"a": 1})
+
+        serialization.configure(threshold=1000)
+        self.addCleanup(serialization.configure, **serialization.default_config._asdict())
+        pool_metrics = metrics.registry.pool("serialization")
+        pool_metrics.reset()
+        request = MockRequest("", "/ibd3/test_compressed/")
+
+        variants = yield serialization.compress(request, "x" * 500, ("gzip",))
+        self.assertEqual(pool_metrics.completed, 0)
+        self.assertEqual(zlib.decompress(variants[0][1], 16 + zlib.MAX_WBITS), "x" * 500)
+
+        variants = yield serialization.compress(request, "y" * 5000, ("gzip",))
+        self.assertEqual(pool_metrics.completed, 1)
+        self.assertEqual(zlib.decompress(variants[0][1], 16 + zlib.MAX_WBITS), "y" * 5000)
+
+    @defer.inlineCallbacks
+    def test_client(self):
+        other_server = MockCacheServer()
+        client = cache.CacheClient(registry=metrics.Registry(), chunk_size=0)
+        client.connect = lambda: defer.succeed(other_server)
+        func = cache.cache(lazy_key=cache.default_lazy_key, client=client)(redecorate(blocking_func_with_args))
+
+        yield func(1, arg2=7)
+        result = yield func(1, arg2=7)
+        self.assertEqual(result, ("17", 1))
+        self.assertEqual((len(other_server.data), len(self.cache_server.data)), (1, 0))
+        func_metrics = client.metrics.function(keyregistry.func_id(func))
+        self.assertEqual((func_metrics.hits, func_metrics.misses), (1, 1))
+
+        yield client.set("key", {"a": 1})
+        result = yield client.get("key")
+        self.assertEqual(result, (0, {"a": 1}))
+        self.assertFalse("key" in self.cache_server.data)
+
+        other_server.append = Mock(return_value=defer.succeed(True))
+        client.serializer = Mock(dumps=lambda value: "dumped")
+        yield client.append("key", "tail")
+        other_server.append.assert_called_once_with("key", "dumped")
+
+    @defer.inlineCallbacks
+    def test_runtime_disable(self):
+        func = cache.cache(lazy_key=cache.default_lazy_key)(redecorate(blocking_func_with_args))
+        yield cache.reconfigure(disable=True)
+        self.assertEqual(self.successResultOf(func(1, arg2=8)), ("18", 1))
+        self.assertEqual(len(self.cache_server.data), 0)
+
+        yield cache.reconfigure(disable=False)
+        result = yield func(1, arg2=8)
+        self.assertEqual(result, ("18", 1))
+        self.assertEqual(len(self.cache_server.data), 1)
+
     @defer.inlineCallbacks
     def test_class_method(self):
         obj = SomeClass()
@@ -298,6 +760,218 @@ class TestCache(unittest.TestCase):
         #Check that the initial function was called only twice
         self.assertEqual(service.call_count, 2)
 
+    @defer.inlineCallbacks
+    def test_async_render_get_headers(self):
+        service = AsyncJSONService()
+        request = MockRequest("", "/ibd3/test_json/")
+
+        yield service.render_GET(request)  #First call of initial function
+        request.clear()
+
+        yield service.render_GET(request)  #Get data from cache. Initial function is not called.
+        self.assertEqual(service.call_count, 1)
+        self.assertEqual(request.stream.getvalue(), '{"result": 1}')
+        self.assertEqual(request.responseHeaders.getRawHeaders("Content-Type"), ["application/json"])
+        #Headers which are not listed in cached_headers are not replayed
+        self.assertEqual(request.responseHeaders.getRawHeaders("X-Request-Id"), None)
+
+    @defer.inlineCallbacks
+    def test_async_render_get_vary_on_miss(self):
+        service = LocalizedAsyncService()
+        requests = []
+        for _ in xrange(2):
+            request = MockRequest("", "/ibd3/test_localized_async/")
+            request.requestHeaders.setRawHeaders("Accept-Language", ["fr"])
+            yield service.render_GET(request)
+            self.assertEqual(request.stream.getvalue(), "fr")
+            requests.append(request)
+        self.assertEqual(service.call_count, 1)
+        #The body is too short to be compressed, so the hit doesn't vary by Accept-Encoding.
+        self.assertEqual(requests[0].responseHeaders.getRawHeaders("Vary"), ["Accept-Language", "Accept-Encoding"])
+        self.assertEqual(requests[1].responseHeaders.getRawHeaders("Vary"), ["Accept-Language"])
+
+    @defer.inlineCallbacks
+    def test_render_get_conditional(self):
+        service = SyncService()
+        request = MockRequest("", "/ibd3/test_uri/?arg=1")
+
+        yield service.render_GET(request)  #First call of initial function
+        etag = request.responseHeaders.getRawHeaders("ETag")[0]
+        last_modified = request.responseHeaders.getRawHeaders("Last-Modified")[0]
+        request.clear()
+
+        request.requestHeaders.setRawHeaders("If-None-Match", ['"other"', etag])
+        yield service.render_GET(request)  #Client has the same version: 304 without body.
+        self.assertEqual(request.code, 304)
+        self.assertEqual(request.stream.getvalue(), "")
+        request.clear()
+
+        request.requestHeaders.setRawHeaders("If-None-Match", ['"other"'])
+        yield service.render_GET(request)  #Client has another version: full response.
+        self.assertEqual(request.code, 200)
+        self.assertEqual(request.stream.getvalue(), "sync_render_get_result")
+        request.clear()
+
+        request.requestHeaders.removeHeader("If-None-Match")
+        request.requestHeaders.setRawHeaders("If-Modified-Since", [last_modified])
+        yield service.render_GET(request)
+        self.assertEqual(request.code, 304)
+        self.assertEqual(request.stream.getvalue(), "")
+
+        self.assertEqual(service.call_count, 1)
+
+    @defer.inlineCallbacks
+    def test_render_get_compressed(self):
+        service = CompressedSyncService()
+        value = "compressible " * 100
+        request = MockRequest("", "/ibd3/test_compressed/")
+
+        yield service.render_GET(request)  #First call of initial function
+        request.clear()
+
+        request.requestHeaders.setRawHeaders("Accept-Encoding", ["deflate;q=0.5, gzip"])
+        yield service.render_GET(request)  #Get compressed variant from cache.
+        self.assertEqual(request.responseHeaders.getRawHeaders("Content-Encoding"), ["gzip"])
+        self.assertEqual(request.responseHeaders.getRawHeaders("Vary"), ["Accept-Encoding"])
+        self.assertEqual(zlib.decompress(request.stream.getvalue(), 16 + zlib.MAX_WBITS), value)
+        request.clear()
+
+        request.requestHeaders.setRawHeaders("Accept-Encoding", ["gzip;q=0, identity"])
+        yield service.render_GET(request)  #Client doesn't accept gzip: identity body.
+        self.assertEqual(request.responseHeaders.getRawHeaders("Content-Encoding"), None)
+        self.assertEqual(request.stream.getvalue(), value)
+
+        self.assertEqual(service.call_count, 1)
+        self.assertRaises(ValueError, cache.cache_sync_render_GET, encodings=("lzma",))
+
+    @defer.inlineCallbacks
+    def test_render_get_vary(self):
+        service = LocalizedSyncService()
+        requests = []
+        for utoken, language in [("user1", "en"), ("user1", "fr"), ("user2", "en"), ("user1", "en")]:
+            request = MockRequest(utoken, "/ibd3/test_localized/")
+            request.requestHeaders.setRawHeaders("Accept-Language", [language])
+            yield service.render_GET(request)
+            requests.append(request)
+
+        self.assertEqual([request.stream.getvalue() for request in requests],
+                         ["en:user1", "fr:user1", "en:user2", "en:user1"])
+        self.assertEqual(service.call_count, 3)  #The last request is read from cache
+        self.assertEqual(requests[-1].responseHeaders.getRawHeaders("Vary"), ["Accept-Language, Cookie"])
+
+    @defer.inlineCallbacks
+    def test_render_get_vary_missing_header(self):
+        service = LocalizedSyncService()
+        for language in [None, "None", None]:
+            request = MockRequest("user1", "/ibd3/test_localized/")
+            if language is not None:
+                request.requestHeaders.setRawHeaders("Accept-Language", [language])
+            yield service.render_GET(request)
+
+        self.assertEqual(service.call_count, 2)  #Missing header doesn't share the key with "None"
+        self.assertEqual(len(set(self.cache_server.data)), 2)
+
+    def test_render_get_vary_unicode(self):
+        create_key = cache._key_builder(vary_session=("utoken",))
+        key = create_key(MockRequest(u"J\xfcrgen", "/ibd3/test_localized/"))
+        self.assertEqual(key, "/ibd3/test_localized/#J%C3%BCrgen")
+        self.assertNotEqual(create_key(MockRequest(None, "/ibd3/test_localized/")),
+                            create_key(MockRequest("None", "/ibd3/test_localized/")))
+
+    @defer.inlineCallbacks
+    def test_sync_render_get_error_not_cached(self):
+        service = FailingSyncService()
+        for _ in xrange(2):
+            request = MockRequest("", "/ibd3/test_failing/")
+            yield service.render_GET(request)
+            self.assertEqual((request.code, request.stream.getvalue()), (500, "oops"))
+        self.assertEqual(service.call_count, 2)
+        self.assertEqual(len(self.cache_server.data), 0)
+        self.assertEqual(self.cache_server.connected, False)
+
+    @defer.inlineCallbacks
+    def test_render_get_head_and_range(self):
+        service = SyncService()
+        value = "sync_render_get_result"
+        request = MockRequest("", "/ibd3/test_uri/?arg=1")
+        yield service.render_GET(request)  #First call of initial function
+
+        request = MockRequest("", "/ibd3/test_uri/?arg=1")
+        request.method = "HEAD"
+        yield service.render_GET(request)
+        self.assertEqual(request.stream.getvalue(), "")
+        self.assertEqual(request.responseHeaders.getRawHeaders("Content-Length"), [str(len(value))])
+
+        for range_header, code, content_range, body in [
+            ("bytes=5-10", 206, "bytes 5-10/22", value[5:11]),
+            ("bytes=-6", 206, "bytes 16-21/22", value[-6:]),
+            ("bytes=16-", 206, "bytes 16-21/22", value[16:]),
+            ("bytes=16-100", 206, "bytes 16-21/22", value[16:]),
+            ("bytes=22-", 416, "bytes */22", ""),
+            ("bytes=1-2,5-6", 200, None, value),
+            ("lines=1-2", 200, None, value),
+        ]:
+            request = MockRequest("", "/ibd3/test_uri/?arg=1")
+            request.requestHeaders.setRawHeaders("Range", [range_header])
+            yield service.render_GET(request)
+            self.assertEqual(request.code, code)
+            self.assertEqual(request.responseHeaders.getRawHeaders("Content-Range", [None])[0], content_range)
+            self.assertEqual(request.stream.getvalue(), body)
+
+        request = MockRequest("", "/ibd3/test_uri/?arg=1")
+        request.requestHeaders.setRawHeaders("Range", ["bytes=5-10"])
+        request.requestHeaders.setRawHeaders("If-Range", ['"old-etag"'])
+        yield service.render_GET(request)  #Client has another version: full response.
+        self.assertEqual(request.code, 200)
+        self.assertEqual(request.stream.getvalue(), value)
+
+        self.assertEqual(service.call_count, 1)
+
+    @defer.inlineCallbacks
+    def test_render_get_ttl_from_headers(self):
+        service = FreshnessSyncService()
+        for cache_control, expire_time in [
+            ("public, max-age=300", 300),
+            ("max-age=300, s-maxage=30", 30),
+            (None, 60),
+            ("no-store", None),
+            ("private, max-age=300", None),
+            ("max-age=0", None),
+        ]:
+            uri = "/ibd3/test_fresh/?cache_control=%s" % cache_control
+            request = MockRequest("", uri)
+            if cache_control:
+                request.args = {"cache_control": [cache_control]}
+            yield service.render_GET(request)
+            self.assertEqual(self.cache_server.expire_times.get(uri), expire_time)
+
+        self.assertEqual(service.call_count, 6)
+
+    @defer.inlineCallbacks
+    def test_render_get_stale_value(self):
+        service = SyncService()
+        request = MockRequest("", "/ibd3/test_uri/?arg=1")
+        self.cache_server.data["/ibd3/test_uri/?arg=1"] = "raw value cached by an older version"
+
+        yield service.render_GET(request)  #Value can't be read, so the initial function is called and overwrites it.
+        self.assertEqual(request.stream.getvalue(), "sync_render_get_result")
+        request.clear()
+
+        yield service.render_GET(request)
+        self.assertEqual(request.stream.getvalue(), "sync_render_get_result")
+        self.assertEqual(service.call_count, 1)
+
+    @defer.inlineCallbacks
+    def test_async_render_get_max_cached_size(self):
+        service = AsyncChunkedService()
+        for chunks, call_count in [(3, 1), (3, 1), (4, 2), (4, 3)]:
+            request = MockRequest("", "/ibd3/test_chunked/?chunks=%d" % chunks)
+            request.args = {"chunks": [str(chunks)]}
+            yield service.render_GET(request)
+            self.assertEqual(request.stream.getvalue(), "0123456789" * 3 * chunks)
+            self.assertEqual(service.call_count, call_count)  #4 chunks exceed max_cached_size and are not cached
+        self.assertEqual(self.cache_server.connected, False)
+
     @defer.inlineCallbacks
     def test_async_render_get_fail(self):
         service = AsyncFailingService()
@@ -359,6 +1033,341 @@ class TestCache(unittest.TestCase):
         yield func(request2)
         self.assertEqual(keyregistry.key(func, kwargs=request2.args), "/ibd3/test_uri2/?arg=2")
 
+        func = LocalizedSyncService().render_GET
+        for utoken in ("user1", "user2", "user1"):
+            yield func(MockRequest(utoken, "/ibd3/test_localized/"))
+        self.assertEqual(keyregistry.keys(func), ["/ibd3/test_localized/#~&user1", "/ibd3/test_localized/#~&user2"])
+        self.assertEqual(keyregistry.key(func), "/ibd3/test_localized/#~&user1")
+
+    def test_canonical_uri(self):
+        canonical_uri = cache._canonical_uri
+        self.assertEqual(canonical_uri("/service/?c=3&a=1&b=2", frozenset(["a"])), "/service/?b=2&c=3")
+        self.assertEqual(canonical_uri("/service/?a_dc=1&_dc=2", frozenset(["_dc"])), "/service/?a_dc=1")
+        self.assertEqual(canonical_uri("/service/?_dc=2", frozenset(["_dc"])), "/service/")
+        self.assertEqual(canonical_uri("/service/?b=2&a=3&b=1"), "/service/?a=3&b=2&b=1")
+        self.assertEqual(canonical_uri("/service/"), "/service/")
+
+    @defer.inlineCallbacks
+    def test_render_get_redundant_args(self):
+        func = cache.cache_sync_render_GET(class_name="SyncService", exclude_self=True, redundant_args=("_dc",))(
+            SyncService.render_GET.init_func)
+        service = SyncService()
+
+        request = MockRequest("", "/ibd3/test_uri/?b=2&_dc=123&a=1")
+        request.args = {"a": ["1"], "b": ["2"], "_dc": ["123"]}
+        yield func(service, request)
+        self.assertEqual(request.args, {"a": ["1"], "b": ["2"], "_dc": ["123"]})  #Request arguments are not changed
+
+        request = MockRequest("", "/ibd3/test_uri/?a=1&b=2")  #Same arguments in another order, without _dc
+        yield func(service, request)
+        self.assertEqual(request.stream.getvalue(), "sync_render_get_result")
+        self.assertEqual(service.call_count, 1)
+
+
+class SlowClientRequest(MockRequest):
+    """Request whose transport buffer is full after every write."""
+
+    def __init__(self, *args, **kwargs):
+        MockRequest.__init__(self, *args, **kwargs)
+        self.writes = []
+
+    def write(self, data):
+        MockRequest.write(self, data)
+        self.writes.append(len(data))
+        self.producer.pauseProducing()
+
+
+class TestBodyProducer(unittest.TestCase):
+    def test_stream_large_body(self):
+        body = "x" * (response.STREAMED_SIZE * 2 + 10)
+        request = SlowClientRequest("")
+        response.write_body(request, body)
+
+        self.assertEqual(request.writes, [response.STREAMED_SIZE])
+        producer = request.producer
+        while request.producer is not None:
+            producer.resumeProducing()
+
+        self.assertEqual(request.writes, [response.STREAMED_SIZE, response.STREAMED_SIZE, 10])
+        self.assertEqual(request.stream.getvalue(), body)
+        self.assertEqual(request.responseHeaders.getRawHeaders("Content-Length"), [str(len(body))])
+        self.assertTrue(request.finished)
+
+    def test_stop_producing(self):
+        request = SlowClientRequest("")
+        response.write_body(request, "x" * (response.STREAMED_SIZE * 2))
+        request.producer.stopProducing()
+        request.producer.resumeProducing()
+
+        self.assertEqual(request.writes, [response.STREAMED_SIZE])
+        self.assertFalse(request.finished)
+
+    def test_write_small_body(self):
+        request = MockRequest("")
+        response.write_body(request, "small body")
+        self.assertEqual(request.stream.getvalue(), "small body")
+        self.assertEqual(request.producer, None)
+        self.assertTrue(request.finished)
+
+
+class MockClientCreator:
+    calls = []
+    created = []
+
+    def __init__(self, reactor, protocolClass, **kwargs):
+        self.protocolClass = protocolClass
+        self.kwargs = kwargs
+        self.created.append(self)
+
+    def connectTCP(self, host, port):
+        self.calls.append(("tcp", host, port))
+        return defer.succeed(self.protocolClass(**self.kwargs))
+
+    def connectUNIX(self, address):
+        self.calls.append(("unix", address))
+        return defer.succeed(self.protocolClass(**self.kwargs))
+
+
+class TestConnect(unittest.TestCase):
+    def setUp(self):
+        self._config = cache.config
+        MockClientCreator.calls = []
+        MockClientCreator.created = []
+        self.patch(cache.protocol, "ClientCreator", MockClientCreator)
+
+    def tearDown(self):
+        cache.config = self._config
+        cache.default_client.connections.clear()
+
+    def test_connect_tcp(self):
+        cache.load_config(**{"disable": False, "ip": "10.0.0.1", "port": 11212})
+        cache.connect()
+        self.assertEqual(MockClientCreator.calls, [("tcp", "10.0.0.1", 11212)])
+
+    def test_connect_unix(self):
+        cache.load_config(**{"disable": False, "unix_socket": "/var/run/memcached.sock"})
+        cache.connect()
+        self.assertEqual(MockClientCreator.calls, [("unix", "/var/run/memcached.sock")])
+
+    def test_client(self):
+        registry = metrics.Registry()
+        client = cache.CacheClient(ip="10.0.0.2", port=11213, registry=registry)
+        self.assertFalse(client.config.disable)
+        client.connect()
+        self.assertEqual(MockClientCreator.calls, [("tcp", "10.0.0.2", 11213)])
+        self.assertEqual(MockClientCreator.created[0].kwargs, {"registry": registry})
+
+    def test_reconfigure_drains_connections(self):
+        client = cache.CacheClient(ip="10.0.0.2")
+        client.clock = task.Clock()
+        protos = [self.successResultOf(client.connect()) for _ in xrange(2)]
+        for proto in protos:
+            proto.makeConnection(proto_helpers.StringTransport())
+        self.assertEqual(len(client.connections), 2)
+
+        d = client.reconfigure(timeout=5, ip="10.0.0.3")
+        self.assertEqual(client.config.ip, "10.0.0.3")
+        client.connect()
+        self.assertEqual(MockClientCreator.calls[-1], ("tcp", "10.0.0.3", 11211))
+
+        protos[0].connectionLost(None)
+        self.assertNoResult(d)
+        client.clock.advance(5)
+        self.assertTrue(protos[1].transport.disconnecting)
+        protos[1].connectionLost(None)
+        self.successResultOf(d)
+        self.assertEqual(len(client.connections), 1)
+
+    def test_reconfigure_drains_after_errors(self):
+        client = cache.CacheClient(ip="10.0.0.2")
+        connect = client.connect
+        client.connect = lambda: connect().addCallback(lambda proto: proto.makeConnection(proto_helpers.StringTransport()) or proto)
+        failing = Mock(side_effect=ValueError("failed"))
+        failing.__name__ = "failing"
+        func = cache.cache(lazy_key=cache.default_lazy_key, client=client)(failing)
+
+        d = func(1)
+        proto, = client.connections
+        proto.dataReceived("END\r\n")
+        self.failureResultOf(d, ValueError)
+        d = func(2)
+        other_proto, = [other for other in client.connections if other is not proto]
+        other_proto.dataReceived("SERVER_ERROR out of memory\r\n")
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(failing.call_count, 2)
+
+        drained = client.reconfigure(timeout=None)
+        for closed in (proto, other_proto):
+            self.assertTrue(closed.transport.disconnecting)
+            closed.connectionLost(None)
+        self.successResultOf(drained)
+        self.assertEqual(len(client.connections), 0)
+
+
+class RecordingHook:
+    def __init__(self):
+        self.started = []
+        self.finished = []
+
+    def start(self, operation):
+        self.started.append(operation)
+
+    def finish(self, operation):
+        self.finished.append(operation)
+
+
+class MockSpan:
+    def __init__(self, operation_name, tags, start_time):
+        self.operation_name = operation_name
+        self.tags = dict(tags)
+        self.start_time = start_time
+        self.finish_time = None
+
+    def set_tag(self, key, value):
+        self.tags[key] = value
+
+    def finish(self, finish_time=None):
+        self.finish_time = finish_time
+
+
+class MockTracer:
+    def __init__(self):
+        self.spans = []
+
+    def start_span(self, operation_name, tags=None, start_time=None):
+        span = MockSpan(operation_name, tags, start_time)
+        self.spans.append(span)
+        return span
+
+
+class TestCacheProtocol(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.hook = RecordingHook()
+        tracing.add_hook(self.hook)
+        self.addCleanup(tracing.remove_hook, self.hook)
+
+        self.proto = CacheProtocol()
+        self.proto.metrics = self.registry
+        self.transport = proto_helpers.StringTransport(peerAddress=IPv4Address("TCP", "10.0.0.1", 11211))
+        self.proto.makeConnection(self.transport)
+
+    def test_commands(self):
+        tracer = MockTracer()
+        adapter = tracing.SpanAdapter(tracer)
+        tracing.add_hook(adapter)
+        self.addCleanup(tracing.remove_hook, adapter)
+
+        self.proto.get("key1")
+        self.proto.dataReceived("VALUE key1 0 5\r\nhello\r\nEND\r\n")
+        self.proto.add("key2", "value")
+        self.proto.dataReceived("NOT_STORED\r\n")
+
+        self.assertEqual([(operation.name, operation.key, operation.server, operation.outcome, operation.sent,
+                           operation.received) for operation in self.hook.finished],
+                         [("get", "key1", "10.0.0.1:11211", "hit", 0, 5),
+                          ("add", "key2", "10.0.0.1:11211", "rejected", 5, 0)])
+        self.assertEqual(self.registry.snapshot()["operations"]["get"]["latency"]["count"], 1)
+        self.assertEqual(self.registry.snapshot()["connections"], {"open": 1, "total": 1})
+
+        self.assertEqual([span.operation_name for span in tracer.spans], ["memcached.get", "memcached.add"])
+        self.assertEqual(tracer.spans[1].tags["txcaching.outcome"], "rejected")
+        self.assertEqual(tracer.spans[1].tags["peer.address"], "10.0.0.1:11211")
+        self.assertTrue(tracer.spans[0].finish_time >= tracer.spans[0].start_time)
+
+    def test_stats_outcome(self):
+        d = self.proto.stats()
+        self.proto.dataReceived("STAT pid 12\r\nSTAT empty \r\nEND\r\n")
+        self.assertEqual(self.successResultOf(d), {"pid": "12", "empty": ""})
+        self.assertEqual([(operation.name, operation.outcome, operation.received) for operation in self.hook.finished],
+                         [("stats", "ok", 0)])
+
+    def test_error(self):
+        d = self.proto.set("key1", "value")
+        self.proto.dataReceived("SERVER_ERROR out of memory\r\n")
+        self.assertFailure(d, Exception)
+
+        self.assertEqual(self.hook.finished[0].outcome, "error")
+        self.assertEqual(self.registry.snapshot()["operations"]["set"]["errors"], 1)
+        return d
+
+    def test_slow_operation_logger(self):
+        messages = []
+        log.addObserver(messages.append)
+        self.addCleanup(log.removeObserver, messages.append)
+        logger = tracing.SlowOperationLogger(threshold=0)
+        tracing.add_hook(logger)
+        self.addCleanup(tracing.remove_hook, logger)
+
+        self.proto.delete("key1")
+        self.proto.dataReceived("NOT_FOUND\r\n")
+
+        self.assertEqual(len(messages), 1)
+        self.assertIn("slow delete of 'key1'", messages[0]["message"][0])
+
+
+class MockStatsServer:
+    def __init__(self, server, raw):
+        self.server = server
+        self.raw = raw
+        self.connected = True
+        self.transport = MockTransport(self)
+
+    def stats(self, arg=None):
+        return defer.succeed(self.raw[arg])
+
+
+def raw_stats(get_hits, get_misses, evictions):
+    return {
+        None: {"uptime": "100", "get_hits": str(get_hits), "get_misses": str(get_misses),
+               "evictions": str(evictions), "bytes": "512", "limit_maxbytes": "1024", "cmd_get": str(get_hits + get_misses),
+               "curr_items": "10", "version": "1.6.9", "rusage_user": "0.5"},
+        "slabs": {"1:chunk_size": "96", "1:total_chunks": "100", "1:used_chunks": "50", "1:mem_requested": "2400",
+                  "active_slabs": "1", "total_malloced": "1048576"},
+        "items": {"items:1:number": "50", "items:1:evicted": "20"},
+        "settings": {"growth_factor": "1.25", "evictions": "on", "maxbytes": "1024"},
+    }
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self._connect = cache.connect
+
+    def tearDown(self):
+        cache.connect = self._connect
+
+    @defer.inlineCallbacks
+    def test_collect(self):
+        server = MockStatsServer("10.0.0.1:11211", raw_stats(30, 10, 50))
+        cache.connect = lambda: defer.succeed(server)
+
+        collected = yield stats.collect()
+        server_stats = collected[0]
+        self.assertEqual(server_stats.general["get_hits"], 30)
+        self.assertEqual(server_stats.general["version"], "1.6.9")
+        self.assertEqual(server_stats.general["rusage_user"], 0.5)
+        self.assertEqual(server_stats.slabs, {1: {"chunk_size": 96, "total_chunks": 100, "used_chunks": 50,
+                                                  "mem_requested": 2400}})
+        self.assertEqual(server_stats.slab_totals["active_slabs"], 1)
+        self.assertEqual(server_stats.items, {1: {"number": 50, "evicted": 20}})
+        self.assertEqual(server_stats.settings, {"growth_factor": 1.25, "evictions": True, "maxbytes": 1024})
+        self.assertFalse(server.connected)
+
+    def test_summary(self):
+        first = MockStatsServer("first", raw_stats(30, 10, 50))
+        second = MockStatsServer("second", raw_stats(10, 10, 0))
+        collected = [stats.query(first).result, stats.query(second).result]
+
+        result = stats.summary(collected)
+        self.assertEqual(result["servers"]["first"]["hit_ratio"], 0.75)
+        self.assertEqual(result["servers"]["first"]["eviction_rate"], 0.5)
+        self.assertEqual(result["servers"]["first"]["memory_fill"], 0.5)
+        self.assertEqual(result["servers"]["first"]["slabs"][1], {"chunk_size": 96, "fill": 0.5, "efficiency": 0.5,
+                                                                   "evicted": 20, "evicted_rate": 0.2})
+        self.assertEqual(result["skew"]["cmd_get"], 40 / 30.0)
+        self.assertEqual(result["skew"]["evictions"], 2.0)
+        self.assertEqual(result["skew"]["bytes"], 1.0)
+
 
 skipped = [
     #"test_cache_blocking_func_without_args",
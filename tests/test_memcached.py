@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+from twisted.internet import defer, task
+from twisted.protocols.memcache import MemCacheProtocol
+from twisted.test import iosim
+from twisted.trial import unittest
+
+from txcaching import cache, memcached
+
+
+class TestMemcachedServer(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000000)
+        self.factory = memcached.MemcachedFactory(max_bytes=1000, item_size_max=500, clock=self.clock)
+        self.connect()
+
+    def connect(self):
+        clock = self.clock
+
+        def client():
+            proto = MemCacheProtocol()
+            proto.callLater = clock.callLater
+            return proto
+
+        self.client, self.server, self.pump = iosim.connectedServerAndClient(
+            lambda: self.factory.buildProtocol(None), client)
+
+    def call(self, d):
+        """Deliver the command and the reply, and return the result of the command."""
+
+        self.pump.flush()
+        results = []
+        d.addBoth(results.append)
+        self.assertEqual(len(results), 1)
+        return results[0]
+
+    def test_storage_commands(self):
+        self.assertTrue(self.call(self.client.set("key1", "value1", flags=3)))
+        self.assertEqual(self.call(self.client.get("key1")), (3, "value1"))
+        self.assertFalse(self.call(self.client.add("key1", "other")))
+        self.assertFalse(self.call(self.client.replace("key2", "other")))
+        self.assertTrue(self.call(self.client.append("key1", "+")))
+        self.assertTrue(self.call(self.client.prepend("key1", "-")))
+        self.assertEqual(self.call(self.client.get("key1")), (3, "-value1+"))
+        self.assertTrue(self.call(self.client.delete("key1")))
+        self.assertFalse(self.call(self.client.delete("key1")))
+        self.assertEqual(self.call(self.client.getMultiple(["key1", "key2"])), {"key1": (0, None), "key2": (0, None)})
+
+    def test_cas(self):
+        self.call(self.client.set("key1", "value1"))
+        flags, cas, value = self.call(self.client.get("key1", withIdentifier=True))
+        self.call(self.client.set("key1", "value2"))
+        self.assertFalse(self.call(self.client.checkAndSet("key1", "value3", cas)))
+
+        flags, cas, value = self.call(self.client.get("key1", withIdentifier=True))
+        self.assertTrue(self.call(self.client.checkAndSet("key1", "value3", cas)))
+        self.assertEqual(self.call(self.client.get("key1")), (0, "value3"))
+
+    def test_increment(self):
+        self.call(self.client.set("counter", "5"))
+        self.assertEqual(self.call(self.client.increment("counter", 3)), 8)
+        self.assertEqual(self.call(self.client.decrement("counter", 10)), 0)
+        self.call(self.client.set("text", "abc"))
+        self.call(self.client.increment("text")).trap(Exception)
+
+    def test_expiry(self):
+        self.call(self.client.set("short", "value", expireTime=10))
+        self.call(self.client.set("absolute", "value", expireTime=int(self.clock.seconds()) + 40 * 24 * 3600))
+        self.clock.advance(11)
+        self.assertEqual(self.call(self.client.get("short")), (0, None))
+        self.assertEqual(self.call(self.client.get("absolute")), (0, "value"))
+
+    def test_flush_all_with_delay(self):
+        self.call(self.client.set("key1", "value1"))
+        self.factory.storage.flush_all(5)
+        self.assertEqual(self.call(self.client.get("key1")), (0, "value1"))
+        self.clock.advance(5)
+        self.assertEqual(self.call(self.client.get("key1")), (0, None))
+
+    def test_lru_eviction(self):
+        for index in xrange(4):
+            self.call(self.client.set("key%d" % index, "x" * 200))
+            self.call(self.client.get("key0"))
+
+        self.assertEqual(self.call(self.client.get("key1")), (0, None))
+        self.assertEqual(self.call(self.client.get("key0")), (0, "x" * 200))
+        self.assertEqual(self.factory.storage.stats()["evictions"], 1)
+        self.assertTrue(self.factory.storage.bytes <= 1000)
+
+    def test_too_large(self):
+        self.call(self.client.set("large", "x" * 600)).trap(Exception)
+        self.assertEqual(self.call(self.client.get("large")), (0, None))
+
+    def test_latency(self):
+        self.factory.latency = 0.5
+        d = self.client.get("key1")
+        self.pump.flush()
+        self.assertNoResult(d)
+
+        self.clock.advance(0.5)
+        self.pump.flush()
+        self.assertEqual(self.successResultOf(d), (0, None))
+
+    def test_injected_failures(self):
+        self.factory.fail(1)
+        self.call(self.client.set("key1", "value1")).trap(Exception)
+        self.assertTrue(self.call(self.client.set("key1", "value1")))
+
+        self.factory.fail(1, mode="hang")
+        d = self.client.get("key1")
+        self.pump.flush()
+        self.assertNoResult(d)
+        self.clock.advance(self.client.persistentTimeOut)
+        self.failureResultOf(d)
+
+    def test_stats(self):
+        self.call(self.client.set("key1", "value1"))
+        self.call(self.client.get("key1"))
+        self.call(self.client.get("key2"))
+        stats = self.call(self.client.stats())
+        self.assertEqual((stats["get_hits"], stats["get_misses"], stats["curr_items"]), ("1", "1", "1"))
+
+
+class TestCacheWithServer(unittest.TestCase):
+    """The module-level functions of :mod:`txcaching.cache` against the server over TCP."""
+
+    def setUp(self):
+        self.port, self.factory = memcached.listen()
+        self._config = cache.config
+        cache.load_config(disable=False, port=self.port.getHost().port, chunk_size=300)
+
+    def tearDown(self):
+        cache.config = self._config
+        return self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def test_round_trip(self):
+        yield cache.set("key1", {"a": 1})
+        result = yield cache.get("key1")
+        self.assertEqual(result, (0, {"a": 1}))
+
+        added = yield cache.add("key1", "other")
+        self.assertFalse(added)
+
+        yield cache.set("large", "x" * 1000)
+        result = yield cache.get("large")
+        self.assertEqual(result, (0, "x" * 1000))
+        self.assertTrue(len(self.factory.storage.items) > 2)
+
+    @defer.inlineCallbacks
+    def test_counters(self):
+        proto = yield cache.connect()
+        yield proto.set("counter", "5")
+        proto.transport.loseConnection()
+
+        result = yield cache.increment("counter", 3)
+        self.assertEqual(result, 8)
+        result = yield cache.decrement("counter")
+        self.assertEqual(result, 7)
@@ -3,6 +3,7 @@
 from StringIO import StringIO
 
 from twisted.internet.defer import Deferred
+from twisted.web.http_headers import Headers
 
 
 class MockSession(object):
@@ -14,15 +15,28 @@ class MockRequest(object):
     def __init__(self, utoken, uri=None):
         self._utoken = utoken
         self.uri = uri
+        self.method = "GET"
         self._finishedDeferreds = []
         self.stream = StringIO()
         self.args = {}
+        self.code = 200
+        self.requestHeaders = Headers()
+        self.responseHeaders = Headers()
+        self.received_cookies = {}
+        self.producer = None
+        self.finished = False
 
     def getSession(self):
         return MockSession(self._utoken)
 
     def finish(self):
-        pass
+        self.finished = True
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
 
     def write(self, data):
         self.stream.write(data)
@@ -30,13 +44,27 @@ class MockRequest(object):
     def clear(self):
         self.stream.close()
         self.stream = StringIO()
+        self.code = 200
+        self.responseHeaders = Headers()
+        self.finished = False
+
+    def getHeader(self, name):
+        values = self.requestHeaders.getRawHeaders(name)
+        if values:
+            return values[-1]
+
+    def getCookie(self, name):
+        return self.received_cookies.get(name)
+
+    def setHeader(self, name, value):
+        self.responseHeaders.setRawHeaders(name, [value])
 
     def notifyFinish(self):
         finished = Deferred()
         self._finishedDeferreds.append(finished)
         return finished
 
-    def setResponseCode(self, code, error):
+    def setResponseCode(self, code, error=None):
         self.code = code
         self.error = error
 
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""Compact binary trace of decorator lookups, to replay them in :mod:`txcaching.simulator`.
+
+A trace starts with :const:`MAGIC`, followed by records. Every record starts with its kind (one byte).
+Lookup and compute records hold the time, the hash of the key, the hash of the function id, the size of the value
+and the compute cost, in :const:`RECORD` format (29 bytes). Function records map a function hash
+to its :func:`txcaching.keyregistry.func_id` and are written once, before its first lookup.
+"""
+
+from collections import namedtuple
+import hashlib
+import struct
+import zlib
+
+from . import tracing
+
+MAGIC = "TXCTRACE\x01"
+
+MISS, HIT, ERROR, COMPUTE, FUNCTION = range(5)
+
+_OUTCOMES = {"miss": MISS, "hit": HIT, "error": ERROR}
+
+#kind, timestamp, key hash, function hash, size in bytes, compute cost in seconds
+RECORD = struct.Struct("<BdQIIf")
+
+#kind, function hash, length of function id
+FUNCTION_RECORD = struct.Struct("<BIH")
+
+#Event of the trace: kind is one of MISS, HIT, ERROR and COMPUTE, function is the function id.
+Event = namedtuple("Event", ["kind", "timestamp", "key", "function", "size", "cost"])
+
+
+def key_hash(key):
+    """64-bit hash of the cache key. Keys themselves are not recorded: they may be long or contain user data."""
+
+    return struct.unpack("<Q", hashlib.md5(key).digest()[:8])[0]
+
+
+def _function_hash(func_id):
+    return zlib.crc32(func_id) & 0xffffffff
+
+
+class Recorder(object):
+    """Tracing hook (see :func:`txcaching.tracing.add_hook`) which writes lookups and calls of cached functions
+    on misses to the trace. Writes are buffered by the file object.
+
+    :param output: Path or file opened for binary writing
+    :param sample: Share of keys to record. Keys are sampled by their hash, so all the events of a sampled key
+        are recorded and the simulated hit ratio is not skewed.
+    """
+
+    def __init__(self, output, sample=1.0):
+        self.own_file = isinstance(output, basestring)
+        self.file = open(output, "wb") if self.own_file else output
+        self.file.write(MAGIC)
+        self.threshold = int(sample * 2 ** 64)
+        self.functions = set()
+
+    def start(self, operation):
+        pass
+
+    def finish(self, operation):
+        if operation.function is None or operation.name not in ("lookup", "recompute"):
+            return
+        key = key_hash(operation.key)
+        if key >= self.threshold:
+            return
+
+        function = _function_hash(operation.function)
+        if function not in self.functions:
+            self.functions.add(function)
+            self.file.write(FUNCTION_RECORD.pack(FUNCTION, function, len(operation.function)) + operation.function)
+
+        if operation.name == "lookup":
+            kind, size, cost = _OUTCOMES.get(operation.outcome, ERROR), operation.received, 0.0
+        else:
+            kind, size, cost = COMPUTE, operation.sent, operation.duration
+        self.file.write(RECORD.pack(kind, operation.started, key, function, size, cost))
+
+    def close(self):
+        """Stop recording and close the trace. A file passed by the caller is flushed, but left open."""
+
+        if self in tracing.hooks:
+            tracing.remove_hook(self)
+        if self.own_file:
+            self.file.close()
+        else:
+            self.file.flush()
+
+
+def record(output, sample=1.0):
+    """Start recording the trace of all decorators.
+
+    :returns: :class:`Recorder`; call its close method to stop
+    """
+
+    recorder = Recorder(output, sample)
+    tracing.add_hook(recorder)
+    return recorder
+
+
+def read(source):
+    """Read the trace.
+
+    :param source: Path or file opened for binary reading
+
+    :returns: iterator of :class:`Event`
+    """
+
+    trace = open(source, "rb") if isinstance(source, basestring) else source
+    if trace.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a txcaching trace")
+
+    functions = {}
+    while True:
+        kind = trace.read(1)
+        if not kind:
+            break
+        if ord(kind) == FUNCTION:
+            _, function, length = FUNCTION_RECORD.unpack(kind + trace.read(FUNCTION_RECORD.size - 1))
+            functions[function] = trace.read(length)
+            continue
+        data = kind + trace.read(RECORD.size - 1)
+        if len(data) < RECORD.size:
+            #The trace has been cut while it was written.
+            break
+        kind, timestamp, key, function, size, cost = RECORD.unpack(data)
+        yield Event(kind, timestamp, key, functions.get(function), size, cost)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Adaptive bypass of the cache for functions which are cheaper to call than to look up.
+
+The decorator keeps rolling averages of the lookup latency, the hit ratio and the time the function takes.
+Caching pays off while the lookup costs less than the computation it saves on hits. When it doesn't,
+a growing share of calls skips memcached and calls the function directly. The rest of the calls still look up
+the cache, so the averages stay fresh and the bypass is withdrawn when memcached gets fast again.
+"""
+
+import random
+
+
+class AdaptiveBypass(object):
+    """Bypass decisions of one cached function.
+
+    :param alpha: Weight of the newest sample in the rolling averages.
+    :param step: Change of the bypassed share of calls at each reevaluation.
+    :param max_ratio: Maximal bypassed share of calls. The others probe the cache.
+    :param interval: The bypassed share is reevaluated after this number of lookups.
+    :param margin: Caching is considered a loss when the lookup costs more than (1 + margin) times
+        the computation it saves. It keeps the decision from flapping when both are close.
+    """
+
+    def __init__(self, alpha=0.1, step=0.1, max_ratio=0.9, interval=50, margin=0.2):
+        self.alpha = alpha
+        self.step = step
+        self.max_ratio = max_ratio
+        self.interval = interval
+        self.margin = margin
+        self.ratio = 0.0
+        self.lookup_latency = None
+        self.compute_latency = None
+        self.hit_ratio = None
+        self.lookups = 0
+        self.random = random.random
+
+    def _average(self, average, sample):
+        return sample if average is None else average + self.alpha * (sample - average)
+
+    def bypass(self):
+        """Decide if the call should skip the cache."""
+
+        return self.ratio > 0 and self.random() < self.ratio
+
+    def lookup(self, duration, hit):
+        """Take the lookup into account. Failed lookups are misses: they only add latency."""
+
+        self.lookup_latency = self._average(self.lookup_latency, duration)
+        self.hit_ratio = self._average(self.hit_ratio, 1.0 if hit else 0.0)
+        self.lookups += 1
+        if self.lookups % self.interval == 0:
+            self._reevaluate()
+
+    def compute(self, duration):
+        """Take the call of the function into account."""
+
+        self.compute_latency = self._average(self.compute_latency, duration)
+
+    def pays_off(self):
+        """Compare the lookup latency with the computation time saved by hits. True until both are known."""
+
+        if self.lookup_latency is None or self.compute_latency is None:
+            return True
+        return self.lookup_latency <= (1 + self.margin) * self.hit_ratio * self.compute_latency
+
+    def _reevaluate(self):
+        #Rounded, so that repeated steps return exactly to 0.
+        if self.pays_off():
+            self.ratio = round(max(0.0, self.ratio - self.step), 6)
+        else:
+            self.ratio = round(min(self.max_ratio, self.ratio + self.step), 6)
@@ -2,25 +2,36 @@
 
 from collections import namedtuple
 import cPickle as pickle
-import re
-from StringIO import StringIO
+import urllib
 
 from twisted.internet import reactor, protocol
 from twisted.internet import defer
 from twisted.internet.defer import maybeDeferred
-from twisted.protocols.memcache import MemCacheProtocol, DEFAULT_PORT
+from twisted.protocols.memcache import DEFAULT_PORT
 from twisted.web import server
 
-from . import keyregistry
+from . import adaptive, chunking, hotkeys, keyregistry, metrics, response, serialization, tracing, workers
+from .connection import CacheProtocol
 
-ConfigSchema = namedtuple("Config", ["disable", "ip", "port"])
-default_config = ConfigSchema(**{"disable": True, "ip": "127.0.0.1", "port": DEFAULT_PORT})
+ConfigSchema = namedtuple("Config", ["disable", "ip", "port", "unix_socket", "chunk_size"])
+ConfigSchema.__new__.__defaults__ = ("127.0.0.1", DEFAULT_PORT, None, chunking.DEFAULT_CHUNK_SIZE)
+default_config = ConfigSchema(**{"disable": True, "ip": "127.0.0.1", "port": DEFAULT_PORT, "unix_socket": None,
+                                 "chunk_size": chunking.DEFAULT_CHUNK_SIZE})
 config = default_config
 
 
 def load_config(**kwargs):
     """Load configuration. Must be called before use of other method of this module.
     By default, caching is disabled.
+
+    :param disable: If it is true, the decorated functions are called without cache.
+    :param ip: IP-address of memcached server.
+    :param port: Port of memcached server.
+    :param unix_socket: Path to the Unix domain socket of memcached server. If it is set, ip and port are ignored.
+        Useful when memcached runs on the same host: it saves the overhead of loopback TCP.
+    :param chunk_size: Values larger than this are split into several memcached items. It must not exceed
+        the item size limit of memcached server (1 MB by default) minus the key and item overhead.
+        If set to 0, values are never split.
     """
     global config
     config = ConfigSchema(**kwargs)
@@ -33,14 +44,34 @@ def _close_connection(result, proto):
     return defer.succeed(result)
 
 
-def _remove_args(url, args):
-    """Remove particular arguments from url.
-    For example, _remove_args(/service/?a=1&b=2&c=3, (a,c)) == /service/?b=2
+def _close_on_error(failure, proto):
+    """Errback for closing connection with memcached server. The failure is passed on."""
+
+    proto.transport.loseConnection()
+    return failure
+
+
+def _arg_name(arg):
+    """Name of the argument in query string item 'name=value'."""
+
+    return arg.partition("=")[0]
+
+
+def _canonical_uri(uri, redundant_args=frozenset()):
+    """Remove particular arguments from uri and sort the rest by name, so that the order of arguments
+    doesn't matter. Order of values of the same argument is kept.
+    For example, _canonical_uri(/service/?c=3&a=1&b=2, {"a"}) == /service/?b=2&c=3
     """
-    regexps = [re.compile(r'%s=[^&?]*[&]?' % arg) for arg in args]
-    for regexp in regexps:
-        url = re.sub(regexp, "", url)
-    return url
+
+    path, separator, query = uri.partition("?")
+    if not separator:
+        return path
+
+    args = [arg for arg in query.split("&") if arg and _arg_name(arg) not in redundant_args]
+    if not args:
+        return path
+    args.sort(key=_arg_name)
+    return path + "?" + "&".join(args)
 
 
 def _register_key(success, proto, key, func, args, kwargs, exclude_self, class_name, redundant_args=()):
@@ -49,10 +80,10 @@ def _register_key(success, proto, key, func, args, kwargs, exclude_self, class_n
     if success:
         if exclude_self:
             args = args[1:]
-            
-        for arg in redundant_args:
-            del kwargs[arg]
-            
+
+        if redundant_args:
+            kwargs = {name: value for name, value in kwargs.iteritems() if name not in redundant_args}
+
         keyregistry.register(key, func, args, kwargs, class_name)
 
     _close_connection(None, proto)
@@ -66,20 +97,268 @@ def _set_metadata(wrapper, func):
     wrapper.init_func = func
 
 
-def _create_key(request, redundant_args=()):
-    """Forms key for caching from request arguments."""
-    
-    uri = _remove_args(request.uri, redundant_args)
-    return str(uri)
+def _key_builder(redundant_args=(), vary_headers=(), vary_cookies=(), vary_session=()):
+    """Make function which forms key for caching from request arguments and, optionally, from request headers,
+    cookies and session attributes the response depends on. Everything which doesn't depend on the request
+    is prepared here, once per decorator.
+    """
+
+    redundant_args = frozenset(redundant_args)
+    vary_headers = tuple(vary_headers)
+    vary_cookies = tuple(vary_cookies)
+    vary_session = tuple(vary_session)
+    quote = urllib.quote
+
+    def create_key(request):
+        return str(_canonical_uri(request.uri, redundant_args))
+
+    if not (vary_headers or vary_cookies or vary_session):
+        return create_key
+
+    def quote_value(value):
+        #"~" is always quoted, so missing values don't share keys with any sent value, "None" included.
+        if value is None:
+            return "~"
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        return quote(str(value), safe="")
+
+    def create_vary_key(request):
+        values = [request.getHeader(name) for name in vary_headers]
+        values.extend(request.getCookie(name) for name in vary_cookies)
+        if vary_session:
+            session = request.getSession()
+            values.extend(getattr(session, name, None) for name in vary_session)
+        return create_key(request) + "#" + "&".join(quote_value(value) for value in values)
+
+    return create_vary_key
+
+
+def _vary(vary_headers, vary_cookies, vary_session):
+    """Names of request headers for Vary response header."""
+
+    if vary_cookies or vary_session:
+        return tuple(vary_headers) + ("Cookie",)
+    return tuple(vary_headers)
+
+
+def _local_lookup(key, func_id, func_metrics, client):
+    """Count the lookup for hot key detection and return the value of the key from the in-process tier
+    of hot keys, or None.
+    """
+
+    value = hotkeys.observe(key, func_id, id(client))
+    if value is not None:
+        func_metrics.hits += 1
+        func_metrics.local_hits += 1
+        tracing.finish(tracing.start("lookup", key, "local", func_id), "hit", len(value))
+    return value
+
+
+def _track(proto, connections):
+    """Keep the protocol in connections until its connection is closed."""
+
+    connections[proto] = True
+    proto.notifyClosed().addCallback(lambda _: connections.pop(proto, None))
+    return proto
+
+
+def _connect(config, connections, registry=None):
+    """Connect to memcached server of the configuration, either through the Unix socket (if it is configured)
+    or through TCP. The connection is kept in connections while it is open.
+    """
+
+    creator = protocol.ClientCreator(reactor, CacheProtocol, registry=registry)
+    if config.unix_socket:
+        d = creator.connectUNIX(config.unix_socket)
+    else:
+        d = creator.connectTCP(config.ip, config.port)
+    return d.addCallback(_track, connections)
+
+
+def _drain(connections, timeout, clock):
+    """Wait until the connections which are open now are closed. Connections still open after timeout
+    seconds are closed, so their commands fail.
+    """
+
+    draining = list(connections)
+    d = defer.DeferredList([proto.notifyClosed() for proto in draining])
+    if timeout is not None and draining:
+        def close():
+            for proto in draining:
+                if not proto.closed:
+                    proto.transport.loseConnection()
+
+        call = clock.callLater(timeout, close)
+
+        def closed(result):
+            if call.active():
+                call.cancel()
+            return result
+
+        d.addCallback(closed)
+    return d.addCallback(lambda _: None)
 
 
 def connect():
-    """Connect to memcached server
+    """Connect to memcached server, either through the Unix socket (if it is configured) or through TCP.
 
     :returns: Deferred which fires with protocol instance
     """
 
-    return protocol.ClientCreator(reactor, MemCacheProtocol).connectTCP(config.ip, config.port)
+    return _connect(config, default_client.connections)
+
+
+class CacheClient(object):
+    """Client of one memcached server (or of one pool of servers behind a proxy). Decorators and functions
+    of this module work with the default client, configured by :func:`load_config`. Pass other clients
+    to the decorators to keep values of particular functions in other servers, for example large values
+    in a separate pool.
+
+    Keyword arguments are the parameters of :func:`load_config`; disable is false by default.
+
+    :param serializer: Object with functions dumps and loads for cached values, :mod:`txcaching.serialization`
+        by default.
+    :param registry: :class:`txcaching.metrics.Registry` for metrics of the decorated functions and of
+        the connections. By default, the default registry.
+    """
+
+    clock = reactor
+
+    def __init__(self, serializer=serialization, registry=None, **kwargs):
+        kwargs.setdefault("disable", False)
+        self.config = ConfigSchema(**kwargs)
+        self.serializer = serializer
+        self.metrics = registry or metrics.registry
+        #Open connections: {protocol: True}
+        self.connections = {}
+
+    def connect(self):
+        """Connect to memcached server.
+
+        :returns: Deferred which fires with protocol instance
+        """
+
+        return _connect(self.config, self.connections, self.metrics)
+
+    def reconfigure(self, timeout=30, **kwargs):
+        """Change the settings at runtime. Parameters which are not passed keep their values.
+        Decorated functions use the new settings from their next call, for example reconfigure(disable=True)
+        turns caching off. Commands which are in flight finish on the connections opened before.
+
+        :param timeout: Connections opened before and still open after this number of seconds are closed,
+            so their commands fail and the decorated functions are called without cache. If it is None,
+            they are never closed.
+
+        :returns: Deferred which fires when all the connections opened before have been closed
+        """
+
+        self.config = self.config._replace(**kwargs)
+        return _drain(self.connections, timeout, self.clock)
+
+    def _store(self, method, key, val, flags, expireTime):
+        dumps = self.serializer.dumps
+        chunk_size = self.config.chunk_size
+        return self.connect().addCallback(lambda proto: chunking.store(proto, method, key, dumps(val), flags, expireTime, chunk_size).\
+                                                                    addBoth(_close_connection, proto))
+
+    def _command(self, method, *args):
+        return self.connect().addCallback(lambda proto: getattr(proto, method)(*args).addBoth(_close_connection, proto))
+
+    def replace(self, key, val, flags=0, expireTime=0):
+        """Wrapper for :meth:`twisted.protocol.memcached.MemCacheProtocol.replace`"""
+        hotkeys.forget(key, id(self))
+        return self._store("replace", key, val, flags, expireTime)
+
+    def add(self, key, val, flags=0, expireTime=0):
+        """Wrapper for :py:meth:`twisted.protocol.memcached.MemCacheProtocol.add`"""
+        return self._store("add", key, val, flags, expireTime)
+
+    def set(self, key, val, flags=0, expireTime=0):
+        """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.set`"""
+        hotkeys.forget(key, id(self))
+        return self._store("set", key, val, flags, expireTime)
+
+    def get(self, key, withIdentifier=False):
+        """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.get`"""
+        loads = self.serializer.loads
+        return self.connect().addCallback(lambda proto: chunking.get(proto, key, withIdentifier).\
+                                                            addBoth(_close_connection, proto)).\
+                                                            addCallback(lambda data: data[:-1] + (loads(data[-1]),))
+
+    def getMultiple(self, keys, withIdentifier=False):
+        """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.getMultiple`"""
+        loads = self.serializer.loads
+        return self.connect().addCallback(lambda proto: chunking.getMultiple(proto, keys, withIdentifier).\
+                                                    addBoth(_close_connection, proto)).\
+                                                    addCallback(lambda data: {
+                                                                    key: info[:-1] + (loads(info[-1]),)
+                                                                    for key, info in data.iteritems()
+                                                                })
+
+    def delete(self, key):
+        """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.delete`"""
+        hotkeys.forget(key, id(self))
+        return self._command("delete", key)
+
+    def flushAll(self):
+        """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.flushAll`"""
+        return self._command("flushAll")
+
+    def version(self):
+        """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.version`"""
+        return self._command("version")
+
+    def stats(self):
+        """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.stats`.
+        See :mod:`txcaching.stats` for parsed statistics of slabs, items and settings."""
+        return self._command("stats")
+
+    def append(self, key, val):
+        """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.append`"""
+        hotkeys.forget(key, id(self))
+        return self._command("append", key, self.serializer.dumps(val))
+
+    def prepend(self, key, val):
+        """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.prepend`"""
+        hotkeys.forget(key, id(self))
+        return self._command("prepend", key, self.serializer.dumps(val))
+
+    def increment(self, key, val=1):
+        """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.increment`.
+        Counters are stored as decimal numbers, so neither the value nor the delta are serialized."""
+        hotkeys.forget(key, id(self))
+        return self._command("increment", key, int(val))
+
+    def decrement(self, key, val=1):
+        """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.decrement`.
+        Counters are stored as decimal numbers, so neither the value nor the delta are serialized."""
+        hotkeys.forget(key, id(self))
+        return self._command("decrement", key, int(val))
+
+
+class _DefaultClient(CacheClient):
+    """Client configured by :func:`load_config`. It connects through :func:`connect`."""
+
+    def __init__(self):
+        self.serializer = serialization
+        self.metrics = metrics.registry
+        self.connections = {}
+
+    @property
+    def config(self):
+        return config
+
+    @config.setter
+    def config(self, value):
+        global config
+        config = value
+
+    def connect(self):
+        return connect()
+
+
+default_client = _DefaultClient()
 
 
 class RequestCachingWrapper(object):
@@ -87,7 +366,9 @@ class RequestCachingWrapper(object):
     This class is not to be used directly.
     """
 
-    def __init__(self, request, cache_key, cache_proto, func, resource, expireTime=0, exclude_self=False, class_name="", redundant_args=()):
+    def __init__(self, request, cache_key, cache_proto, func, resource, expireTime=0, exclude_self=False, class_name="",
+                 redundant_args=(), cached_headers=response.DEFAULT_CACHED_HEADERS, encodings=(), overwrite=False,
+                 max_cached_size=0, ttl_from_headers=False, func_metrics=None, client=None):
         self.request = request
         self.cache_key = cache_key
         self.cache_proto = cache_proto
@@ -97,46 +378,91 @@ class RequestCachingWrapper(object):
         self.exclude_self = exclude_self
         self.class_name = class_name
         self.redundant_args = redundant_args
-
-        self.stream = StringIO()
+        self.cached_headers = cached_headers
+        self.encodings = encodings
+        self.overwrite = overwrite
+        self.max_cached_size = max_cached_size
+        self.ttl_from_headers = ttl_from_headers
+        self.func_metrics = func_metrics or metrics.FunctionMetrics()
+        self.client = client or default_client
+
+        self.recompute = tracing.start("recompute", cache_key, function=keyregistry.func_id(func, class_name=class_name))
+        self.chunks = []
+        self.size = 0
+        self.code = 200
         self.error_occurred = False
 
+    def __getattr__(self, name):
+        return getattr(self.request, name)
+
     def getSession(self):
         return self.request.getSession()
 
     def finish(self):
         self.request.finish()
-        if not self.error_occurred:
+        self.recompute.sent = self.size
+        tracing.finish(self.recompute, "ok")
+        self.func_metrics.recompute_latency.record(self.recompute.duration)
+        if not self.error_occurred and self.chunks is not None:
             self._write_to_cache()
+        else:
+            self.func_metrics.bypasses += 1
+            _close_connection(None, self.cache_proto)
 
     def write(self, data):
-        self.stream.write(data)
+        if self.chunks is not None:
+            self.size += len(data)
+            if self.max_cached_size and self.size > self.max_cached_size:
+                #The response is too large to be cached: stop collecting it and free the buffer.
+                self.chunks = None
+            else:
+                self.chunks.append(data)
         self.request.write(data)
 
     def notifyFinish(self):
-        self.request.notifyFinish()
+        return self.request.notifyFinish()
 
-    def setResponseCode(self, code, error):
-        self.request.setResponseCode(code, error)
+    def setResponseCode(self, code, message=None):
+        self.request.setResponseCode(code, message)
+        self.code = code
         if code != 200:
             self.error_occurred = True
         else:
             self.error_occurred = False
 
     def _write_to_cache(self):
-        self.cache_proto.add(self.cache_key, str(self), expireTime=self.expireTime).\
+        expireTime = response.expire_time(self.request, self.expireTime) if self.ttl_from_headers else self.expireTime
+        if expireTime is None:
+            self.func_metrics.bypasses += 1
+            return _close_connection(None, self.cache_proto)
+
+        body = "".join(self.chunks)
+        self.chunks = []
+        serialization.compress(self.request, body, self.encodings).\
+            addCallback(self._store, body, expireTime).\
+            addErrback(_close_connection, self.cache_proto)
+
+    def _store(self, variants, body, expireTime):
+        method = "set" if self.overwrite else "add"
+        envelope = response.dumps(response.capture(self.request, body, self.cached_headers, self.code, variants=variants))
+        self.func_metrics.value_size.record(len(envelope))
+        return chunking.store(self.cache_proto, method, self.cache_key, envelope, expireTime=expireTime,\
+                              chunk_size=self.client.config.chunk_size).\
             addCallback(_register_key, self.cache_proto, self.cache_key, self.func, (self.resource,),\
                         self.request.args, self.exclude_self, self.class_name, self.redundant_args)
 
     def __str__(self):
-        return self.stream.getvalue()
+        return "".join(self.chunks or ())
 
     @property
     def args(self):
         return self.request.args
 
 
-def cache_sync_render_GET(expireTime=0, redundant_args=(), exclude_self=False, class_name=""):
+def cache_sync_render_GET(expireTime=0, redundant_args=(), exclude_self=False, class_name="",
+                          cached_headers=response.DEFAULT_CACHED_HEADERS, encodings=(),
+                          vary_headers=(), vary_cookies=(), vary_session=(), max_cached_size=0,
+                          ttl_from_headers=False, client=None):
     """Cache the output of function render_GET which returns a string.
     If it returns :const:`server.NOT_DONE_YET`, use :func:`cache_async_render_GET` instead. Shall be used as decorator.
 
@@ -151,36 +477,99 @@ def cache_sync_render_GET(expireTime=0, redundant_args=(), exclude_self=False, c
     :param class_name:
         Name of class of the resource. It is required because the decorator can only see an unbound method,
         unrelated to any class.
+    :param cached_headers:
+        Names of response headers which are cached together with the status code and the body,
+        and are set again when the response is read from cache.
+    :param encodings:
+        Content codings, for example ("gzip",), to store compressed variants of the body for. The body is compressed
+        once when it is cached, and a hit is answered with the variant the client accepts (by Accept-Encoding header).
+        Don't wrap such resources into :class:`twisted.web.resource.EncodingResourceWrapper`.
+    :param vary_headers:
+        Names of request headers the response depends on, for example ("Accept-Language", "Host").
+        Their values become part of the cache key, and they are listed in Vary header of cached responses.
+    :param vary_cookies:
+        Names of request cookies the response depends on. Their values become part of the cache key.
+    :param vary_session:
+        Names of attributes of the session (returned by request.getSession()) the response depends on,
+        for example the user or the tenant identifier. Their values become part of the cache key.
+    :param max_cached_size:
+        Responses with larger bodies (in bytes) are not cached. If set to 0, the size is not limited.
+    :param ttl_from_headers:
+        If it is true, the lifetime of each cached response is taken from Cache-Control (s-maxage or max-age)
+        or Expires header set by render_GET, and expireTime is used only for responses without them.
+        Responses marked as no-store, private or no-cache are not cached.
+    :param client:
+        :class:`CacheClient` to keep the responses in. By default, the client configured by :func:`load_config`.
     """
+    response.check_encodings(encodings)
+    create_key = _key_builder(redundant_args, vary_headers, vary_cookies, vary_session)
+    vary = _vary(vary_headers, vary_cookies, vary_session)
+
+    client = client or default_client
 
     def decorator(func):
-        if config.disable:
-            return func
+        func_id = keyregistry.func_id(func, class_name=class_name)
+        func_metrics = client.metrics.function(func_id)
 
         def wrapper(self, request):
-            d = connect()
+            if client.config.disable:
+                return func(self, request)
+
+            cache_key = create_key(request)
+            local = _local_lookup(cache_key, func_id, func_metrics, client)
+            if local is not None:
+                response.replay(request, response.loads(local), vary)
+                return server.NOT_DONE_YET
+
+            lookup = tracing.start("lookup", cache_key, function=func_id)
+            d = client.connect()
 
             def final(cache, proto):
                 flags, value = cache
-                if value is not None:
+                cached = response.loads(value) if value is not None else None
+                tracing.finish(lookup, "miss" if cached is None else "hit", len(value) if value is not None else 0)
+                func_metrics.lookup_latency.record(lookup.duration)
+                if cached is not None:
+                    func_metrics.hits += 1
                     _close_connection(None, proto)
-                    request.write(value)
-                    request.finish()
+                    hotkeys.promote(cache_key, value, id(client))
+                    response.replay(request, cached, vary)
                 else:
-                    cache_key = _create_key(request, redundant_args=redundant_args)
-                    value = read_without_cache(None)
-                    proto.add(cache_key, value, expireTime=expireTime).\
-                        addCallback(_register_key, proto, cache_key, func, (self,), request.args, exclude_self, class_name=class_name, redundant_args=redundant_args).\
-                        addErrback(_close_connection, proto)
+                    func_metrics.misses += 1
+                    recompute = tracing.start("recompute", cache_key, function=func_id)
+                    body = str(func(self, request))
+                    recompute.sent = len(body)
+                    tracing.finish(recompute, "ok")
+                    func_metrics.recompute_latency.record(recompute.duration)
+                    return serialization.compress(request, body, encodings).\
+                        addCallback(store, body, getattr(request, "code", 200), value, proto)
+
+            def store(variants, body, code, value, proto):
+                envelope = response.capture(request, body, cached_headers, code, variants=variants)
+                response.replay(request, envelope, vary)
+                expire = response.expire_time(request, expireTime) if ttl_from_headers else expireTime
+                #Like RequestCachingWrapper, only successful responses are cached.
+                if code != 200 or expire is None or max_cached_size and len(body) > max_cached_size:
+                    func_metrics.bypasses += 1
+                    return _close_connection(None, proto)
+                method = "set" if value is not None else "add"
+                envelope = response.dumps(envelope)
+                func_metrics.value_size.record(len(envelope))
+                chunking.store(proto, method, cache_key, envelope, expireTime=expire, chunk_size=client.config.chunk_size).\
+                    addCallback(_register_key, proto, cache_key, func, (self,), request.args, exclude_self, class_name=class_name, redundant_args=redundant_args).\
+                    addErrback(_close_connection, proto)
 
             def read_without_cache(_):
+                tracing.finish(lookup, "error")
+                func_metrics.errors += 1
                 result = str(func(self, request))
                 request.write(result)
                 request.finish()
                 return result
 
             def check_in_cache(proto):
-                return proto.get(_create_key(request, redundant_args=redundant_args)).addCallback(final, proto).addErrback(read_without_cache)
+                return chunking.get(proto, cache_key).addCallback(final, proto).addErrback(_close_on_error, proto).\
+                    addErrback(read_without_cache)
 
             d.addCallbacks(check_in_cache, read_without_cache)
             return server.NOT_DONE_YET
@@ -191,7 +580,10 @@ def cache_sync_render_GET(expireTime=0, redundant_args=(), exclude_self=False, c
     return decorator
 
 
-def cache_async_render_GET(expireTime=0, redundant_args=(), exclude_self=False, class_name=""):
+def cache_async_render_GET(expireTime=0, redundant_args=(), exclude_self=False, class_name="",
+                           cached_headers=response.DEFAULT_CACHED_HEADERS, encodings=(),
+                           vary_headers=(), vary_cookies=(), vary_session=(), max_cached_size=0,
+                           ttl_from_headers=False, client=None):
     """Cache the output of function render_GET which returns :const:`server.NOT_DONE_YET`.
     If it returns a string, use :func:`cache_sync_render_GET` instead. Shall be used as decorator.
 
@@ -206,35 +598,89 @@ def cache_async_render_GET(expireTime=0, redundant_args=(), exclude_self=False,
     :param class_name:
         Name of class of the resource. It is required because the decorator can only see an unbound method,
         unrelated to any class.
+    :param cached_headers:
+        Names of response headers which are cached together with the status code and the body,
+        and are set again when the response is read from cache.
+    :param encodings:
+        Content codings, for example ("gzip",), to store compressed variants of the body for. The body is compressed
+        once when it is cached, and a hit is answered with the variant the client accepts (by Accept-Encoding header).
+        Don't wrap such resources into :class:`twisted.web.resource.EncodingResourceWrapper`.
+    :param vary_headers:
+        Names of request headers the response depends on, for example ("Accept-Language", "Host").
+        Their values become part of the cache key, and they are listed in Vary header of cached responses.
+    :param vary_cookies:
+        Names of request cookies the response depends on. Their values become part of the cache key.
+    :param vary_session:
+        Names of attributes of the session (returned by request.getSession()) the response depends on,
+        for example the user or the tenant identifier. Their values become part of the cache key.
+    :param max_cached_size:
+        Responses with larger bodies (in bytes) are not cached. If set to 0, the size is not limited.
+    :param ttl_from_headers:
+        If it is true, the lifetime of each cached response is taken from Cache-Control (s-maxage or max-age)
+        or Expires header set by render_GET, and expireTime is used only for responses without them.
+        Responses marked as no-store, private or no-cache are not cached.
+    :param client:
+        :class:`CacheClient` to keep the responses in. By default, the client configured by :func:`load_config`.
     """
+    response.check_encodings(encodings)
+    create_key = _key_builder(redundant_args, vary_headers, vary_cookies, vary_session)
+    vary = _vary(vary_headers, vary_cookies, vary_session)
+
+    client = client or default_client
+
     def decorator(func):
-        if config.disable:
-            return func
+        func_id = keyregistry.func_id(func, class_name=class_name)
+        func_metrics = client.metrics.function(func_id)
 
         def wrapper(self, request):
-            d = connect()
+            if client.config.disable:
+                return func(self, request)
+
+            cache_key = create_key(request)
+            local = _local_lookup(cache_key, func_id, func_metrics, client)
+            if local is not None:
+                response.replay(request, response.loads(local), vary)
+                return server.NOT_DONE_YET
+
+            lookup = tracing.start("lookup", cache_key, function=func_id)
+            d = client.connect()
 
             def final(cache, proto):
                 flags, value = cache
-                if value is not None:
+                cached = response.loads(value) if value is not None else None
+                tracing.finish(lookup, "miss" if cached is None else "hit", len(value) if value is not None else 0)
+                func_metrics.lookup_latency.record(lookup.duration)
+                if cached is not None:
+                    func_metrics.hits += 1
                     _close_connection(None, proto)
-                    request.write(value)
-                    request.finish()
+                    hotkeys.promote(cache_key, value, id(client))
+                    response.replay(request, cached, vary)
                 else:
-                    read_without_cache(None, proto)
-
-            def read_without_cache(arg, proto=None):
-                cache_key = _create_key(request, redundant_args)
+                    func_metrics.misses += 1
+                    read_without_cache(None, proto, overwrite=value is not None)
+
+            def read_without_cache(arg, proto=None, overwrite=False):
+                #The response may be stored by shared caches, so it must vary like the responses replayed on hits.
+                if vary:
+                    request.responseHeaders.addRawHeader("Vary", ", ".join(vary))
+                if encodings:
+                    request.responseHeaders.addRawHeader("Vary", "Accept-Encoding")
                 if proto is None:
+                    tracing.finish(lookup, "error")
+                    func_metrics.errors += 1
                     caching_request = request
                 else:
                     caching_request = RequestCachingWrapper(request, cache_key, proto, func, self, expireTime=expireTime,\
-                                                            exclude_self=exclude_self, class_name=class_name, redundant_args=redundant_args)
+                                                            exclude_self=exclude_self, class_name=class_name, redundant_args=redundant_args,\
+                                                            cached_headers=cached_headers, encodings=encodings, overwrite=overwrite,\
+                                                            max_cached_size=max_cached_size, ttl_from_headers=ttl_from_headers,\
+                                                            func_metrics=func_metrics, client=client)
 
                 return func(self, caching_request)
 
             def check_in_cache(proto):
-                return proto.get(_create_key(request, redundant_args=redundant_args)).addCallback(final, proto).addErrback(read_without_cache, None)
+                return chunking.get(proto, cache_key).addCallback(final, proto).addErrback(_close_on_error, proto).\
+                    addErrback(read_without_cache, None)
 
             d.addCallbacks(check_in_cache, read_without_cache)
             return server.NOT_DONE_YET
@@ -245,6 +691,10 @@ def cache_async_render_GET(expireTime=0, redundant_args=(), exclude_self=False,
     return decorator
 
 
+#Result of lookup of :func:`cache` which has found no value.
+_MISS = object()
+
+
 def default_lazy_key(func, args, kwargs, exclude_self=False, class_name=""):
     """Default function which generates cache key using function and its arguments.
     All the arguments must be picklable.
@@ -268,7 +718,8 @@ def default_lazy_key(func, args, kwargs, exclude_self=False, class_name=""):
     return cache_key
 
 
-def cache(cache_key=None, lazy_key=default_lazy_key, class_name="", expireTime=0, exclude_self=False):
+def cache(cache_key=None, lazy_key=default_lazy_key, class_name="", expireTime=0, exclude_self=False, adaptive_bypass=False,
+          threaded=False, client=None):
     """ Cache the output of the function. Shall be used as decorator.
 
     :param cache_key: Set up the cache key directly. In this case, only one key will be used to store function output, \
@@ -283,115 +734,178 @@ def cache(cache_key=None, lazy_key=default_lazy_key, class_name="", expireTime=0
     :param exclude_self:
         If it is true, the state of resource object will not be used to create cache key. If it is set to false,
         changing the resource object will change the cache key, even if the other function arguments are the same.
+    :param adaptive_bypass:
+        If it is true, a share of calls skips the cache while looking it up takes longer than the function
+        saves on hits, for example for cheap functions under memcached load. See :mod:`txcaching.adaptive`.
+        The decisions are available as the attribute adaptive of the decorated function.
+    :param threaded:
+        If it is true, the function is called in a thread, so that a blocking function doesn't stop the reactor,
+        and hits keep being served while it runs. True means the thread pool of the reactor,
+        or pass :class:`txcaching.workers.Pool` to use its own threads. The function must return a value,
+        not a Deferred, and must not use Twisted APIs which aren't thread-safe.
+    :param client:
+        :class:`CacheClient` to keep the values in. By default, the client configured by :func:`load_config`.
     """
+    client = client or default_client
+
     def decorator(func):
-        if config.disable:
-            return func
+        func_id = keyregistry.func_id(func, class_name=class_name)
+        func_metrics = client.metrics.function(func_id)
+        bypass = adaptive.AdaptiveBypass() if adaptive_bypass else None
+        if threaded:
+            call = (workers.default_pool() if threaded is True else threaded).run
+        else:
+            call = maybeDeferred
 
         def wrapper(*args, **kwargs):
-            key = cache_key or lazy_key(func, args, kwargs, exclude_self=exclude_self, class_name=class_name)
-
-            d = connect()
+            if client.config.disable:
+                return call(func, *args, **kwargs)
 
-            def write_to_cache(value, proto):
-                proto.add(key, pickle.dumps(value), expireTime=expireTime).\
+            key = cache_key or lazy_key(func, args, kwargs, exclude_self=exclude_self, class_name=class_name)
+            local = _local_lookup(key, func_id, func_metrics, client)
+            if local is not None:
+                return defer.succeed(client.serializer.loads(local))
+
+            if bypass is not None and bypass.bypass():
+                func_metrics.adaptive_bypasses += 1
+                recompute = tracing.start("recompute", key, function=func_id)
+                return call(func, *args, **kwargs).addCallback(computed_without_cache, recompute)
+
+            lookup = tracing.start("lookup", key, function=func_id)
+            d = client.connect()
+
+            def looked_up(hit):
+                if bypass is not None:
+                    bypass.lookup(lookup.duration, hit)
+                    func_metrics.bypass_ratio = bypass.ratio
+
+            def write_to_cache(value, proto, recompute):
+                dump = client.serializer.dumps(value)
+                recompute.sent = len(dump)
+                tracing.finish(recompute, "ok")
+                func_metrics.recompute_latency.record(recompute.duration)
+                if bypass is not None:
+                    bypass.compute(recompute.duration)
+                func_metrics.value_size.record(len(dump))
+                chunking.store(proto, "add", key, dump, expireTime=expireTime, chunk_size=client.config.chunk_size).\
                     addBoth(_register_key, proto, key, func, args, kwargs, exclude_self, class_name)
-
-                _close_connection(None, proto)
                 return value
 
             def final(cache, proto):
                 flags, value = cache
+                tracing.finish(lookup, "miss" if value is None else "hit", len(value) if value is not None else 0)
+                func_metrics.lookup_latency.record(lookup.duration)
+                looked_up(value is not None)
                 if value is not None:
+                    func_metrics.hits += 1
                     _close_connection(None, proto)
-                    return defer.succeed(pickle.loads(value))
+                    hotkeys.promote(key, value, id(client))
+                    return client.serializer.loads(value)
                 else:
-                    return maybeDeferred(func, *args, **kwargs).addCallback(write_to_cache, proto)
+                    func_metrics.misses += 1
+                    return _MISS
+
+            def recompute_on_miss(result, proto):
+                #Outside of the lookup errback: failures of the function go to the caller, it isn't called again.
+                if result is not _MISS:
+                    return result
+                recompute = tracing.start("recompute", key, function=func_id)
+                return call(func, *args, **kwargs).addCallbacks(write_to_cache, _close_on_error,
+                                                                callbackArgs=(proto, recompute), errbackArgs=(proto,))
 
             def read_without_cache(arg):
-                return func(*args, **kwargs)
+                tracing.finish(lookup, "error")
+                func_metrics.errors += 1
+                looked_up(False)
+                return call(func, *args, **kwargs)
 
             def check_in_cache(proto):
-                return proto.get(key).addCallback(final, proto).addErrback(read_without_cache)
+                return chunking.get(proto, key).addCallback(final, proto).addErrback(_close_on_error, proto).\
+                    addErrback(read_without_cache).addCallback(recompute_on_miss, proto)
 
             return d.addCallbacks(check_in_cache, read_without_cache)
 
+        def computed_without_cache(value, recompute):
+            tracing.finish(recompute, "ok")
+            func_metrics.recompute_latency.record(recompute.duration)
+            bypass.compute(recompute.duration)
+            return value
+
         _set_metadata(wrapper, func)
+        wrapper.adaptive = bypass
         return wrapper
 
     return decorator
 
 
 def replace(key, val, flags=0, expireTime=0):
-    """Wrapper for :meth:`twisted.protocol.memcached.MemCacheProtocol.replace`"""
-    return connect().addCallback(lambda proto: proto.replace(key, pickle.dumps(val), flags, expireTime).\
-                                                                        addBoth(_close_connection, proto))
+    """Replace the value with the default client, see :meth:`CacheClient.replace`."""
+    return default_client.replace(key, val, flags, expireTime)
 
 
 def add(key, val, flags=0, expireTime=0):
-    """Wrapper for :py:meth:`twisted.protocol.memcached.MemCacheProtocol.add`"""
-    return connect().addCallback(lambda proto: proto.add(key, pickle.dumps(val), flags, expireTime).\
-                                                                    addBoth(_close_connection, proto))
+    """Add the value with the default client, see :meth:`CacheClient.add`."""
+    return default_client.add(key, val, flags, expireTime)
 
 
 def set(key, val, flags=0, expireTime=0):
-    """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.set`"""
-    return connect().addCallback(lambda proto: proto.set(key, pickle.dumps(val), flags, expireTime).\
-                                                                    addBoth(_close_connection, proto))
+    """Set the value with the default client, see :meth:`CacheClient.set`."""
+    return default_client.set(key, val, flags, expireTime)
 
 
 def get(key, withIdentifier=False):
-    """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.get`"""
-    return connect().addCallback(lambda proto: proto.get(key, withIdentifier).\
-                                                        addBoth(_close_connection, proto)).\
-                                                        addCallback(lambda data: data[:-1] + (pickle.loads(data[-1]),))
+    """Get the value with the default client, see :meth:`CacheClient.get`."""
+    return default_client.get(key, withIdentifier)
 
 
 def getMultiple(keys, withIdentifier=False):
-    """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.getMultiple`"""
-    return connect().addCallback(lambda proto: proto.getMultiple(keys, withIdentifier).\
-                                                addBoth(_close_connection, proto)).\
-                                                addCallback(lambda data: {
-                                                                key: info[:-1] + (pickle.loads(info[-1]),)
-                                                                for key, info in data.iteritems()
-                                                            })
+    """Get the values with the default client, see :meth:`CacheClient.getMultiple`."""
+    return default_client.getMultiple(keys, withIdentifier)
 
 
 def delete(key):
-    """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.delete`"""
-    return connect().addCallback(lambda proto: proto.delete(key).addBoth(_close_connection, proto))
+    """Delete the value with the default client, see :meth:`CacheClient.delete`."""
+    return default_client.delete(key)
 
 
 def flushAll():
-    """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.flushAll`"""
-    return connect().addCallback(lambda proto: proto.flushAll().addBoth(_close_connection, proto))
+    """Flush the server of the default client, see :meth:`CacheClient.flushAll`."""
+    return default_client.flushAll()
 
 
 def version():
-    """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.version`"""
-    return connect().addCallback(lambda proto: proto.version().addBoth(_close_connection, proto))
+    """Version of the server of the default client, see :meth:`CacheClient.version`."""
+    return default_client.version()
 
 
 def stats():
-    """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.stats`"""
-    return connect().addCallback(lambda proto: proto.stats().addBoth(_close_connection, proto))
+    """Statistics of the server of the default client, see :meth:`CacheClient.stats`.
+    See :mod:`txcaching.stats` for parsed statistics of slabs, items and settings."""
+    return default_client.stats()
 
 
 def append(key, val):
-    """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.append`"""
-    return connect().addCallback(lambda proto: proto.append(key, pickle.dumps(val)).addBoth(_close_connection, proto))
+    """Append to the value with the default client, see :meth:`CacheClient.append`."""
+    return default_client.append(key, val)
 
 
 def prepend(key, val):
-    """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.prepend`"""
-    return connect().addCallback(lambda proto: proto.prepend(key, pickle.dumps(val)).addBoth(_close_connection, proto))
+    """Prepend to the value with the default client, see :meth:`CacheClient.prepend`."""
+    return default_client.prepend(key, val)
 
 
 def increment(key, val=1):
-    """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.increment`"""
-    return connect().addCallback(lambda proto: proto.increment(key, pickle.dumps(val)).addBoth(_close_connection, proto))
+    """Increment the value with the default client, see :meth:`CacheClient.increment`."""
+    return default_client.increment(key, val)
 
 
 def decrement(key, val=1):
-    """Wrapper for :func:`twisted.protocol.memcached.MemCacheProtocol.decrement`"""
-    return connect().addCallback(lambda proto: proto.decrement(key, pickle.dumps(val)).addBoth(_close_connection, proto))
+    """Decrement the value with the default client, see :meth:`CacheClient.decrement`."""
+    return default_client.decrement(key, val)
+
+
+def reconfigure(timeout=30, **kwargs):
+    """Change the settings of the default client at runtime, see :meth:`CacheClient.reconfigure`.
+    Parameters are those of :func:`load_config`.
+    """
+    return default_client.reconfigure(timeout, **kwargs)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import zlib
+
+from twisted.internet import defer
+
+#Memcached limits items to 1 MB by default, including the key and item overhead.
+DEFAULT_CHUNK_SIZE = 1000 * 1000
+
+#Pickles never start with zero byte, so manifests can't be confused with regular values.
+MANIFEST_PREFIX = "\x00txcaching-chunks:"
+
+
+def _checksum(value):
+    """Checksum of the value to verify assembled chunks."""
+
+    return zlib.crc32(value) & 0xffffffff
+
+
+def _chunk_keys(key, token, count):
+    """Keys of chunks. The original key may be close to the limit of key length, so its digest is used."""
+
+    digest = hashlib.sha1(key).hexdigest()
+    return ["%s:%s:%d" % (digest, token, index) for index in xrange(count)]
+
+
+def _parse_manifest(value):
+    """Parse manifest into tuple (token, count, size, checksum) or return None if it is malformed."""
+
+    try:
+        token, count, size, checksum = value[len(MANIFEST_PREFIX):].split(":")
+        return token, int(count), int(size), int(checksum)
+    except ValueError:
+        return None
+
+
+def is_manifest(value):
+    """Check if the value read from memcached is a manifest of chunked value."""
+
+    return value is not None and value.startswith(MANIFEST_PREFIX)
+
+
+def store(proto, method, key, value, flags=0, expireTime=0, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Store the value using the method of :class:`twisted.protocols.memcache.MemCacheProtocol`
+    ("set", "add" or "replace"). If the value is larger than chunk_size, it is split into chunks,
+    which are set under their own keys in one pipeline. Then the manifest (the version token of the chunks,
+    their number, the size and the checksum of the value) is stored under the key with the method,
+    so readers never see a manifest before its chunks. The chunk keys include the token,
+    so chunks of different versions of the value never mix. If the manifest is not stored
+    (for example, add has lost the race to another writer), the chunks are deleted.
+
+    :param chunk_size: Maximal size of one item. If set to 0, values are never split.
+
+    :returns: Deferred which fires with the result of the method
+    """
+
+    store_item = getattr(proto, method)
+    if not chunk_size or len(value) <= chunk_size:
+        return store_item(key, value, flags=flags, expireTime=expireTime)
+
+    token = os.urandom(6).encode("hex")
+    count = (len(value) + chunk_size - 1) // chunk_size
+    chunks = [
+        proto.set(chunk_key, value[index * chunk_size:(index + 1) * chunk_size], expireTime=expireTime)
+        for index, chunk_key in enumerate(_chunk_keys(key, token, count))
+    ]
+    manifest = MANIFEST_PREFIX + "%s:%d:%d:%d" % (token, count, len(value), _checksum(value))
+
+    def store_manifest(results):
+        if not all(results):
+            return False
+        return store_item(key, manifest, flags=flags, expireTime=expireTime)
+
+    def delete_orphans(stored):
+        if stored:
+            return stored
+        deletes = [proto.delete(chunk_key) for chunk_key in _chunk_keys(key, token, count)]
+        return defer.DeferredList(deletes, consumeErrors=True).addCallback(lambda _: stored)
+
+    def failed(failure):
+        return delete_orphans(False).addCallback(lambda _: failure)
+
+    return defer.gatherResults(chunks, consumeErrors=True).addCallback(store_manifest).\
+        addCallbacks(delete_orphans, failed)
+
+
+def _assemble(result, proto, key):
+    """Replace the manifest in result of get command with the value assembled from chunks.
+    If some chunks have been evicted or don't match the manifest, the value is treated as missing,
+    and the manifest is deleted so that the value can be added again.
+    """
+
+    manifest = _parse_manifest(result[-1])
+    if manifest is None:
+        return _broken(result, proto, key)
+
+    token, count, size, checksum = manifest
+    chunk_keys = _chunk_keys(key, token, count)
+
+    def join(chunks):
+        parts = [chunks.get(chunk_key, (None,))[-1] for chunk_key in chunk_keys]
+        if None in parts:
+            return _broken(result, proto, key)
+        value = "".join(parts)
+        if len(value) != size or _checksum(value) != checksum:
+            return _broken(result, proto, key)
+        return result[:-1] + (value,)
+
+    return proto.getMultiple(chunk_keys).addCallback(join)
+
+
+def _broken(result, proto, key):
+    """Result of get command for the missing value. The broken manifest is deleted,
+    unless another writer has stored a new value under the key meanwhile.
+    """
+
+    manifest = result[-1]
+    missing = result[:-1] + (None,)
+
+    def delete(current):
+        if current[-1] == manifest:
+            return proto.delete(key)
+
+    return proto.get(key).addCallback(delete).addBoth(lambda _: missing)
+
+
+def get(proto, key, withIdentifier=False):
+    """Same as :meth:`twisted.protocols.memcache.MemCacheProtocol.get`, but assembles chunked values."""
+
+    def assemble(result):
+        if is_manifest(result[-1]):
+            return _assemble(result, proto, key)
+        return result
+
+    return proto.get(key, withIdentifier).addCallback(assemble)
+
+
+def getMultiple(proto, keys, withIdentifier=False):
+    """Same as :meth:`twisted.protocols.memcache.MemCacheProtocol.getMultiple`, but assembles chunked values."""
+
+    def assemble(values):
+        chunked = [key for key, result in values.iteritems() if is_manifest(result[-1])]
+        if not chunked:
+            return values
+
+        def replace(result, key):
+            values[key] = result
+
+        return defer.gatherResults([
+            _assemble(values[key], proto, key).addCallback(replace, key) for key in chunked
+        ]).addCallback(lambda _: values)
+
+    return proto.getMultiple(keys, withIdentifier).addCallback(assemble)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+from twisted.internet import defer
+from twisted.protocols.memcache import MemCacheProtocol
+
+from . import metrics, tracing
+
+
+class CacheProtocol(MemCacheProtocol):
+    """:class:`twisted.protocols.memcache.MemCacheProtocol` which records metrics of connections and commands
+    to :attr:`metrics` and traces every command (see :mod:`txcaching.tracing`).
+    """
+
+    metrics = metrics.registry
+
+    server = None
+
+    def __init__(self, timeOut=60, registry=None):
+        """
+        :param registry: :class:`txcaching.metrics.Registry` to record metrics to, instead of :attr:`metrics`.
+        """
+
+        MemCacheProtocol.__init__(self, timeOut)
+        if registry is not None:
+            self.metrics = registry
+        self.closed = False
+        self._closeWaiters = []
+
+    def connectionMade(self):
+        MemCacheProtocol.connectionMade(self)
+        peer = self.transport.getPeer()
+        if hasattr(peer, "port"):
+            self.server = "%s:%d" % (peer.host, peer.port)
+        else:
+            self.server = getattr(peer, "name", None)
+        self.metrics.connections_open += 1
+        self.metrics.connections_total += 1
+
+    def connectionLost(self, reason):
+        self.metrics.connections_open -= 1
+        MemCacheProtocol.connectionLost(self, reason)
+        self.closed = True
+        waiters, self._closeWaiters = self._closeWaiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def notifyClosed(self):
+        """Deferred which fires when the connection is closed."""
+
+        if self.closed:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._closeWaiters.append(d)
+        return d
+
+    def _measure(self, name, key, sent, command, *args):
+        """Send the command, trace it and record its latency and outcome."""
+
+        operation = tracing.start(name, key, self.server, sent=sent)
+
+        def record(result):
+            outcome, received = tracing.describe(name, result)
+            tracing.finish(operation, outcome, received)
+            operation_metrics = self.metrics.operation(name)
+            operation_metrics.latency.record(operation.duration)
+            if outcome == "error":
+                operation_metrics.errors += 1
+            return result
+
+        return command(self, *args).addBoth(record)
+
+    def get(self, key, withIdentifier=False):
+        return self._measure("get", key, 0, MemCacheProtocol.get, key, withIdentifier)
+
+    def getMultiple(self, keys, withIdentifier=False):
+        return self._measure("getMultiple", keys, 0, MemCacheProtocol.getMultiple, keys, withIdentifier)
+
+    def set(self, key, val, flags=0, expireTime=0):
+        return self._measure("set", key, len(val), MemCacheProtocol.set, key, val, flags, expireTime)
+
+    def add(self, key, val, flags=0, expireTime=0):
+        return self._measure("add", key, len(val), MemCacheProtocol.add, key, val, flags, expireTime)
+
+    def replace(self, key, val, flags=0, expireTime=0):
+        return self._measure("replace", key, len(val), MemCacheProtocol.replace, key, val, flags, expireTime)
+
+    def checkAndSet(self, key, val, cas, flags=0, expireTime=0):
+        return self._measure("checkAndSet", key, len(val), MemCacheProtocol.checkAndSet, key, val, cas, flags,
+                             expireTime)
+
+    def append(self, key, val):
+        return self._measure("append", key, len(val), MemCacheProtocol.append, key, val)
+
+    def prepend(self, key, val):
+        return self._measure("prepend", key, len(val), MemCacheProtocol.prepend, key, val)
+
+    def increment(self, key, val=1):
+        return self._measure("increment", key, 0, MemCacheProtocol.increment, key, val)
+
+    def decrement(self, key, val=1):
+        return self._measure("decrement", key, 0, MemCacheProtocol.decrement, key, val)
+
+    def delete(self, key):
+        return self._measure("delete", key, 0, MemCacheProtocol.delete, key)
+
+    def flushAll(self):
+        return self._measure("flushAll", None, 0, MemCacheProtocol.flushAll)
+
+    def stats(self, arg=None):
+        return self._measure("stats", arg, 0, MemCacheProtocol.stats, arg)
+
+    def version(self):
+        return self._measure("version", None, 0, MemCacheProtocol.version)
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""Detection of hot keys: a count-min sketch and a top-K table over sampled lookups of the decorators.
+Memory doesn't depend on the number of keys. Optionally, values of hot keys are kept in a small in-process tier
+for a short time, so that their lookups don't reach the memcached node which owns them.
+
+Detection is disabled by default. Enable it with :func:`enable`, see the current hot keys with :func:`top`.
+"""
+
+from array import array
+from collections import OrderedDict
+import random
+import time
+
+#HotKeyDetector when detection is enabled.
+detector = None
+
+
+class CountMinSketch(object):
+    """Approximate counts of keys in width * depth counters. Estimates never undercount,
+    and overcount by at most 2 / width of all the counts with high probability.
+    """
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array("L", [0] * width) for _ in xrange(depth)]
+
+    def _indexes(self, key):
+        #Double hashing: depth indexes from two hashes of the key.
+        first = hash(key)
+        second = (first >> 16) | 1
+        return [(first + row * second) % self.width for row in xrange(self.depth)]
+
+    def add(self, key, count=1):
+        """Count the key and return its estimated count."""
+
+        estimate = None
+        for row, index in zip(self.rows, self._indexes(key)):
+            row[index] += count
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+        return estimate
+
+    def estimate(self, key):
+        return min(row[index] for row, index in zip(self.rows, self._indexes(key)))
+
+    def decay(self):
+        """Halve all the counts, so that keys which are not hot anymore leave the top."""
+
+        for row in self.rows:
+            for index in xrange(self.width):
+                row[index] >>= 1
+
+
+class LocalTier(object):
+    """In-process cache of values of hot keys, bounded by the number of items, with a short lifetime.
+
+    :param size: Maximal number of items. Least recently promoted items are dropped first.
+    :param ttl: Lifetime of items in seconds.
+    :param clock: Function which returns the current time.
+    """
+
+    def __init__(self, size=100, ttl=5, clock=time.time):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.items = OrderedDict()
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires <= self.clock():
+            del self.items[key]
+            return None
+        return value
+
+    def put(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = (self.clock() + self.ttl, value)
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class HotKeyDetector(object):
+    """Count-min sketch over sampled lookups and the table of top keys.
+
+    :param k: Number of top keys to keep.
+    :param sample_rate: Share of lookups to count.
+    :param min_count: Sampled count from which a key in the top is considered hot.
+    :param decay_interval: Counts are halved after this number of sampled lookups.
+    :param width, depth: Size of the sketch, see :class:`CountMinSketch`.
+    :param local_tier: :class:`LocalTier` to promote hot keys into, or None.
+    """
+
+    def __init__(self, k=20, sample_rate=0.01, min_count=10, decay_interval=100000, width=2048, depth=4,
+                 local_tier=None):
+        self.k = k
+        self.sample_rate = sample_rate
+        self.min_count = min_count
+        self.decay_interval = decay_interval
+        self.sketch = CountMinSketch(width, depth)
+        self.local_tier = local_tier
+        self.top_keys = {}
+        self.sampled = 0
+        self.random = random.random
+
+    def observe(self, key, func_id):
+        """Count the lookup, if it is sampled."""
+
+        if self.sample_rate < 1 and self.random() >= self.sample_rate:
+            return
+        self.sampled += 1
+        if self.sampled % self.decay_interval == 0:
+            self._decay()
+
+        estimate = self.sketch.add(key)
+        top_keys = self.top_keys
+        if key in top_keys or len(top_keys) < self.k:
+            top_keys[key] = (estimate, func_id)
+            return
+        coldest = min(top_keys, key=lambda top_key: top_keys[top_key][0])
+        if top_keys[coldest][0] < estimate:
+            del top_keys[coldest]
+            top_keys[key] = (estimate, func_id)
+
+    def _decay(self):
+        self.sketch.decay()
+        self.top_keys = {key: (estimate >> 1, func_id) for key, (estimate, func_id) in self.top_keys.iteritems()
+                         if estimate >> 1}
+
+    def is_hot(self, key):
+        entry = self.top_keys.get(key)
+        return entry is not None and entry[0] >= self.min_count
+
+    def top(self):
+        """Top keys, the hottest first.
+
+        :returns: list of tuples (key, func_id, estimated number of lookups)
+        """
+
+        return sorted(((key, func_id, int(estimate / self.sample_rate))
+                       for key, (estimate, func_id) in self.top_keys.iteritems()), key=lambda item: -item[2])
+
+
+def enable(k=20, sample_rate=0.01, min_count=10, decay_interval=100000, width=2048, depth=4, local_size=0,
+           local_ttl=5):
+    """Start detecting hot keys in lookups of all decorators.
+
+    :param local_size: If it is not 0, values of hot keys are promoted into the in-process tier of this size
+        (number of items) for local_ttl seconds. Their changes in memcached are not seen until the lifetime ends.
+
+    See :class:`HotKeyDetector` for the other parameters.
+    """
+
+    global detector
+    local_tier = LocalTier(local_size, local_ttl) if local_size else None
+    detector = HotKeyDetector(k, sample_rate, min_count, decay_interval, width, depth, local_tier)
+    return detector
+
+
+def disable():
+    global detector
+    detector = None
+
+
+def observe(key, func_id, namespace=None):
+    """Count the lookup of the key by the decorator of the function.
+
+    :param namespace: Values of the same key in different namespaces (e.g. read from different memcached servers)
+        are kept apart in the in-process tier.
+    :returns: value from the in-process tier or None
+    """
+
+    if detector is None:
+        return None
+    detector.observe(key, func_id)
+    if detector.local_tier is None:
+        return None
+    return detector.local_tier.get((namespace, key))
+
+
+def promote(key, value, namespace=None):
+    """Keep the value read from memcached in the in-process tier, if the key is hot."""
+
+    if detector is not None and detector.local_tier is not None and detector.is_hot(key):
+        detector.local_tier.put((namespace, key), value)
+
+
+def forget(key, namespace=None):
+    """Drop the key from the in-process tier, when its value is changed or deleted in memcached by this process."""
+
+    if detector is not None and detector.local_tier is not None:
+        detector.local_tier.items.pop((namespace, key), None)
+
+
+def top():
+    """Current top keys, see :meth:`HotKeyDetector.top`."""
+
+    if detector is None:
+        return []
+    return detector.top()
@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict
 import copy
 import cPickle as pickle
 import json
 
+#Function identifier -> serialized arguments -> keys (ordered sets), so that registering and looking up
+#a key don't depend on the number of registered calls.
 _REGISTRY = {}
 
 
@@ -32,10 +35,11 @@ def all():
             "function": func_id,
             "info": [
                 {
-                    "key": info_item["key"],
-                    "args": pickle.loads(info_item["args"])
+                    "key": key,
+                    "args": pickle.loads(args_dump)
                 }
-                for info_item in info
+                for args_dump, keys in info.iteritems()
+                for key in keys
             ]
         }
         for func_id, info in _REGISTRY.iteritems()
@@ -50,19 +54,22 @@ def register(key, func, args=(), kwargs={}, class_name=""):
     :param tuple args: function arguments
     :param dict kwargs: function keyword arguments
     :param class_name: If the function is a method, name of class of the object must be set up.
+
+    The registry keeps every distinct key until :func:`remove` or :func:`clear`. Render decorators with
+    vary_headers, vary_cookies or vary_session register a key per variant (e.g. per user and page),
+    so the memory it takes grows with the number of variants served.
     """
 
     func = func_id(func, class_name=class_name)
     args_dump = _serialize(args, kwargs)
 
     if func not in _REGISTRY:
-        _REGISTRY[func] = []
+        _REGISTRY[func] = OrderedDict()
 
-    if not filter(lambda item: item["args"] == args_dump, _REGISTRY[func]):
-        _REGISTRY[func].append({
-            "key": key,
-            "args": args_dump,
-        })
+    keys = _REGISTRY[func].get(args_dump)
+    if keys is None:
+        keys = _REGISTRY[func][args_dump] = OrderedDict()
+    keys[key] = True
 
 
 def remove(func):
@@ -80,7 +87,7 @@ def keys(func):
     func = func_id(func, class_name)
     if func not in _REGISTRY:
         return []
-    return [item["key"] for item in _REGISTRY[func]]
+    return [key for keys in _REGISTRY[func].itervalues() for key in keys]
 
 
 def key(func, args=(), kwargs={}):
@@ -92,10 +99,10 @@ def key(func, args=(), kwargs={}):
     if func not in _REGISTRY:
         return None
     
-    keys = [item["key"] for item in _REGISTRY[func] if item["args"] == _serialize(args, kwargs)]
+    keys = _REGISTRY[func].get(_serialize(args, kwargs))
     if not keys:
         return None
-    return keys[0]
+    return next(iter(keys))
 
 
 def clear():
@@ -0,0 +1,526 @@
+# -*- coding: utf-8 -*-
+"""In-process memcached server for tests and benchmarks. It speaks the memcached text protocol,
+honours expiration times, flags and CAS, limits memory with LRU eviction, and can delay replies or fail
+commands on purpose, so that clients can be tested offline against realistic behaviour.
+
+Run it standalone with `python -m txcaching.memcached --port 11211`.
+"""
+
+from collections import OrderedDict
+import argparse
+import os
+import random
+import sys
+
+from twisted.internet import protocol
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+
+#Memcached treats expiration times longer than 30 days as absolute Unix time.
+MAX_RELATIVE_EXPIRE_TIME = 30 * 24 * 60 * 60
+
+#Memory accounted for each item in addition to its key and value, roughly as memcached does.
+ITEM_OVERHEAD = 50
+
+MAX_KEY_LENGTH = 250
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+DEFAULT_ITEM_SIZE_MAX = 1024 * 1024
+
+VERSION = "1.6.0-txcaching"
+
+#Ways injected failures manifest: error reply, closed connection, or no replies at all (to test timeouts).
+FAILURE_MODES = ("error", "disconnect", "hang")
+
+_STORAGE_COMMANDS = frozenset(["set", "add", "replace", "append", "prepend", "cas"])
+
+
+class Item(object):
+    """Stored value. expires is the absolute time of expiration, 0 if the item never expires."""
+
+    __slots__ = ("flags", "expires", "value", "cas", "stored")
+
+    def __init__(self, flags, expires, value, cas, stored):
+        self.flags = flags
+        self.expires = expires
+        self.value = value
+        self.cas = cas
+        self.stored = stored
+
+
+class Storage(object):
+    """Items of the server with memcached semantics. Time is taken from the clock, so that expiration
+    can be tested with :class:`twisted.internet.task.Clock`.
+
+    :param max_bytes: Memory limit. Least recently used items are evicted to stay within it.
+    :param item_size_max: Larger items are refused.
+    :param clock: Provider of IReactorTime. By default, the reactor is used.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, item_size_max=DEFAULT_ITEM_SIZE_MAX, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.max_bytes = max_bytes
+        self.item_size_max = item_size_max
+        self.clock = clock
+        self.items = OrderedDict()
+        self.bytes = 0
+        self.next_cas = 1
+        self.flushed = None
+        self.started = clock.seconds()
+        self.counters = dict.fromkeys(["cmd_get", "cmd_set", "cmd_touch", "get_hits", "get_misses", "delete_hits",
+                                       "delete_misses", "incr_hits", "incr_misses", "decr_hits", "decr_misses",
+                                       "cas_hits", "cas_misses", "cas_badval", "touch_hits", "touch_misses",
+                                       "evictions", "expired_unfetched", "total_items"], 0)
+
+    def _expires(self, exptime):
+        """Absolute time of expiration for exptime of the command."""
+
+        if exptime == 0:
+            return 0
+        if exptime < 0:
+            return -1
+        if exptime > MAX_RELATIVE_EXPIRE_TIME:
+            return exptime
+        return self.clock.seconds() + exptime
+
+    def _size(self, key, value):
+        return len(key) + len(value) + ITEM_OVERHEAD
+
+    def _live(self, key):
+        """Item if it exists and hasn't expired. Expired items are removed."""
+
+        item = self.items.get(key)
+        if item is None:
+            return None
+        now = self.clock.seconds()
+        expired = item.expires and item.expires <= now
+        flushed = self.flushed is not None and self.flushed <= now and item.stored <= self.flushed
+        if expired or flushed:
+            self._remove(key)
+            self.counters["expired_unfetched"] += 1
+            return None
+        return item
+
+    def _remove(self, key):
+        item = self.items.pop(key)
+        self.bytes -= self._size(key, item.value)
+
+    def _touch_lru(self, key, item):
+        del self.items[key]
+        self.items[key] = item
+
+    def _put(self, key, flags, expires, value):
+        if key in self.items:
+            self._remove(key)
+        self.items[key] = Item(flags, expires, value, self.next_cas, self.clock.seconds())
+        self.next_cas += 1
+        self.bytes += self._size(key, value)
+        self.counters["total_items"] += 1
+        while self.bytes > self.max_bytes and self.items:
+            evicted = next(iter(self.items))
+            self._remove(evicted)
+            self.counters["evictions"] += 1
+
+    def too_large(self, key, value):
+        return self._size(key, value) > self.item_size_max
+
+    def get(self, key):
+        """Item or None."""
+
+        self.counters["cmd_get"] += 1
+        item = self._live(key)
+        if item is None:
+            self.counters["get_misses"] += 1
+            return None
+        self.counters["get_hits"] += 1
+        self._touch_lru(key, item)
+        return item
+
+    def store(self, command, key, flags, exptime, value, cas=None):
+        """Execute storage command ("set", "add", "replace", "append", "prepend" or "cas").
+
+        :returns: reply: "STORED", "NOT_STORED", "EXISTS" or "NOT_FOUND"
+        """
+
+        self.counters["cmd_set"] += 1
+        item = self._live(key)
+        if command == "add" and item is not None:
+            self._touch_lru(key, item)
+            return "NOT_STORED"
+        if command in ("replace", "append", "prepend") and item is None:
+            return "NOT_STORED"
+        if command == "cas":
+            if item is None:
+                self.counters["cas_misses"] += 1
+                return "NOT_FOUND"
+            if item.cas != cas:
+                self.counters["cas_badval"] += 1
+                return "EXISTS"
+            self.counters["cas_hits"] += 1
+
+        if command == "append":
+            flags, expires, value = item.flags, item.expires, item.value + value
+        elif command == "prepend":
+            flags, expires, value = item.flags, item.expires, value + item.value
+        else:
+            expires = self._expires(exptime)
+        if self.too_large(key, value):
+            return "SERVER_ERROR object too large for cache"
+        self._put(key, flags, expires, value)
+        return "STORED"
+
+    def delete(self, key):
+        if self._live(key) is None:
+            self.counters["delete_misses"] += 1
+            return "NOT_FOUND"
+        self.counters["delete_hits"] += 1
+        self._remove(key)
+        return "DELETED"
+
+    def incr(self, command, key, delta):
+        """Execute "incr" or "decr". Values wrap at 2**64 on increment and stop at 0 on decrement."""
+
+        item = self._live(key)
+        if item is None:
+            self.counters[command + "_misses"] += 1
+            return "NOT_FOUND"
+        try:
+            number = int(item.value)
+        except ValueError:
+            return "CLIENT_ERROR cannot increment or decrement non-numeric value"
+        self.counters[command + "_hits"] += 1
+        if command == "incr":
+            number = (number + delta) % 2 ** 64
+        else:
+            number = max(number - delta, 0)
+        self._put(key, item.flags, item.expires, str(number))
+        return str(number)
+
+    def touch(self, key, exptime):
+        self.counters["cmd_touch"] += 1
+        item = self._live(key)
+        if item is None:
+            self.counters["touch_misses"] += 1
+            return "NOT_FOUND"
+        self.counters["touch_hits"] += 1
+        item.expires = self._expires(exptime)
+        return "TOUCHED"
+
+    def flush_all(self, delay=0):
+        """Invalidate all the items, now or after delay seconds."""
+
+        if delay <= 0:
+            self.items.clear()
+            self.bytes = 0
+        else:
+            self.flushed = self.clock.seconds() + delay
+
+    def stats(self):
+        """General statistics, as "stats" command returns them."""
+
+        now = self.clock.seconds()
+        stats = {
+            "pid": os.getpid(),
+            "uptime": int(now - self.started),
+            "time": int(now),
+            "version": VERSION,
+            "curr_items": len(self.items),
+            "bytes": self.bytes,
+            "limit_maxbytes": self.max_bytes,
+        }
+        stats.update(self.counters)
+        return stats
+
+    def settings(self):
+        return {"maxbytes": self.max_bytes, "item_size_max": self.item_size_max, "evictions": "on",
+                "cas_enabled": "yes"}
+
+
+class MemcachedProtocol(LineReceiver):
+    """Connection to :class:`MemcachedFactory`. Replies are sent in the order of commands,
+    even if their latencies differ.
+    """
+
+    delimiter = "\r\n"
+    MAX_LENGTH = 8 * 1024
+
+    def connectionMade(self):
+        self.pending = None
+        self.buffer = ""
+        self.ready = 0
+        self.hung = False
+        self.factory.connections += 1
+        self.factory.total_connections += 1
+
+    def connectionLost(self, reason):
+        self.factory.connections -= 1
+
+    def reply(self, lines):
+        """Send reply lines, after the injected latency."""
+
+        if self.hung:
+            return
+        data = "".join(line + "\r\n" for line in lines)
+        delay = self.factory.delay()
+        clock = self.factory.storage.clock
+        now = clock.seconds()
+        if delay <= 0 and self.ready <= now:
+            self.transport.write(data)
+            return
+        self.ready = max(self.ready, now + delay)
+        clock.callLater(self.ready - now, self._send, data)
+
+    def _send(self, data):
+        if not self.hung:
+            self.transport.write(data)
+
+    def _failed(self):
+        """Apply the injected failure, if the command must fail. Returns True if it has failed."""
+
+        mode = self.factory.failure()
+        if mode is None:
+            return False
+        if mode == "disconnect":
+            self.transport.loseConnection()
+        elif mode == "hang":
+            self.hung = True
+        else:
+            self.reply(["SERVER_ERROR injected failure"])
+        return True
+
+    def lineLengthExceeded(self, line):
+        self.reply(["CLIENT_ERROR line too long"])
+        self.transport.loseConnection()
+
+    def lineReceived(self, line):
+        parts = line.split()
+        if not parts:
+            return self.reply(["ERROR"])
+        command = parts[0]
+
+        if command in _STORAGE_COMMANDS:
+            argc = 6 if command == "cas" else 5
+            if len(parts) < argc or len(parts) > argc + 1 or not self._valid_key(parts[1]):
+                return self.reply(["CLIENT_ERROR bad command line format"])
+            try:
+                flags, exptime, length = int(parts[2]), int(parts[3]), int(parts[4])
+                cas = int(parts[5]) if command == "cas" else None
+            except ValueError:
+                return self.reply(["CLIENT_ERROR bad command line format"])
+            if length < 0:
+                return self.reply(["CLIENT_ERROR bad data chunk"])
+            noreply = len(parts) == argc + 1 and parts[-1] == "noreply"
+            self.pending = (command, parts[1], flags, exptime, length, cas, noreply)
+            self.buffer = ""
+            self.setRawMode()
+            return
+
+        handler = getattr(self, "cmd_" + command, None)
+        if handler is None:
+            return self.reply(["ERROR"])
+        if command not in ("quit", "version") and self._failed():
+            return
+        handler(parts[1:])
+
+    def rawDataReceived(self, data):
+        self.buffer += data
+        command, key, flags, exptime, length, cas, noreply = self.pending
+        if len(self.buffer) < length + 2:
+            return
+        value, terminator, rest = self.buffer[:length], self.buffer[length:length + 2], self.buffer[length + 2:]
+        self.pending = None
+        self.buffer = ""
+
+        if terminator != "\r\n":
+            self.reply(["CLIENT_ERROR bad data chunk"])
+        elif not self._failed():
+            result = self.factory.storage.store(command, key, flags, exptime, value, cas)
+            if not noreply:
+                self.reply([result])
+        self.setLineMode(rest)
+
+    def _valid_key(self, key):
+        return len(key) <= MAX_KEY_LENGTH
+
+    def _noreply(self, args):
+        if args and args[-1] == "noreply":
+            return args[:-1], True
+        return args, False
+
+    def _get(self, keys, with_cas):
+        if not keys or not all(self._valid_key(key) for key in keys):
+            return self.reply(["CLIENT_ERROR bad command line format"])
+        lines = []
+        for key in keys:
+            item = self.factory.storage.get(key)
+            if item is None:
+                continue
+            cas = " %d" % item.cas if with_cas else ""
+            lines.append("VALUE %s %d %d%s" % (key, item.flags, len(item.value), cas))
+            lines.append(item.value)
+        lines.append("END")
+        self.reply(lines)
+
+    def cmd_get(self, args):
+        self._get(args, False)
+
+    def cmd_gets(self, args):
+        self._get(args, True)
+
+    def cmd_delete(self, args):
+        args, noreply = self._noreply(args)
+        if len(args) != 1:
+            return self.reply(["CLIENT_ERROR bad command line format"])
+        result = self.factory.storage.delete(args[0])
+        if not noreply:
+            self.reply([result])
+
+    def _incr(self, command, args):
+        args, noreply = self._noreply(args)
+        try:
+            key, delta = args
+            delta = int(delta)
+        except ValueError:
+            delta = -1
+        if delta < 0:
+            return self.reply(["CLIENT_ERROR invalid numeric delta argument"])
+        result = self.factory.storage.incr(command, key, delta)
+        if not noreply:
+            self.reply([result])
+
+    def cmd_incr(self, args):
+        self._incr("incr", args)
+
+    def cmd_decr(self, args):
+        self._incr("decr", args)
+
+    def cmd_touch(self, args):
+        args, noreply = self._noreply(args)
+        try:
+            key, exptime = args[0], int(args[1])
+        except (IndexError, ValueError):
+            return self.reply(["CLIENT_ERROR bad command line format"])
+        result = self.factory.storage.touch(key, exptime)
+        if not noreply:
+            self.reply([result])
+
+    def cmd_flush_all(self, args):
+        args, noreply = self._noreply(args)
+        try:
+            delay = int(args[0]) if args else 0
+        except ValueError:
+            return self.reply(["CLIENT_ERROR bad command line format"])
+        self.factory.storage.flush_all(delay)
+        if not noreply:
+            self.reply(["OK"])
+
+    def cmd_stats(self, args):
+        if not args:
+            stats = self.factory.storage.stats()
+            stats["curr_connections"] = self.factory.connections
+            stats["total_connections"] = self.factory.total_connections
+        elif args == ["settings"]:
+            stats = self.factory.storage.settings()
+        elif args[0] in ("slabs", "items", "sizes", "conns"):
+            #There are no slab classes here: items are accounted by their exact size.
+            stats = {}
+        else:
+            return self.reply(["ERROR"])
+        self.reply(["STAT %s %s" % (name, value) for name, value in sorted(stats.iteritems())] + ["END"])
+
+    def cmd_version(self, args):
+        self.reply(["VERSION " + VERSION])
+
+    def cmd_verbosity(self, args):
+        args, noreply = self._noreply(args)
+        if not noreply:
+            self.reply(["OK"])
+
+    def cmd_quit(self, args):
+        self.transport.loseConnection()
+
+
+class MemcachedFactory(protocol.ServerFactory):
+    """Memcached server. Items are shared by all its connections.
+
+    :param max_bytes: Memory limit, see :class:`Storage`.
+    :param item_size_max: Maximal size of an item, see :class:`Storage`.
+    :param clock: Provider of IReactorTime for expiration and latency. By default, the reactor is used.
+    :param latency: Delay of every reply, in seconds, or function without arguments which returns it.
+    :param failure_rate: Probability of failure of every command.
+    :param failure_mode: How random failures manifest, one of :const:`FAILURE_MODES`.
+    :param seed: Seed of random failures.
+    """
+
+    protocol = MemcachedProtocol
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, item_size_max=DEFAULT_ITEM_SIZE_MAX, clock=None, latency=0,
+                 failure_rate=0, failure_mode="error", seed=None):
+        if failure_mode not in FAILURE_MODES:
+            raise ValueError("Unknown failure mode: %s" % failure_mode)
+        self.storage = Storage(max_bytes, item_size_max, clock)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_mode = failure_mode
+        self.random = random.Random(seed)
+        self.scheduled_failures = []
+        self.connections = 0
+        self.total_connections = 0
+
+    def delay(self):
+        """Latency of the next reply."""
+
+        return self.latency() if callable(self.latency) else self.latency
+
+    def fail(self, count=1, mode="error"):
+        """Make the next count commands fail."""
+
+        if mode not in FAILURE_MODES:
+            raise ValueError("Unknown failure mode: %s" % mode)
+        self.scheduled_failures.extend([mode] * count)
+
+    def failure(self):
+        """Failure mode for the next command, or None if it must succeed."""
+
+        if self.scheduled_failures:
+            return self.scheduled_failures.pop(0)
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            return self.failure_mode
+        return None
+
+
+def listen(port=0, interface="127.0.0.1", reactor=None, **kwargs):
+    """Start the server. Keyword arguments are passed to :class:`MemcachedFactory`.
+
+    :returns: pair (:class:`twisted.internet.interfaces.IListeningPort`, :class:`MemcachedFactory`).
+        Use port.getHost().port to find out the port chosen when port is 0.
+    """
+
+    if reactor is None:
+        from twisted.internet import reactor
+    factory = MemcachedFactory(**kwargs)
+    return reactor.listenTCP(port, factory, interface=interface), factory
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="In-process memcached server for tests and benchmarks.")
+    parser.add_argument("--port", type=int, default=11211)
+    parser.add_argument("--interface", default="127.0.0.1")
+    parser.add_argument("--max-bytes", type=int, default=DEFAULT_MAX_BYTES)
+    parser.add_argument("--latency", type=float, default=0, help="Delay of every reply, in milliseconds")
+    parser.add_argument("--failure-rate", type=float, default=0)
+    parser.add_argument("--failure-mode", choices=FAILURE_MODES, default="error")
+    options = parser.parse_args(argv)
+
+    from twisted.internet import reactor
+    log.startLogging(sys.stdout)
+    port, _ = listen(options.port, options.interface, max_bytes=options.max_bytes, latency=options.latency / 1000.0,
+                     failure_rate=options.failure_rate, failure_mode=options.failure_mode)
+    log.msg("txcaching memcached server listening on %s:%d" % (options.interface, port.getHost().port))
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
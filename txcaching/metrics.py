@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_left
+
+#Upper bounds of buckets of latency histograms, in seconds.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+#Upper bounds of buckets of value size histograms, in bytes.
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class Histogram(object):
+    """Histogram with fixed buckets. Recording a value doesn't allocate memory for new buckets,
+    so it is cheap enough for the hot path.
+    """
+
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def record(self, value):
+        """Add the value to the bucket with the least upper bound which is not less than the value."""
+
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def reset(self):
+        """Set all the counts to zero."""
+
+        for index in xrange(len(self.counts)):
+            self.counts[index] = 0
+        self.count = 0
+        self.sum = 0
+
+    def snapshot(self):
+        """Readable copy of the histogram.
+
+        :returns: dict with keys "buckets" (list of pairs (upper bound, cumulative count), the last bound
+            is infinity), "count" and "sum"
+        """
+
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return {"buckets": buckets, "count": self.count, "sum": self.sum}
+
+
+class FunctionMetrics(object):
+    """Metrics of one cached function.
+
+    hits, misses: lookups which have found / not found the value in cache.
+    local_hits: hits served from the in-process tier of hot keys (see :mod:`txcaching.hotkeys`), included in hits.
+    errors: lookups which have failed, so the function has been called without cache.
+    bypasses: calls which haven't been cached by policy (for example, a response is too large or marked as no-store).
+    adaptive_bypasses: calls which have skipped the cache, because looking it up costs more than calling the function
+    (see :mod:`txcaching.adaptive`).
+    bypass_ratio: current share of calls which skip the cache. It is a gauge, so reset keeps it.
+    lookup_latency: time from the start of the call to the response of memcached, in seconds.
+    recompute_latency: time the function has taken on cache misses and adaptive bypasses, in seconds.
+    value_size: sizes of cached values, in bytes.
+    """
+
+    __slots__ = ("hits", "misses", "local_hits", "errors", "bypasses", "adaptive_bypasses", "bypass_ratio",
+                 "lookup_latency", "recompute_latency", "value_size")
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.local_hits = 0
+        self.errors = 0
+        self.bypasses = 0
+        self.adaptive_bypasses = 0
+        self.bypass_ratio = 0.0
+        self.lookup_latency = Histogram(LATENCY_BUCKETS)
+        self.recompute_latency = Histogram(LATENCY_BUCKETS)
+        self.value_size = Histogram(SIZE_BUCKETS)
+
+    def reset(self):
+        """Set all the metrics to zero."""
+
+        self.hits = self.misses = self.local_hits = self.errors = self.bypasses = self.adaptive_bypasses = 0
+        self.lookup_latency.reset()
+        self.recompute_latency.reset()
+        self.value_size.reset()
+
+    def snapshot(self):
+        """Readable copy of the metrics."""
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "local_hits": self.local_hits,
+            "errors": self.errors,
+            "bypasses": self.bypasses,
+            "adaptive_bypasses": self.adaptive_bypasses,
+            "bypass_ratio": self.bypass_ratio,
+            "lookup_latency": self.lookup_latency.snapshot(),
+            "recompute_latency": self.recompute_latency.snapshot(),
+            "value_size": self.value_size.snapshot(),
+        }
+
+
+class OperationMetrics(object):
+    """Metrics of one memcached command: latency in seconds and the number of failed commands."""
+
+    __slots__ = ("latency", "errors")
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.errors = 0
+
+    def reset(self):
+        """Set all the metrics to zero."""
+
+        self.latency.reset()
+        self.errors = 0
+
+    def snapshot(self):
+        """Readable copy of the metrics."""
+
+        return {"latency": self.latency.snapshot(), "errors": self.errors}
+
+
+class PoolMetrics(object):
+    """Metrics of a pool of threads (see :mod:`txcaching.workers`).
+
+    queued: calls which are waiting for a thread.
+    running: calls which are running in threads.
+    completed: calls which have finished.
+    wait: time calls have waited for a thread, in seconds.
+    """
+
+    __slots__ = ("queued", "running", "completed", "wait")
+
+    def __init__(self):
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.wait = Histogram(LATENCY_BUCKETS)
+
+    def reset(self):
+        """Set the counters to zero. The numbers of queued and running calls are kept."""
+
+        self.completed = 0
+        self.wait.reset()
+
+    def snapshot(self):
+        """Readable copy of the metrics."""
+
+        return {"queued": self.queued, "running": self.running, "completed": self.completed,
+                "wait": self.wait.snapshot()}
+
+
+class Registry(object):
+    """Metrics of cached functions, keyed by :func:`txcaching.keyregistry.func_id`, metrics of memcached commands,
+    keyed by command name, metrics of thread pools, keyed by pool name, and the numbers of currently open
+    and of all opened connections to memcached.
+    """
+
+    def __init__(self):
+        self.functions = {}
+        self.operations = {}
+        self.pools = {}
+        self.connections_open = 0
+        self.connections_total = 0
+
+    def function(self, func_id):
+        """Metrics of the function. Decorators get them once, when they are applied."""
+
+        metrics = self.functions.get(func_id)
+        if metrics is None:
+            metrics = self.functions[func_id] = FunctionMetrics()
+        return metrics
+
+    def operation(self, name):
+        """Metrics of memcached command."""
+
+        metrics = self.operations.get(name)
+        if metrics is None:
+            metrics = self.operations[name] = OperationMetrics()
+        return metrics
+
+    def pool(self, name):
+        """Metrics of the thread pool."""
+
+        metrics = self.pools.get(name)
+        if metrics is None:
+            metrics = self.pools[name] = PoolMetrics()
+        return metrics
+
+    def snapshot(self):
+        """Readable copy of all the metrics.
+
+        :returns: dict with keys "functions" ({func_id: metrics}), "operations" ({command: metrics}),
+            "pools" ({pool name: metrics}) and "connections"
+        """
+
+        return {
+            "functions": {func_id: metrics.snapshot() for func_id, metrics in self.functions.iteritems()},
+            "operations": {name: metrics.snapshot() for name, metrics in self.operations.iteritems()},
+            "pools": {name: metrics.snapshot() for name, metrics in self.pools.iteritems()},
+            "connections": {"open": self.connections_open, "total": self.connections_total},
+        }
+
+    def reset(self):
+        """Set all the metrics to zero. The numbers of open connections and of queued and running calls are kept."""
+
+        for metrics in self.functions.itervalues():
+            metrics.reset()
+        for metrics in self.operations.itervalues():
+            metrics.reset()
+        for metrics in self.pools.itervalues():
+            metrics.reset()
+        self.connections_total = 0
+
+
+registry = Registry()
+
+
+def function(func_id):
+    """Metrics of the function in the default registry."""
+
+    return registry.function(func_id)
+
+
+def snapshot():
+    """Readable copy of all the metrics in the default registry."""
+
+    return registry.snapshot()
+
+
+def reset():
+    """Set all the metrics in the default registry to zero."""
+
+    registry.reset()
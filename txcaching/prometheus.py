@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+from twisted.web.resource import Resource
+
+from . import hotkeys, metrics
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    """Escape label value."""
+
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    """Format sample value."""
+
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _header(lines, name, kind, description):
+    lines.append("# HELP %s %s" % (name, description))
+    lines.append("# TYPE %s %s" % (name, kind))
+
+
+def _histogram(lines, name, label, value, histogram):
+    """Add samples of the histogram snapshot (see :meth:`txcaching.metrics.Histogram.snapshot`)."""
+
+    labels = '%s="%s"' % (label, _escape(value))
+    for bound, count in histogram["buckets"]:
+        lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, _number(float(bound)), count))
+    lines.append("%s_sum{%s} %s" % (name, labels, _number(histogram["sum"])))
+    lines.append("%s_count{%s} %d" % (name, labels, histogram["count"]))
+
+
+def render(registry=None):
+    """Format the metrics in Prometheus text format.
+
+    :param registry: :class:`txcaching.metrics.Registry`. By default, the default registry is used.
+
+    :returns: str
+    """
+
+    snapshot = (registry or metrics.registry).snapshot()
+    functions = sorted(snapshot["functions"].iteritems())
+    operations = sorted(snapshot["operations"].iteritems())
+    lines = []
+
+    for counter, description in [
+        ("hits", "Lookups which have found the value in cache."),
+        ("misses", "Lookups which have not found the value in cache."),
+        ("local_hits", "Hits served from the in-process tier of hot keys."),
+        ("errors", "Lookups which have failed, so the function has been called without cache."),
+        ("bypasses", "Calls whose results have not been cached by policy."),
+        ("adaptive_bypasses", "Calls which have skipped the cache, because it is slower than the function."),
+    ]:
+        name = "txcaching_function_%s_total" % counter
+        _header(lines, name, "counter", description)
+        for func_id, function_metrics in functions:
+            lines.append('%s{function="%s"} %d' % (name, _escape(func_id), function_metrics[counter]))
+
+    _header(lines, "txcaching_function_hit_ratio", "gauge", "Share of successful lookups which have found the value.")
+    for func_id, function_metrics in functions:
+        lookups = function_metrics["hits"] + function_metrics["misses"]
+        ratio = float(function_metrics["hits"]) / lookups if lookups else 0.0
+        lines.append('txcaching_function_hit_ratio{function="%s"} %s' % (_escape(func_id), _number(ratio)))
+
+    _header(lines, "txcaching_function_bypass_ratio", "gauge", "Current share of calls which skip the cache.")
+    for func_id, function_metrics in functions:
+        lines.append('txcaching_function_bypass_ratio{function="%s"} %s' %
+                     (_escape(func_id), _number(function_metrics["bypass_ratio"])))
+
+    for histogram, unit, description in [
+        ("lookup_latency", "seconds", "Time from the call to the response of memcached."),
+        ("recompute_latency", "seconds", "Time the function has taken on cache misses and bypasses."),
+        ("value_size", "bytes", "Sizes of cached values."),
+    ]:
+        name = "txcaching_function_%s_%s" % (histogram, unit)
+        _header(lines, name, "histogram", description)
+        for func_id, function_metrics in functions:
+            _histogram(lines, name, "function", func_id, function_metrics[histogram])
+
+    name = "txcaching_memcached_operation_latency_seconds"
+    _header(lines, name, "histogram", "Latency of memcached commands.")
+    for operation, operation_metrics in operations:
+        _histogram(lines, name, "operation", operation, operation_metrics["latency"])
+
+    name = "txcaching_memcached_operation_errors_total"
+    _header(lines, name, "counter", "Failed memcached commands.")
+    for operation, operation_metrics in operations:
+        lines.append('%s{operation="%s"} %d' % (name, _escape(operation), operation_metrics["errors"]))
+
+    pools = sorted(snapshot["pools"].iteritems())
+    for gauge, description in [
+        ("queued", "Calls which are waiting for a thread."),
+        ("running", "Calls which are running in threads."),
+    ]:
+        name = "txcaching_pool_%s" % gauge
+        _header(lines, name, "gauge", description)
+        for pool, pool_metrics in pools:
+            lines.append('%s{pool="%s"} %d' % (name, _escape(pool), pool_metrics[gauge]))
+
+    name = "txcaching_pool_completed_total"
+    _header(lines, name, "counter", "Calls which have finished in threads.")
+    for pool, pool_metrics in pools:
+        lines.append('%s{pool="%s"} %d' % (name, _escape(pool), pool_metrics["completed"]))
+
+    name = "txcaching_pool_wait_seconds"
+    _header(lines, name, "histogram", "Time calls have waited for a thread.")
+    for pool, pool_metrics in pools:
+        _histogram(lines, name, "pool", pool, pool_metrics["wait"])
+
+    _header(lines, "txcaching_memcached_connections_open", "gauge", "Currently open connections to memcached.")
+    lines.append("txcaching_memcached_connections_open %d" % snapshot["connections"]["open"])
+    _header(lines, "txcaching_memcached_connections_total", "counter", "Opened connections to memcached.")
+    lines.append("txcaching_memcached_connections_total %d" % snapshot["connections"]["total"])
+
+    detector = hotkeys.detector
+    if detector is not None and detector.local_tier is not None:
+        _header(lines, "txcaching_local_tier_items", "gauge", "Values of hot keys in the in-process tier.")
+        lines.append("txcaching_local_tier_items %d" % len(detector.local_tier))
+
+    lines.append("")
+    return "\n".join(lines)
+
+
+class MetricsResource(Resource):
+    """Resource which exposes txcaching metrics in Prometheus text format. Mount it in your site, for example:
+
+        root.putChild("metrics", MetricsResource())
+
+    :param registry: :class:`txcaching.metrics.Registry`. By default, the default registry is used.
+    """
+
+    isLeaf = True
+
+    def __init__(self, registry=None):
+        Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", CONTENT_TYPE)
+        return render(self.registry)
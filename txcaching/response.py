@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+import cPickle as pickle
+import hashlib
+import time
+import zlib
+
+from twisted.internet.interfaces import IPushProducer
+from twisted.web import http
+from zope.interface import implementer
+
+DEFAULT_CACHED_HEADERS = (
+    "Content-Type",
+    "Content-Language",
+    "Content-Disposition",
+    "Cache-Control",
+    "Expires",
+    "Last-Modified",
+    "Location",
+)
+
+#Bodies shorter than this are not compressed: gzip overhead outweighs the gain.
+MIN_COMPRESSED_SIZE = 256
+
+#Memcached treats expiration times longer than 30 days as absolute Unix time.
+MAX_RELATIVE_EXPIRE_TIME = 30 * 24 * 60 * 60
+
+#Bodies larger than this are streamed to the client by :class:`BodyProducer`, slice by slice.
+STREAMED_SIZE = 64 * 1024
+
+CachedResponse = namedtuple("CachedResponse", ["code", "headers", "body", "etag", "last_modified", "variants"])
+
+
+def _gzip(body):
+    """Compress body to gzip format."""
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+#Content codings available for pre-compressed variants of cached bodies.
+ENCODERS = {
+    "gzip": _gzip,
+}
+
+
+def _etag(body):
+    """Strong entity tag of the body."""
+
+    return '"%s"' % hashlib.sha1(body).hexdigest()
+
+
+def _parse_date(value):
+    """Parse HTTP date to seconds since epoch. Returns None if the date is malformed."""
+
+    try:
+        return http.stringToDatetime(value)
+    except (ValueError, IndexError, KeyError):
+        return None
+
+
+def _last_modified(request):
+    """Value of Last-Modified header set by render_GET (in seconds since epoch), or the current time."""
+
+    values = request.responseHeaders.getRawHeaders("Last-Modified")
+    last_modified = _parse_date(values[-1]) if values else None
+    if last_modified is None:
+        return int(time.time())
+    return last_modified
+
+
+def check_encodings(encodings):
+    """Raise ValueError if some of content codings are not supported."""
+
+    unknown = [encoding for encoding in encodings if encoding not in ENCODERS]
+    if unknown:
+        raise ValueError("Unsupported content codings: %s" % ", ".join(unknown))
+
+
+def compressible(request, body, encodings):
+    """Content codings to compress the body with: none for short bodies and for bodies which render_GET
+    has encoded itself.
+    """
+
+    if not encodings or len(body) < MIN_COMPRESSED_SIZE or request.responseHeaders.hasHeader("Content-Encoding"):
+        return ()
+    return tuple(encodings)
+
+
+def compress(body, encodings):
+    """Pre-compressed variants of the body: tuple of pairs (content coding, compressed body).
+    It doesn't touch the request, so it may run in a thread.
+    """
+
+    variants = []
+    for encoding in encodings:
+        compressed = ENCODERS[encoding](body)
+        if len(compressed) < len(body):
+            variants.append((encoding, compressed))
+    return tuple(variants)
+
+
+def capture(request, body, header_names=DEFAULT_CACHED_HEADERS, code=200, encodings=(), variants=None):
+    """Form the cached response from the body and the headers that render_GET has set on the request.
+    The content hash of the body is stored as ETag to answer conditional requests.
+
+    :param request: Request the response has been rendered for
+    :param body: Response body (str)
+    :param header_names: Names of response headers to store. Other headers are not cached.
+    :param code: Response status code
+    :param encodings: Content codings (keys of :const:`ENCODERS`) to store compressed variants of the body for.
+        The body is compressed once here, and the variant is chosen by Accept-Encoding header on every hit.
+    :param variants: Variants already compressed by :func:`compress`. If they are given, encodings are ignored.
+
+    :returns: :class:`CachedResponse`
+    """
+
+    headers = []
+    for name in header_names:
+        values = request.responseHeaders.getRawHeaders(name)
+        if values:
+            headers.append((name, tuple(values)))
+    if variants is None:
+        variants = compress(body, compressible(request, body, encodings))
+    return CachedResponse(code, tuple(headers), body, _etag(body), _last_modified(request), variants)
+
+
+def _cache_control(request):
+    """Parse Cache-Control response header into dictionary {directive: argument}."""
+
+    directives = {}
+    for value in request.responseHeaders.getRawHeaders("Cache-Control", ()):
+        for directive in value.split(","):
+            name, _, argument = directive.partition("=")
+            directives[name.strip().lower()] = argument.strip().strip('"')
+    return directives
+
+
+def expire_time(request, default=0):
+    """Lifetime of the response in memcached derived from Cache-Control (s-maxage or max-age) or Expires header
+    that render_GET has set.
+
+    :param default: Lifetime for responses which don't define their freshness.
+
+    :returns: expireTime for memcached, or None if the response must not be cached: it is marked
+        as no-store, private or no-cache, or it is already stale.
+    """
+
+    directives = _cache_control(request)
+    if "no-store" in directives or "private" in directives or "no-cache" in directives:
+        return None
+
+    now = int(time.time())
+    if "s-maxage" in directives or "max-age" in directives:
+        try:
+            seconds = int(directives.get("s-maxage", directives.get("max-age")))
+        except ValueError:
+            return None
+    else:
+        expires = request.responseHeaders.getRawHeaders("Expires")
+        if not expires:
+            return default
+        expires = _parse_date(expires[-1])
+        if expires is None:
+            return None
+        seconds = expires - now
+
+    if seconds <= 0:
+        return None
+    if seconds > MAX_RELATIVE_EXPIRE_TIME:
+        return now + seconds
+    return seconds
+
+
+def dumps(response):
+    """Serialize :class:`CachedResponse` to store it in memcached."""
+
+    return pickle.dumps(tuple(response), pickle.HIGHEST_PROTOCOL)
+
+
+def loads(value):
+    """Deserialize :class:`CachedResponse`.
+
+    :returns: :class:`CachedResponse` or None if the value has not been stored by :func:`dumps`
+        (for example, it has been cached by an older version of the library).
+    """
+
+    try:
+        return CachedResponse(*pickle.loads(value))
+    except Exception:
+        return None
+
+
+def not_modified(request, etag, last_modified):
+    """Check if the client already has the cached response, using If-None-Match or If-Modified-Since header.
+    If-Modified-Since is ignored when If-None-Match is present.
+    """
+
+    if_none_match = request.getHeader("If-None-Match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags or "W/" + etag in tags
+
+    if_modified_since = request.getHeader("If-Modified-Since")
+    if if_modified_since:
+        since = _parse_date(if_modified_since)
+        return since is not None and last_modified <= since
+    return False
+
+
+def _accepted_encodings(accept_encoding):
+    """Parse Accept-Encoding header into dictionary {content coding: quality value}."""
+
+    accepted = {}
+    for item in accept_encoding.split(","):
+        params = item.split(";")
+        encoding = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if encoding:
+            accepted[encoding] = quality
+    return accepted
+
+
+def negotiate(request, variants):
+    """Choose the pre-compressed variant acceptable by the client.
+
+    :returns: pair (content coding, compressed body) or None if the identity body must be sent.
+    """
+
+    accept_encoding = request.getHeader("Accept-Encoding") if variants else None
+    if not accept_encoding:
+        return None
+
+    accepted = _accepted_encodings(accept_encoding)
+    default = accepted.get("*", 0.0)
+    best, best_quality = None, 0.0
+    for variant in variants:
+        quality = accepted.get(variant[0], default)
+        if quality > best_quality:
+            best, best_quality = variant, quality
+    return best
+
+
+@implementer(IPushProducer)
+class BodyProducer(object):
+    """Streams the cached body to the request in slices, so that the transport doesn't buffer the whole body
+    when the client is slow. Writing is paused while the transport's buffer is full.
+    This class is not to be used directly.
+    """
+
+    def __init__(self, request, body, slice_size=STREAMED_SIZE):
+        self.request = request
+        self.body = memoryview(body)
+        self.slice_size = slice_size
+        self.offset = 0
+        self.paused = False
+        self.producing = False
+        self.stopped = False
+
+    def start(self):
+        """Register the producer and write the body. The request is finished when the whole body is written."""
+
+        self.request.registerProducer(self, True)
+        self.request.notifyFinish().addErrback(lambda failure: self.stopProducing())
+        if not self.paused:
+            self._produce()
+
+    def _produce(self):
+        #Transport may pause the producer during write, and resumeProducing may be called during write as well.
+        if self.producing:
+            return
+        self.producing = True
+        try:
+            while not (self.paused or self.stopped) and self.offset < len(self.body):
+                end = self.offset + self.slice_size
+                data = self.body[self.offset:end].tobytes()
+                self.offset = end
+                self.request.write(data)
+        finally:
+            self.producing = False
+
+        if not self.stopped and self.offset >= len(self.body):
+            self.stopped = True
+            self.request.unregisterProducer()
+            self.request.finish()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._produce()
+
+    def stopProducing(self):
+        self.stopped = True
+        self.body = None
+
+
+def write_body(request, body):
+    """Write the body to the request and finish it. Large bodies are streamed by :class:`BodyProducer`."""
+
+    request.responseHeaders.setRawHeaders("Content-Length", [str(len(body))])
+    if len(body) > STREAMED_SIZE:
+        BodyProducer(request, body).start()
+    else:
+        request.write(body)
+        request.finish()
+
+
+def _byte_range(range_header, size):
+    """Parse Range header with a single byte range.
+
+    :returns: pair (first byte, last byte), None if the header must be ignored (it is malformed,
+        has other units or several ranges) or False if the range can't be satisfied.
+    """
+
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+    first, separator, last = ranges.strip().partition("-")
+    if not separator:
+        return None
+
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0 or size == 0:
+                return False
+            return max(size - suffix, 0), size - 1
+        first = int(first)
+        last = int(last) if last else None
+    except ValueError:
+        return None
+
+    if last is None:
+        last = size - 1
+    elif first > last:
+        return None
+    if first >= size:
+        return False
+    return first, min(last, size - 1)
+
+
+def _if_range(request, etag, last_modified):
+    """Check If-Range header: Range must be ignored if the client has another version of the response."""
+
+    if_range = request.getHeader("If-Range")
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range == etag
+    return _parse_date(if_range) == last_modified
+
+
+def replay(request, response, vary=()):
+    """Write the cached response to the request and finish it.
+    If the client already has the response, answer 304 without the body.
+    If the client accepts one of pre-compressed variants, it is sent instead of the identity body.
+    HEAD requests are answered without the body, and GET requests with a byte range are answered
+    with 206 and the part of the identity body.
+
+    :param vary: Names of request headers the response depends on, to list in Vary header.
+    """
+
+    if response.code != 200:
+        request.setResponseCode(response.code)
+    for name, values in response.headers:
+        request.responseHeaders.setRawHeaders(name, list(values))
+    if vary:
+        request.responseHeaders.addRawHeader("Vary", ", ".join(vary))
+
+    body = response.body
+    if response.code == 200:
+        etag = response.etag
+        range_header = request.getHeader("Range") if request.method == "GET" else None
+        request.responseHeaders.setRawHeaders("Accept-Ranges", ["bytes"])
+        if response.variants:
+            request.responseHeaders.addRawHeader("Vary", "Accept-Encoding")
+            variant = negotiate(request, response.variants) if range_header is None else None
+            if variant is not None:
+                encoding, body = variant
+                etag = '%s-%s"' % (etag[:-1], encoding)
+                request.responseHeaders.setRawHeaders("Content-Encoding", [encoding])
+
+        request.responseHeaders.setRawHeaders("ETag", [etag])
+        request.responseHeaders.setRawHeaders("Last-Modified", [http.datetimeToString(response.last_modified)])
+        if not_modified(request, etag, response.last_modified):
+            request.setResponseCode(http.NOT_MODIFIED)
+            request.finish()
+            return
+
+        byte_range = None
+        if range_header is not None and _if_range(request, etag, response.last_modified):
+            byte_range = _byte_range(range_header, len(body))
+        if byte_range is False:
+            request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+            request.responseHeaders.setRawHeaders("Content-Range", ["bytes */%d" % len(body)])
+            request.responseHeaders.setRawHeaders("Content-Length", ["0"])
+            request.finish()
+            return
+        if byte_range is not None:
+            first, last = byte_range
+            request.setResponseCode(http.PARTIAL_CONTENT)
+            request.responseHeaders.setRawHeaders("Content-Range", ["bytes %d-%d/%d" % (first, last, len(body))])
+            body = body[first:last + 1]
+
+    if request.method == "HEAD":
+        request.responseHeaders.setRawHeaders("Content-Length", [str(len(body))])
+        request.finish()
+        return
+
+    write_body(request, body)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Serialization and compression of cached values without long stalls of the reactor.
+
+Values are pickled with the binary protocol: it is several times faster than the default text protocol
+for large values, in both directions. cPickle holds the GIL for the whole call, so pickling stays
+in the reactor thread: a thread would not let the reactor run meanwhile.
+
+Compression releases the GIL, so bodies of at least config.threshold bytes are compressed in a pool of threads
+(see :func:`configure`), and the result is delivered back in the reactor thread. Smaller bodies are compressed
+right away.
+"""
+
+from collections import namedtuple
+import cPickle as pickle
+
+from twisted.internet import defer
+
+from . import response, workers
+
+PROTOCOL = pickle.HIGHEST_PROTOCOL
+
+Config = namedtuple("Config", ["threshold", "threads"])
+default_config = Config(threshold=64 * 1024, threads=2)
+config = default_config
+
+_pool = None
+
+
+def configure(**kwargs):
+    """Change the configuration. Parameters which are not passed keep their values.
+
+    :param threshold: Bodies of at least this size (in bytes) are compressed in threads.
+        If it is 0, all the bodies are compressed in threads.
+    :param threads: Number of threads in the pool "serialization" (see :class:`txcaching.workers.Pool`).
+    """
+
+    global config, _pool
+    config = config._replace(**kwargs)
+    if _pool is not None:
+        _pool.stop()
+        _pool = None
+
+
+def pool():
+    """Pool of threads for large bodies."""
+
+    global _pool
+    if _pool is None:
+        _pool = workers.Pool("serialization", size=config.threads)
+    return _pool
+
+
+def dumps(value):
+    """Pickle the cached value."""
+
+    return pickle.dumps(value, PROTOCOL)
+
+
+def loads(value):
+    """Unpickle the cached value. Values pickled with any protocol are read."""
+
+    return pickle.loads(value)
+
+
+def call(size, func, *args, **kwargs):
+    """Call the function in a thread, if size is at least config.threshold, or right away otherwise.
+
+    :returns: Deferred which fires in the reactor thread with the result of the function
+    """
+
+    if size < config.threshold:
+        return defer.maybeDeferred(func, *args, **kwargs)
+    return pool().run(func, *args, **kwargs)
+
+
+def compress(request, body, encodings):
+    """Pre-compressed variants of the body, see :func:`txcaching.response.compress`.
+
+    :returns: Deferred which fires with tuple of pairs (content coding, compressed body)
+    """
+
+    encodings = response.compressible(request, body, encodings)
+    if not encodings:
+        return defer.succeed(())
+    return call(len(body), response.compress, body, encodings)
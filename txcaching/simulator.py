@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""Offline cache simulator. It replays a trace recorded by :mod:`txcaching.accesstrace` against an alternative
+configuration (local L1 cache size and policy, memcached memory, TTL per function, compression)
+and projects hit ratio and backend load:
+
+    python -m txcaching.simulator trace.bin --l1-size 1000 --l1-policy lfu --ttl 300 --compression
+"""
+
+from collections import OrderedDict
+import argparse
+import heapq
+import json
+import sys
+
+from . import accesstrace
+
+POLICIES = ("lru", "lfu", "fifo")
+
+#Values smaller than this are not compressed (see :const:`txcaching.response.MIN_COMPRESSED_SIZE`).
+MIN_COMPRESSED_SIZE = 256
+
+
+class _Entry(object):
+    __slots__ = ("expires", "size", "count", "seq")
+
+    def __init__(self, expires, size, seq):
+        self.expires = expires
+        self.size = size
+        self.count = 1
+        self.seq = seq
+
+
+class SimulatedCache(object):
+    """Cache bounded either by the number of items or, if by_size is true, by their total size.
+
+    :param capacity: Maximal number of items (or bytes). 0 means unlimited.
+    :param policy: Eviction policy, one of :const:`POLICIES`.
+    """
+
+    def __init__(self, capacity, policy="lru", by_size=False):
+        if policy not in POLICIES:
+            raise ValueError("Unknown policy: %s" % policy)
+        self.capacity = capacity
+        self.policy = policy
+        self.by_size = by_size
+        self.entries = OrderedDict()
+        self.used = 0
+        self.evictions = 0
+        self.heap = []
+        self.seq = 0
+
+    def _cost(self, entry):
+        return entry.size if self.by_size else 1
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.used -= self._cost(entry)
+
+    def get(self, key, now):
+        """Check the key at time now, updating the policy state. Returns True on hit."""
+
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        if entry.expires and entry.expires <= now:
+            self._remove(key)
+            return False
+        if self.policy == "lru":
+            del self.entries[key]
+            self.entries[key] = entry
+        elif self.policy == "lfu":
+            entry.count += 1
+            self._push(key, entry)
+        return True
+
+    def _push(self, key, entry):
+        self.seq += 1
+        entry.seq = self.seq
+        heapq.heappush(self.heap, (entry.count, entry.seq, key))
+
+    def _victim(self):
+        if self.policy != "lfu":
+            return next(iter(self.entries))
+        while True:
+            count, seq, key = heapq.heappop(self.heap)
+            entry = self.entries.get(key)
+            if entry is not None and entry.seq == seq:
+                return key
+
+    def put(self, key, size, expires):
+        """Store the item, evicting others if the cache is full. Items larger than the whole cache are not stored."""
+
+        if key in self.entries:
+            self._remove(key)
+        entry = _Entry(expires, size, 0)
+        if self.capacity and self._cost(entry) > self.capacity:
+            return
+        self.entries[key] = entry
+        self.used += self._cost(entry)
+        if self.policy == "lfu":
+            self._push(key, entry)
+        while self.capacity and self.used > self.capacity:
+            self._remove(self._victim())
+            self.evictions += 1
+
+
+def _profiles(events):
+    """Mean value size and compute cost of every key and every function, from all the events of the trace."""
+
+    keys = {}
+    functions = {}
+    for event in events:
+        if event.kind == accesstrace.ERROR:
+            continue
+        for profiles, name in ((keys, event.key), (functions, event.function)):
+            profile = profiles.setdefault(name, [0, 0, 0.0, 0])
+            if event.size:
+                profile[0] += event.size
+                profile[1] += 1
+            if event.kind == accesstrace.COMPUTE:
+                profile[2] += event.cost
+                profile[3] += 1
+
+    def means(profile):
+        return (float(profile[0]) / profile[1] if profile[1] else None,
+                profile[2] / profile[3] if profile[3] else None)
+
+    return ({key: means(profile) for key, profile in keys.iteritems()},
+            {function: means(profile) for function, profile in functions.iteritems()})
+
+
+def simulate(events, l1_size=0, l1_policy="lru", memcached_bytes=0, ttl=0, ttls=None, compression=False,
+             compression_ratio=0.4, compress_speed=50e6, decompress_speed=250e6):
+    """Replay lookups of the trace.
+
+    :param events: :class:`txcaching.accesstrace.Event` in the order of time
+    :param l1_size: Number of items in the local cache in front of memcached. 0 disables it.
+    :param l1_policy: Eviction policy of the local cache, one of :const:`POLICIES`.
+    :param memcached_bytes: Memory of memcached (LRU). 0 means unlimited.
+    :param ttl: Lifetime of items in seconds, 0 means unlimited.
+    :param ttls: Dictionary {function id: lifetime} overriding ttl for particular functions.
+    :param compression: If it is true, values are stored compressed: they take less memory,
+        but compression and decompression cost CPU time.
+    :param compression_ratio: Compressed size relative to the original one.
+    :param compress_speed, decompress_speed: Bytes per second.
+
+    :returns: dict of projected figures
+    """
+
+    events = list(events)
+    key_profiles, function_profiles = _profiles(events)
+    ttls = ttls or {}
+    l1 = SimulatedCache(l1_size, l1_policy) if l1_size else None
+    memcached = SimulatedCache(memcached_bytes, "lru", by_size=True)
+    counters = dict.fromkeys(["lookups", "l1_hits", "memcached_hits", "misses", "recorded_hits",
+                              "memcached_bytes_read", "memcached_bytes_written"], 0)
+    backend_seconds = compression_seconds = 0.0
+
+    for event in events:
+        if event.kind == accesstrace.COMPUTE:
+            continue
+        counters["lookups"] += 1
+        if event.kind == accesstrace.HIT:
+            counters["recorded_hits"] += 1
+        now = event.timestamp
+        if l1 is not None and l1.get(event.key, now):
+            counters["l1_hits"] += 1
+            continue
+
+        size, cost = key_profiles.get(event.key, (None, None))
+        function_size, function_cost = function_profiles.get(event.function, (None, None))
+        size = int(size if size is not None else function_size or 0)
+        cost = cost if cost is not None else function_cost or 0.0
+        stored_size = size
+        if compression and size >= MIN_COMPRESSED_SIZE:
+            stored_size = max(1, int(size * compression_ratio))
+        lifetime = ttls.get(event.function, ttl)
+        expires = now + lifetime if lifetime else 0
+
+        if memcached.get(event.key, now):
+            counters["memcached_hits"] += 1
+            counters["memcached_bytes_read"] += stored_size
+            if stored_size != size:
+                compression_seconds += size / decompress_speed
+        else:
+            counters["misses"] += 1
+            backend_seconds += cost
+            counters["memcached_bytes_written"] += stored_size
+            if stored_size != size:
+                compression_seconds += size / compress_speed
+            memcached.put(event.key, stored_size, expires)
+        if l1 is not None:
+            l1.put(event.key, size, expires)
+
+    lookups = counters["lookups"]
+    timestamps = [event.timestamp for event in events]
+    duration = max(timestamps) - min(timestamps) if timestamps else 0
+
+    def ratio(value, total):
+        return float(value) / total if total else 0.0
+
+    result = dict(counters)
+    result.update({
+        "hit_ratio": ratio(counters["l1_hits"] + counters["memcached_hits"], lookups),
+        "l1_hit_ratio": ratio(counters["l1_hits"], lookups),
+        "recorded_hit_ratio": ratio(counters["recorded_hits"], lookups),
+        "backend_calls": counters["misses"],
+        "backend_seconds": backend_seconds,
+        "backend_calls_per_second": ratio(counters["misses"], duration),
+        "backend_load": ratio(backend_seconds, duration),
+        "compression_seconds": compression_seconds,
+        "memcached_evictions": memcached.evictions,
+        "l1_evictions": l1.evictions if l1 is not None else 0,
+        "duration": duration,
+    })
+    return result
+
+
+def _size(value):
+    """Parse size with optional suffix K, M or G."""
+
+    multipliers = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    value = value.strip().upper()
+    if value and value[-1] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+    return int(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay txcaching trace against alternative configuration.")
+    parser.add_argument("trace", help="Trace recorded by txcaching.accesstrace")
+    parser.add_argument("--l1-size", type=int, default=0, help="Items in the local cache (0 disables it)")
+    parser.add_argument("--l1-policy", choices=POLICIES, default="lru")
+    parser.add_argument("--memcached-bytes", type=_size, default=0, help="Memory of memcached, e.g. 64M (0: unlimited)")
+    parser.add_argument("--ttl", type=int, default=0, help="Lifetime of items in seconds (0: unlimited)")
+    parser.add_argument("--function-ttl", action="append", default=[], metavar="FUNCTION=SECONDS",
+                        help="Lifetime of items of the function (repeatable)")
+    parser.add_argument("--compression", action="store_true")
+    parser.add_argument("--compression-ratio", type=float, default=0.4)
+    options = parser.parse_args(argv)
+
+    ttls = {}
+    for item in options.function_ttl:
+        function, _, seconds = item.rpartition("=")
+        ttls[function] = int(seconds)
+
+    result = simulate(accesstrace.read(options.trace), options.l1_size, options.l1_policy, options.memcached_bytes,
+                      options.ttl, ttls, options.compression, options.compression_ratio)
+    json.dump(result, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+
+from twisted.internet import defer, protocol, reactor
+from twisted.python import log
+
+from . import cache
+from .connection import CacheProtocol
+
+#Statistics of one memcached server: "stats", "stats slabs", "stats items" and "stats settings".
+#slabs and items are dictionaries {slab class id: {field: value}}, slab_totals has the rest of "stats slabs".
+ServerStats = namedtuple("ServerStats", ["server", "general", "slabs", "slab_totals", "items", "settings"])
+
+#Figures compared across servers by :func:`summary`.
+SKEW_FIELDS = ("cmd_get", "bytes", "curr_items", "evictions")
+
+_BOOLEANS = {"yes": True, "on": True, "true": True, "no": False, "off": False, "false": False}
+
+
+def _typed(value):
+    """Convert the value of statistic to int, float or bool. Other values (versions, paths) are kept as str."""
+
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return _BOOLEANS.get(value.lower(), value)
+
+
+def parse(raw):
+    """Parse the dictionary returned by :meth:`twisted.protocols.memcache.MemCacheProtocol.stats`."""
+
+    return {name: _typed(value) for name, value in raw.iteritems()}
+
+
+def parse_slabs(raw):
+    """Parse "stats slabs" to pair ({slab class id: {field: value}}, {field: value}).
+    Per-class fields look like "1:chunk_size", totals like "active_slabs".
+    """
+
+    classes = {}
+    totals = {}
+    for name, value in raw.iteritems():
+        slab_class, separator, field = name.partition(":")
+        if separator and slab_class.isdigit():
+            classes.setdefault(int(slab_class), {})[field] = _typed(value)
+        else:
+            totals[name] = _typed(value)
+    return classes, totals
+
+
+def parse_items(raw):
+    """Parse "stats items" (fields look like "items:1:number") to dictionary {slab class id: {field: value}}."""
+
+    classes = {}
+    for name, value in raw.iteritems():
+        parts = name.split(":", 2)
+        if len(parts) == 3 and parts[1].isdigit():
+            classes.setdefault(int(parts[1]), {})[parts[2]] = _typed(value)
+    return classes
+
+
+def query(proto):
+    """Query all the statistics from the server. The commands are pipelined in one connection.
+
+    :param proto: Connected :class:`txcaching.connection.CacheProtocol`
+
+    :returns: Deferred which fires with :class:`ServerStats`
+    """
+
+    def combine(results):
+        general, slabs, items, settings = results
+        slab_classes, slab_totals = parse_slabs(slabs)
+        return ServerStats(getattr(proto, "server", None), parse(general), slab_classes, slab_totals,
+                           parse_items(items), parse(settings))
+
+    return defer.gatherResults([proto.stats(), proto.stats("slabs"), proto.stats("items"), proto.stats("settings")],
+                               consumeErrors=True).addCallback(combine)
+
+
+def _connect(server):
+    """Connect to the server given as "host:port" or as the path of the Unix socket."""
+
+    creator = protocol.ClientCreator(reactor, CacheProtocol)
+    if server.startswith("/"):
+        return creator.connectUNIX(server)
+    host, _, port = server.rpartition(":")
+    return creator.connectTCP(host, int(port))
+
+
+def _query_server(d):
+    """Query the server connected by the Deferred and close the connection."""
+
+    def query_and_close(proto):
+        return query(proto).addBoth(cache._close_connection, proto)
+
+    return d.addCallback(query_and_close)
+
+
+def collect(servers=None, client=None):
+    """Query statistics of the servers in parallel. Servers which have failed to answer are logged and skipped.
+
+    :param servers: Addresses of servers ("host:port" or paths of Unix sockets).
+        By default, the server of the client is queried.
+    :param client: :class:`txcaching.cache.CacheClient`. By default, the client configured
+        by :func:`txcaching.cache.load_config`.
+
+    :returns: Deferred which fires with list of :class:`ServerStats`
+    """
+
+    if servers is None:
+        queries = [_query_server((client or cache.default_client).connect())]
+    else:
+        queries = [_query_server(_connect(server)) for server in servers]
+
+    def answered(results):
+        collected = []
+        for success, result in results:
+            if success:
+                collected.append(result)
+            else:
+                log.err(result, "txcaching: failed to collect memcached statistics")
+        return collected
+
+    return defer.DeferredList(queries, consumeErrors=True).addCallback(answered)
+
+
+def _ratio(numerator, denominator):
+    return float(numerator) / denominator if denominator else 0.0
+
+
+def derive(stats):
+    """Figures to resize the cluster and tune the slab growth factor by.
+
+    hit_ratio: share of get commands which have found the item.
+    eviction_rate: evictions per second, averaged over the uptime.
+    memory_fill: share of memory limit used by items.
+    slabs: {slab class id: {"chunk_size", "fill" (share of allocated chunks used), "efficiency" (share of used
+    chunk memory occupied by items, lower values mean the growth factor is too large), "evicted", "evicted_rate"
+    (evictions of the class per second)}}.
+
+    :param stats: :class:`ServerStats`
+
+    :returns: dict
+    """
+
+    general = stats.general
+    uptime = general.get("uptime", 0)
+    slabs = {}
+    for slab_class, fields in stats.slabs.iteritems():
+        chunk_size = fields.get("chunk_size", 0)
+        used_chunks = fields.get("used_chunks", 0)
+        evicted = stats.items.get(slab_class, {}).get("evicted", 0)
+        slabs[slab_class] = {
+            "chunk_size": chunk_size,
+            "fill": _ratio(used_chunks, fields.get("total_chunks", 0)),
+            "efficiency": _ratio(fields.get("mem_requested", 0), used_chunks * chunk_size),
+            "evicted": evicted,
+            "evicted_rate": _ratio(evicted, uptime),
+        }
+
+    hits = general.get("get_hits", 0)
+    return {
+        "hit_ratio": _ratio(hits, hits + general.get("get_misses", 0)),
+        "eviction_rate": _ratio(general.get("evictions", 0), uptime),
+        "memory_fill": _ratio(general.get("bytes", 0), general.get("limit_maxbytes", 0)),
+        "slabs": slabs,
+    }
+
+
+def summary(collected):
+    """Derived figures of every server and the skew between servers: for every field in :const:`SKEW_FIELDS`,
+    the ratio of the largest value to the mean (1.0 means the load is spread evenly).
+
+    :param collected: list of :class:`ServerStats` returned by :func:`collect`
+
+    :returns: dict with keys "servers" ({server: figures returned by :func:`derive`}) and "skew"
+    """
+
+    skew = {}
+    for field in SKEW_FIELDS:
+        values = [stats.general.get(field, 0) for stats in collected]
+        mean = _ratio(sum(values), len(values))
+        skew[field] = _ratio(max(values), mean) if values else 0.0
+    return {
+        "servers": {stats.server: derive(stats) for stats in collected},
+        "skew": skew,
+    }
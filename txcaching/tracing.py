@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from twisted.python import log
+from twisted.python.failure import Failure
+
+#Hooks called on start and finish of every traced operation. Use :func:`add_hook` and :func:`remove_hook`.
+hooks = []
+
+
+class Operation(object):
+    """Traced operation: a memcached command sent by :class:`txcaching.connection.CacheProtocol`,
+    or a lookup or a call of the cached function on a miss made by a decorator.
+
+    name: command name ("get", "add", ...), or "lookup" and "recompute" for decorators.
+    key: key of the item (list of keys for getMultiple).
+    server: address of memcached server ("host:port" or the path of the Unix socket), None for decorators.
+    function: :func:`txcaching.keyregistry.func_id` of the cached function, None for commands.
+    sent, received: sizes of values sent to and received from memcached, in bytes
+    (for "recompute", sent is the size of the computed value).
+    outcome: "hit", "miss", "ok", "rejected" (NOT_STORED, NOT_FOUND or EXISTS reply) or "error".
+    started, duration: time of the start (seconds since epoch) and the duration in seconds.
+    context: dictionary where hooks may keep their state of the operation.
+    """
+
+    __slots__ = ("name", "key", "server", "function", "sent", "received", "outcome", "started", "duration",
+                 "context")
+
+    def __init__(self, name, key=None, server=None, function=None, sent=0):
+        self.name = name
+        self.key = key
+        self.server = server
+        self.function = function
+        self.sent = sent
+        self.received = 0
+        self.outcome = None
+        self.started = time.time()
+        self.duration = None
+        self.context = {}
+
+
+def add_hook(hook):
+    """Call the hook on every operation. The hook must have methods start(operation) and finish(operation),
+    which get :class:`Operation`. They are called in the reactor thread and must not block.
+    """
+
+    hooks.append(hook)
+
+
+def remove_hook(hook):
+    """Stop calling the hook."""
+
+    hooks.remove(hook)
+
+
+def _call(method, operation):
+    """Call the method of every hook. Failures of hooks are logged and never break caching."""
+
+    for hook in hooks:
+        try:
+            getattr(hook, method)(operation)
+        except Exception:
+            log.err(None, "txcaching: tracing hook %r has failed" % (hook,))
+
+
+def start(name, key=None, server=None, function=None, sent=0):
+    """Start the operation and call the hooks.
+
+    :returns: :class:`Operation`
+    """
+
+    operation = Operation(name, key, server, function, sent)
+    if hooks:
+        _call("start", operation)
+    return operation
+
+
+def finish(operation, outcome, received=0):
+    """Finish the operation and call the hooks. Operations which are already finished are left unchanged."""
+
+    if operation.duration is not None:
+        return
+    operation.duration = time.time() - operation.started
+    operation.outcome = outcome
+    operation.received = received
+    if hooks:
+        _call("finish", operation)
+
+
+def describe(name, result):
+    """Outcome and received size of the result of a memcached command.
+
+    :param name: Name of the command. Only results of get and getMultiple are hits or misses.
+    :returns: pair (outcome, received bytes)
+    """
+
+    if isinstance(result, Failure):
+        return "error", 0
+    if name == "get":
+        value = result[-1]
+        return ("miss", 0) if value is None else ("hit", len(value))
+    if name == "getMultiple":
+        values = [info[-1] for info in result.itervalues()]
+        received = sum(len(value) for value in values if value is not None)
+        return ("miss" if None in values else "hit"), received
+    if result is False:
+        return "rejected", 0
+    return "ok", 0
+
+
+class SlowOperationLogger(object):
+    """Hook which logs operations longer than the threshold (in seconds) to twisted log."""
+
+    def __init__(self, threshold=0.1):
+        self.threshold = threshold
+
+    def start(self, operation):
+        pass
+
+    def finish(self, operation):
+        if operation.duration >= self.threshold:
+            log.msg("txcaching: slow %s of %r (server %s, function %s) took %.3f s: %s, sent %d, received %d bytes" %
+                    (operation.name, operation.key, operation.server, operation.function, operation.duration,
+                     operation.outcome, operation.sent, operation.received))
+
+
+class SpanAdapter(object):
+    """Hook which reports operations as spans to an OpenTracing-compatible tracer
+    (anything with start_span(operation_name, tags, start_time) returning spans with set_tag and finish).
+    The span of the active scope, if the tracer has one, becomes the parent.
+
+    :param tracer: Tracer, for example opentracing.tracer
+    """
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+
+    def start(self, operation):
+        tags = {"component": "txcaching", "db.type": "memcached"}
+        if operation.key is not None:
+            tags["db.statement"] = "%s %s" % (operation.name, operation.key)
+        if operation.server is not None:
+            tags["peer.address"] = operation.server
+        if operation.function is not None:
+            tags["txcaching.function"] = operation.function
+        operation.context[self] = self.tracer.start_span(operation_name="memcached.%s" % operation.name, tags=tags,
+                                                         start_time=operation.started)
+
+    def finish(self, operation):
+        span = operation.context.pop(self, None)
+        if span is None:
+            return
+        span.set_tag("txcaching.outcome", operation.outcome)
+        span.set_tag("txcaching.sent", operation.sent)
+        span.set_tag("txcaching.received", operation.received)
+        if operation.outcome == "error":
+            span.set_tag("error", True)
+        span.finish(finish_time=operation.started + operation.duration)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Pools of threads for blocking work, so that the reactor keeps serving other requests meanwhile.
+Every pool counts the calls waiting for a thread and running, and the time calls wait for a thread
+(see :class:`txcaching.metrics.PoolMetrics`).
+"""
+
+import time
+
+from twisted.internet import threads
+from twisted.python.threadpool import ThreadPool
+
+from . import metrics
+
+#Pool which runs functions in the reactor thread pool, see :func:`default_pool`.
+_default = None
+
+
+class Pool(object):
+    """Threads to run blocking functions in.
+
+    :param name: Name of the pool in metrics.
+    :param size: Maximal number of threads. If it is None, the thread pool of the reactor is used
+        (its size is set by reactor.suggestThreadPoolSize). Otherwise, the pool has its own threads,
+        which are started on the first call and stopped when the reactor stops.
+    :param reactor: Reactor to deliver results to. By default, the global reactor.
+    """
+
+    def __init__(self, name="default", size=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.name = name
+        self.size = size
+        self.reactor = reactor
+        self.metrics = metrics.registry.pool(name)
+        self.threadpool = None
+
+    def _threadpool(self):
+        if self.size is None:
+            return self.reactor.getThreadPool()
+        if self.threadpool is None:
+            self.threadpool = ThreadPool(minthreads=0, maxthreads=self.size, name="txcaching-%s" % self.name)
+            self.threadpool.start()
+            self.reactor.addSystemEventTrigger("during", "shutdown", self.stop)
+        return self.threadpool
+
+    def stop(self):
+        """Stop own threads of the pool. Calls which are waiting for a thread are never run."""
+
+        if self.threadpool is not None:
+            self.threadpool.stop()
+            self.threadpool = None
+
+    def _started(self, submitted, started):
+        self.metrics.queued -= 1
+        self.metrics.running += 1
+        self.metrics.wait.record(started - submitted)
+
+    def _finished(self, result):
+        self.metrics.running -= 1
+        self.metrics.completed += 1
+        return result
+
+    def run(self, func, *args, **kwargs):
+        """Call the function in a thread of the pool. The function must not use Twisted APIs
+        which aren't thread-safe, and it must return a value rather than a Deferred.
+
+        :returns: Deferred which fires in the reactor thread with the result of the function
+        """
+
+        submitted = time.time()
+        callFromThread = self.reactor.callFromThread
+
+        def call():
+            callFromThread(self._started, submitted, time.time())
+            return func(*args, **kwargs)
+
+        self.metrics.queued += 1
+        d = threads.deferToThreadPool(self.reactor, self._threadpool(), call)
+        #callFromThread keeps the order, so _started always precedes _finished.
+        return d.addBoth(self._finished)
+
+
+def default_pool():
+    """Pool which runs functions in the reactor thread pool, like :func:`twisted.internet.threads.deferToThread`."""
+
+    global _default
+    if _default is None:
+        _default = Pool()
+    return _default